@@ -0,0 +1,261 @@
+import os
+import numpy as np
+
+class FeatureStore:
+    #struct-of-arrays storage of feature observations, replaces lists of geometry.FeatureIn3d objects
+    #rows are sorted by pose (in the order of pose_ids) and then by feature id, so observations of every pose are a contiguous block
+    #visibility of features (which poses a feature is observed from) is stored in CSR format
+    def __init__(self, pose_ids:list[int], observation_pose_ids, feature_ids, positions, covariances):
+        self.pose_ids = list(pose_ids)
+        pose_ids_array = np.array(self.pose_ids, dtype = np.int64)
+        observation_pose_ids = np.asarray(observation_pose_ids, dtype = np.int64)
+        feature_ids = np.asarray(feature_ids, dtype = np.int64)
+        pose_order = np.argsort(pose_ids_array)
+        pose_ranks = pose_order[np.searchsorted(pose_ids_array, observation_pose_ids, sorter = pose_order)]
+        assert np.array_equal(pose_ids_array[pose_ranks], observation_pose_ids), 'Error! Observations of unknown poses.'
+        order = np.lexsort((feature_ids, pose_ranks))
+        self.observation_pose_ids = observation_pose_ids[order]
+        self.feature_ids = feature_ids[order]
+        self.positions = np.asarray(positions, dtype = np.float64).reshape((-1,3))[order]
+        self.covariances = np.asarray(covariances).reshape((-1,3,3))[order] #float64 or float32
+        self.pose_offsets = np.searchsorted(pose_ranks[order], np.arange(len(self.pose_ids) + 1))
+
+        #CSR visibility index: poses of feature unique_feature_ids[i] are visibility_pose_ids[visibility_offsets[i]:visibility_offsets[i+1]]
+        self.unique_feature_ids, self.feature_indices = np.unique(self.feature_ids, return_inverse = True)
+        self.feature_indices = self.feature_indices.reshape(-1)
+        visibility_order = np.argsort(self.feature_indices, kind = 'stable')
+        self.visibility_pose_ids = self.observation_pose_ids[visibility_order]
+        self.visibility_offsets = np.zeros(len(self.unique_feature_ids) + 1, dtype = np.int64)
+        self.visibility_counts = np.bincount(self.feature_indices, minlength = len(self.unique_feature_ids)).astype(np.int32)
+        np.cumsum(self.visibility_counts, out = self.visibility_offsets[1:])
+
+    @classmethod
+    def from_columns(cls, pose_ids:list[int], list_of_columns:list[dict]):
+        #builds the store from chunks of columns, e.g. returned by Simulator.simulate_reference_pose
+        if len(list_of_columns) == 0:
+            return cls.empty(pose_ids)
+        return cls(pose_ids, np.concatenate([columns['pose_id'] for columns in list_of_columns]),
+                   np.concatenate([columns['feature_id'] for columns in list_of_columns]),
+                   np.concatenate([columns['position'] for columns in list_of_columns]),
+                   np.concatenate([columns['covariance'] for columns in list_of_columns]))
+
+    @classmethod
+    def from_dict_of_features(cls, dict_of_features:dict[int,list]):
+        #builds the store from dictionary pose id -> list of geometry.FeatureIn3d
+        observation_pose_ids = [pose_id for (pose_id, features) in dict_of_features.items() for _ in features]
+        feature_ids = [feature.id for features in dict_of_features.values() for feature in features]
+        positions = [feature.position[:,0] for features in dict_of_features.values() for feature in features]
+        covariances = [feature.covariance for features in dict_of_features.values() for feature in features]
+        return cls(list(dict_of_features.keys()), observation_pose_ids, feature_ids, np.reshape(positions, (-1,3)), np.reshape(covariances, (-1,3,3)))
+
+    @classmethod
+    def empty(cls, pose_ids:list[int] = ()):
+        return cls(pose_ids, np.zeros(0), np.zeros(0), np.zeros((0,3)), np.zeros((0,3,3)))
+
+    def __len__(self):
+        return len(self.feature_ids)
+
+    @property
+    def number_of_measurements(self): #number of poses the feature of every observation is visible from
+        return self.visibility_counts[self.feature_indices]
+
+    def get_visibility(self, feature_id:int):
+        index = np.searchsorted(self.unique_feature_ids, feature_id)
+        if index == len(self.unique_feature_ids) or self.unique_feature_ids[index] != feature_id:
+            return np.zeros(0, dtype = np.int64)
+        return self.visibility_pose_ids[self.visibility_offsets[index]:self.visibility_offsets[index+1]]
+
+    def get_columns(self, first_row:int = 0, last_row:int = None):
+        #returns rows as columns (pose_id, feature_id, number_of_measurements, position, covariance) used by the writers,
+        #the arrays are views, except number_of_measurements
+        rows = slice(first_row, last_row)
+        return {'pose_id': self.observation_pose_ids[rows], 'feature_id': self.feature_ids[rows],
+                'number_of_measurements': self.visibility_counts[self.feature_indices[rows]],
+                'position': self.positions[rows], 'covariance': self.covariances[rows]}
+
+    def get_pose_view(self, pose_id:int):
+        pose_index = self.pose_ids.index(pose_id)
+        return self.get_columns(self.pose_offsets[pose_index], self.pose_offsets[pose_index+1])
+
+    def pose_views(self):
+        #yields (pose_id, columns) for every pose, observations of a pose are views of the store
+        for (pose_index, pose_id) in enumerate(self.pose_ids):
+            yield pose_id, self.get_columns(self.pose_offsets[pose_index], self.pose_offsets[pose_index+1])
+
+    def get_incidence(self):
+        #pose by feature incidence of observations, row i of the store (and of lidar_measurements) is the observation of feature
+        #unique_feature_ids[feature_indices[i]] by pose pose_ids[pose_indices[i]] (COO format), rows are grouped by pose, so
+        #pose_offsets with feature_indices is CSR by pose, feature_offsets with feature_rows (rows of observations of every feature) is CSR by feature
+        pose_indices = np.repeat(np.arange(len(self.pose_ids), dtype = np.int32), np.diff(self.pose_offsets))
+        return {'pose_indices': pose_indices, 'feature_indices': self.feature_indices.astype(np.int32), 'pose_offsets': self.pose_offsets.astype(np.int64),
+                'feature_offsets': self.visibility_offsets, 'feature_rows': np.argsort(self.feature_indices, kind = 'stable').astype(np.int64),
+                'observations_per_pose': np.diff(self.pose_offsets).astype(np.int32), 'observations_per_feature': self.visibility_counts}
+
+    def update_positions(self, update):
+        #calls update(columns) for blocks of rows in the order of the store, update modifies columns['position'] in place
+        update(self.get_columns())
+
+    def close(self):
+        #nothing to release, see SpilledFeatureStore.close
+        pass
+
+class SpilledFeatureStore:
+    #out-of-core storage of feature observations for networks that do not fit in memory, chunks of columns (see Simulator.simulate_reference_pose)
+    #are buffered up to memory_budget bytes, then sorted like rows of FeatureStore and spilled to a run of .npy files in the scratch directory,
+    #pose_views merges observations of every pose from all runs (memory-mapped), so the writers get the same rows as from FeatureStore,
+    #number_of_measurements is taken from the chunks, all observations of a feature belong to the chunk of its reference pose, so every feature
+    #is in one run and its visibility is indexed per run (CSR like FeatureStore, memory-mapped), only unique_feature_ids and their runs stay in memory
+    column_names = ('pose_id', 'feature_id', 'number_of_measurements', 'position', 'covariance')
+
+    def __init__(self, pose_ids:list[int], memory_budget:int, scratch_directory:str = None):
+        self.pose_ids = list(pose_ids)
+        self.pose_ids_array = np.array(self.pose_ids, dtype = np.int64)
+        self.pose_order = np.argsort(self.pose_ids_array)
+        self.memory_budget = memory_budget
+        import tempfile #imported only for out-of-core simulation
+        if scratch_directory is not None:
+            os.makedirs(scratch_directory, exist_ok = True)
+        self.directory = tempfile.mkdtemp(prefix = 'spilled_features_', dir = scratch_directory)
+        self.buffer = []
+        self.buffer_size = 0
+        self.empty_columns = {'pose_id': np.zeros(0, np.int64), 'feature_id': np.zeros(0, np.int64), 'number_of_measurements': np.zeros(0, np.int32),
+                              'position': np.zeros((0,3)), 'covariance': np.zeros((0,3,3))} #columns of poses without observations
+        self.runs = [] #columns of every run, memory-mapped
+        self.number_of_rows = 0
+        self.segments = [] #(pose rank, run, first row, last row) of observations of poses in runs, sorted by pose rank by finish
+        self.run_feature_ids = [] #unique feature ids of every run
+        self.run_visibility = [] #visibility_pose_ids and visibility_offsets of every run, memory-mapped
+
+    def append(self, columns:dict[str,np.ndarray]):
+        #sorting of the buffer copies it, so the buffer is spilled at half of the budget
+        if self.number_of_rows == 0:
+            self.empty_columns = {name: np.zeros((0,) + columns[name].shape[1:], columns[name].dtype) for name in self.column_names}
+        self.buffer.append({name: columns[name] for name in self.column_names})
+        self.buffer_size += sum(columns[name].nbytes for name in self.column_names)
+        self.number_of_rows += len(columns['feature_id'])
+        if 2*self.buffer_size >= self.memory_budget:
+            self.spill()
+
+    def get_pose_ranks(self, observation_pose_ids):
+        return self.pose_order[np.searchsorted(self.pose_ids_array, observation_pose_ids, sorter = self.pose_order)]
+
+    def spill(self):
+        if len(self.buffer) == 0:
+            return
+        columns = {name: np.concatenate([chunk[name] for chunk in self.buffer]) for name in self.column_names}
+        self.buffer = []
+        self.buffer_size = 0
+        pose_ranks = self.get_pose_ranks(columns['pose_id'])
+        order = np.lexsort((columns['feature_id'], pose_ranks))
+        run_directory = os.path.join(self.directory, str(len(self.runs)))
+        os.makedirs(run_directory)
+        for name in self.column_names:
+            np.save(os.path.join(run_directory, name + '.npy'), columns[name][order])
+        (feature_ids, feature_indices) = np.unique(columns['feature_id'][order], return_inverse = True)
+        np.save(os.path.join(run_directory, 'visibility_pose_ids.npy'), columns['pose_id'][order][np.argsort(feature_indices.reshape(-1), kind = 'stable')])
+        visibility_offsets = np.zeros(len(feature_ids) + 1, dtype = np.int64)
+        np.cumsum(np.bincount(feature_indices.reshape(-1), minlength = len(feature_ids)), out = visibility_offsets[1:])
+        np.save(os.path.join(run_directory, 'visibility_offsets.npy'), visibility_offsets)
+        self.run_feature_ids.append(feature_ids)
+        del columns, feature_indices
+        #only poses observed in the run get segments, runs of coherent blocks of poses (see Simulator.generate_features_out_of_core) have few of them
+        (present_pose_ranks, first_rows, counts) = np.unique(pose_ranks[order], return_index = True, return_counts = True)
+        self.segments.append(np.column_stack((present_pose_ranks, np.full(len(present_pose_ranks), len(self.runs)), first_rows, first_rows + counts)))
+        #runs are writable, so update_positions can add noise to the observations in place
+        self.runs.append({name: np.load(os.path.join(run_directory, name + '.npy'), mmap_mode = 'r+') for name in self.column_names})
+        self.run_visibility.append({name: np.load(os.path.join(run_directory, name + '.npy'), mmap_mode = 'r') for name in ('visibility_pose_ids', 'visibility_offsets')})
+
+    def finish(self):
+        #spills the rest of the buffer and indexes observations of every pose in the runs
+        self.spill()
+        segments = np.concatenate(self.segments).astype(np.int64) if len(self.segments) > 0 else np.zeros((0,4), dtype = np.int64)
+        self.segments = segments[np.argsort(segments[:,0], kind = 'stable')]
+        self.segment_offsets = np.searchsorted(self.segments[:,0], np.arange(len(self.pose_ids) + 1))
+        number_of_rows_of_poses = np.zeros(len(self.pose_ids), dtype = np.int64)
+        np.add.at(number_of_rows_of_poses, self.segments[:,0], self.segments[:,3] - self.segments[:,2])
+        self.pose_offsets = np.zeros(len(self.pose_ids) + 1, dtype = np.int64) #rows of poses in the order of pose_views, see get_columns
+        np.cumsum(number_of_rows_of_poses, out = self.pose_offsets[1:])
+        feature_ids = np.concatenate(self.run_feature_ids) if len(self.run_feature_ids) > 0 else np.zeros(0, dtype = np.int64)
+        feature_runs = np.repeat(np.arange(len(self.run_feature_ids)), [len(run_feature_ids) for run_feature_ids in self.run_feature_ids])
+        feature_indices_in_runs = np.concatenate([np.arange(len(run_feature_ids)) for run_feature_ids in self.run_feature_ids]) if len(self.run_feature_ids) > 0 else np.zeros(0, dtype = np.int64)
+        order = np.argsort(feature_ids)
+        (self.unique_feature_ids, self.feature_runs, self.feature_indices_in_runs) = (feature_ids[order], feature_runs[order], feature_indices_in_runs[order])
+        self.run_feature_ids = []
+
+    def __len__(self):
+        return self.number_of_rows
+
+    @property
+    def number_of_runs(self):
+        return len(self.runs)
+
+    def get_parts_of_pose(self, pose_index:int):
+        #observations of the pose in every run, views of the runs
+        return [{name: column[first_row:last_row] for (name, column) in self.runs[run_index].items()}
+                for (_, run_index, first_row, last_row) in self.segments[self.segment_offsets[pose_index]:self.segment_offsets[pose_index+1]].tolist()]
+
+    def merge_parts(self, parts:list[dict]):
+        #returns merged columns and order of rows of the concatenated parts (None if the columns are the part itself)
+        if len(parts) == 0:
+            return {name: column.copy() for (name, column) in self.empty_columns.items()}, None
+        if len(parts) == 1:
+            return parts[0], None
+        columns = {name: np.concatenate([part[name] for part in parts]) for name in self.column_names}
+        order = np.argsort(columns['feature_id'], kind = 'stable')
+        return {name: column[order] for (name, column) in columns.items()}, order
+
+    def get_columns_of_pose(self, pose_index:int):
+        #observations of the pose from all runs, views of the run if all of them are in one run
+        return self.merge_parts(self.get_parts_of_pose(pose_index))[0]
+
+    def get_columns(self, first_row:int = 0, last_row:int = None):
+        #rows in the order of pose_views (as rows of FeatureStore) as columns, read from the runs, views only if the rows are in one part of a run,
+        #so the whole store (the default) is read into memory
+        last_row = len(self) if last_row is None else min(last_row, len(self))
+        first_pose_index = int(np.searchsorted(self.pose_offsets, first_row, 'right')) - 1
+        last_pose_index = int(np.searchsorted(self.pose_offsets, last_row, 'left'))
+        list_of_columns = [self.get_columns_of_pose(pose_index) for pose_index in range(max(first_pose_index, 0), min(last_pose_index, len(self.pose_ids)))]
+        if len(list_of_columns) == 0 or first_row >= last_row:
+            return {name: column.copy() for (name, column) in self.empty_columns.items()}
+        rows = slice(first_row - self.pose_offsets[max(first_pose_index, 0)], last_row - self.pose_offsets[max(first_pose_index, 0)])
+        if len(list_of_columns) == 1:
+            return {name: column[rows] for (name, column) in list_of_columns[0].items()}
+        return {name: np.concatenate([columns[name] for columns in list_of_columns])[rows] for name in self.column_names}
+
+    def get_visibility(self, feature_id:int):
+        index = np.searchsorted(self.unique_feature_ids, feature_id)
+        if index == len(self.unique_feature_ids) or self.unique_feature_ids[index] != feature_id:
+            return np.zeros(0, dtype = np.int64)
+        visibility = self.run_visibility[self.feature_runs[index]]
+        feature_index = self.feature_indices_in_runs[index]
+        return np.array(visibility['visibility_pose_ids'][visibility['visibility_offsets'][feature_index]:visibility['visibility_offsets'][feature_index+1]])
+
+    def update_positions(self, update):
+        #calls update(columns) pose by pose in the order of pose_views, positions of poses merged from several runs are written back to the runs
+        for pose_index in range(len(self.pose_ids)):
+            parts = self.get_parts_of_pose(pose_index)
+            (columns, order) = self.merge_parts(parts)
+            update(columns)
+            if order is None:
+                continue
+            positions = np.empty_like(columns['position'])
+            positions[order] = columns['position']
+            first_row = 0
+            for part in parts:
+                part['position'][:] = positions[first_row:first_row + len(part['position'])]
+                first_row += len(part['position'])
+
+    def get_pose_view(self, pose_id:int):
+        return self.get_columns_of_pose(self.pose_ids.index(pose_id))
+
+    def pose_views(self):
+        #yields (pose_id, columns) for every pose, in the order of pose_ids, with rows sorted by feature id
+        for (pose_index, pose_id) in enumerate(self.pose_ids):
+            yield pose_id, self.get_columns_of_pose(pose_index)
+
+    def close(self):
+        #removes the scratch files, the store can not be used after it
+        self.runs = []
+        self.run_visibility = []
+        import shutil
+        shutil.rmtree(self.directory, ignore_errors = True)
@@ -0,0 +1,116 @@
+import time
+import os
+import contextlib
+#json, cProfile and tracemalloc are imported only by enabled profilers, so runs without --profile start faster
+
+capture_modes = ('cprofile', 'tracemalloc')
+
+def get_size_of_path(path:str):
+    #size of file or of all files in directory (e.g. npy output), 0 if the path does not exist
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(directory, file_name)) for (directory, _, file_names) in os.walk(path) for file_name in file_names)
+
+class Profiler:
+    #collects times of stages, counters and sizes of written files of a simulation run and saves them as json report,
+    #a disabled profiler does nothing, so the stages can always be wrapped with it
+    def __init__(self, enabled:bool = False, capture_modes:tuple = ()):
+        self.enabled = enabled or len(capture_modes) > 0
+        self.capture_modes = tuple(capture_modes)
+        self.stages = {} #stage name -> time and, in tracemalloc mode, peak of allocated memory
+        self.counters = {}
+        self.file_sizes = {}
+        self.profile = None
+        self.start_time = None
+        self.total_time = None
+
+    def start(self):
+        if not self.enabled:
+            return
+        if 'tracemalloc' in self.capture_modes:
+            import tracemalloc
+            tracemalloc.start()
+        if 'cprofile' in self.capture_modes:
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        self.start_time = time.perf_counter()
+
+    def stop(self):
+        if not self.enabled or self.start_time is None:
+            return
+        self.total_time = time.perf_counter() - self.start_time
+        if self.profile is not None:
+            self.profile.disable()
+        import tracemalloc
+        if tracemalloc.is_tracing():
+            self.top_allocations = [{'location': str(statistic.traceback[0]), 'size_bytes': statistic.size, 'count': statistic.count}
+                                    for statistic in tracemalloc.take_snapshot().statistics('lineno')[:20]]
+            tracemalloc.stop()
+
+    @contextlib.contextmanager
+    def stage(self, name:str):
+        #times of stages with the same name are summed up
+        if not self.enabled:
+            yield
+            return
+        import tracemalloc
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            memory_at_start = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'time_s': 0.0, 'calls': 0})
+            stage['time_s'] += time.perf_counter() - start
+            stage['calls'] += 1
+            if tracing:
+                peak_memory = tracemalloc.get_traced_memory()[1] - memory_at_start
+                stage['peak_memory_bytes'] = max(stage.get('peak_memory_bytes', 0), peak_memory)
+
+    def add_stage_times(self, times:dict[str,float]):
+        #times of stages run concurrently (e.g. writers in threads), their sum can exceed the time of the enclosing stage
+        if not self.enabled:
+            return
+        for (name, time_s) in times.items():
+            stage = self.stages.setdefault(name, {'time_s': 0.0, 'calls': 0})
+            stage['time_s'] += time_s
+            stage['calls'] += 1
+
+    def add_counters(self, counters:dict):
+        if not self.enabled:
+            return
+        for (name, value) in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def record_file_sizes(self, paths:list[str]):
+        if not self.enabled:
+            return
+        for path in paths:
+            if os.path.exists(path):
+                self.file_sizes[os.path.basename(path)] = get_size_of_path(path)
+
+    def get_report(self, number_of_functions:int = 30):
+        report = {'total_time_s': self.total_time, 'stages': self.stages, 'counters': self.counters,
+                  'file_sizes_bytes': self.file_sizes, 'total_bytes_written': sum(self.file_sizes.values())}
+        if 'tracemalloc' in self.capture_modes and hasattr(self, 'top_allocations'):
+            report['top_allocations'] = self.top_allocations
+        if self.profile is not None:
+            import pstats #imported only in cprofile mode
+            statistics = pstats.Stats(self.profile)
+            functions = sorted(statistics.stats.items(), key = lambda item: item[1][3], reverse = True)[:number_of_functions]
+            report['top_functions'] = [{'function': f'{file_name}:{line}({function_name})', 'calls': calls, 'total_time_s': total_time, 'cumulative_time_s': cumulative_time}
+                                       for ((file_name, line, function_name), (_, calls, total_time, cumulative_time, _)) in functions]
+        return report
+
+    def save_report(self, path_to_json_file:str):
+        #in cprofile mode the full profile is also saved next to the report (.prof file, e.g. for snakeviz or pstats)
+        if not self.enabled:
+            return
+        import json
+        with open(path_to_json_file, 'w') as file:
+            json.dump(self.get_report(), file, indent = 2)
+        if self.profile is not None:
+            self.profile.dump_stats(os.path.splitext(path_to_json_file)[0] + '.prof')
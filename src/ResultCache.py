@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+
+import geometry
+import SimulationConfig
+
+cache_version = 3 #must be increased when the simulation or the writers change their output
+config_fields_not_changing_output = ('number_of_workers', 'seed', 'cache_directory', 'cache_size_limit_mb', 'memory_budget_mb', 'scratch_directory', 'number_of_writer_threads') #the seed is hashed separately, it is the seed actually used
+
+def get_cache_key(poses:dict[int,geometry.Pose], graph:geometry.SimpleVisibilityGraph, config:SimulationConfig.Config, seed:int):
+    #sha256 of the normalized inputs: order of poses and edges matters (feature ids and matching depend on it),
+    #formatting of the input files does not
+    hasher = hashlib.sha256()
+    hasher.update(f'version {cache_version} seed {int(seed)}\n'.encode())
+    hasher.update(np.array(list(poses.keys()), dtype = np.int64).tobytes())
+    hasher.update(np.array([pose.position for pose in poses.values()], dtype = np.float64).tobytes())
+    hasher.update(np.array([pose.rotation_matrix() for pose in poses.values()], dtype = np.float64).tobytes())
+    hasher.update(','.join(pose.type for pose in poses.values()).encode())
+    hasher.update(np.array([(edge.from_id, edge.to_id) for edge in graph.edges], dtype = np.int64).tobytes())
+    fields = {name: value for (name, value) in sorted(vars(config).items()) if not name in config_fields_not_changing_output}
+    hasher.update(json.dumps(fields, sort_keys = True, default = str).encode())
+    return hasher.hexdigest()
+
+def list_files(path:str):
+    #relative paths of files of path (file or directory, e.g. npy output)
+    if os.path.isfile(path):
+        return [os.path.basename(path)]
+    return [os.path.relpath(os.path.join(directory, file_name), os.path.dirname(path))
+            for (directory, _, file_names) in os.walk(path) for file_name in sorted(file_names)]
+
+def remove_path(path:str):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+class ResultCache:
+    #on-disk cache of simulation outputs, every entry is a directory named by the cache key with the output files and entry.json,
+    #modification time of entry.json is the time of the last use, the least recently used entries are evicted above the size limit
+    def __init__(self, directory:str, size_limit_bytes:int):
+        assert size_limit_bytes >= 0
+        self.directory = directory
+        self.size_limit_bytes = size_limit_bytes
+        os.makedirs(directory, exist_ok = True)
+
+    def get_entry_directory(self, key:str):
+        return os.path.join(self.directory, key)
+
+    def read_entry(self, key:str):
+        try:
+            with open(os.path.join(self.get_entry_directory(key), 'entry.json')) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def restore(self, key:str, output_paths:list[str]):
+        #restores outputs of the entry to output_paths (hard links if possible, copies otherwise), returns False on a cache miss,
+        #entries with missing or modified files are removed
+        entry = self.read_entry(key)
+        entry_directory = self.get_entry_directory(key)
+        if entry is None or sorted(entry['outputs']) != sorted(os.path.basename(path) for path in output_paths):
+            return False
+        files = entry['files']
+        if not all(os.path.isfile(os.path.join(entry_directory, file)) and os.path.getsize(os.path.join(entry_directory, file)) == size for (file, size) in files.items()):
+            remove_path(entry_directory)
+            return False
+        for output_path in output_paths:
+            remove_path(output_path)
+        output_directory = os.path.dirname(output_paths[0])
+        for file in files.keys():
+            target = os.path.join(output_directory, file)
+            os.makedirs(os.path.dirname(target), exist_ok = True)
+            try:
+                os.link(os.path.join(entry_directory, file), target)
+            except OSError: #e.g. cache on a different file system
+                shutil.copy2(os.path.join(entry_directory, file), target)
+        os.utime(os.path.join(entry_directory, 'entry.json'))
+        return True
+
+    def store(self, key:str, output_paths:list[str]):
+        #copies outputs to a new entry (written to a temporary directory first, so readers never see a partial entry) and evicts old entries
+        entry_directory = self.get_entry_directory(key)
+        temporary_directory = f'{entry_directory}.tmp-{os.getpid()}'
+        remove_path(temporary_directory)
+        files = {}
+        for output_path in output_paths:
+            for file in list_files(output_path):
+                source = os.path.join(os.path.dirname(output_path), file)
+                target = os.path.join(temporary_directory, file)
+                os.makedirs(os.path.dirname(target), exist_ok = True)
+                shutil.copy2(source, target)
+                files[file] = os.path.getsize(target)
+        entry = {'key': key, 'outputs': [os.path.basename(path) for path in output_paths], 'files': files, 'size_bytes': sum(files.values()), 'created': time.time()}
+        with open(os.path.join(temporary_directory, 'entry.json'), 'w') as file:
+            json.dump(entry, file, indent = 2)
+        remove_path(entry_directory)
+        try:
+            os.rename(temporary_directory, entry_directory)
+        except OSError: #the same entry was stored by another process in the meantime
+            remove_path(temporary_directory)
+        self.evict()
+
+    def evict(self):
+        #removes the least recently used entries until the cache fits into the size limit
+        entries = []
+        for key in os.listdir(self.directory):
+            entry = self.read_entry(key)
+            if entry is not None:
+                entries.append((os.path.getmtime(os.path.join(self.get_entry_directory(key), 'entry.json')), entry['size_bytes'], key))
+        total_size = sum(size for (_, size, _) in entries)
+        for (_, size, key) in sorted(entries):
+            if total_size <= self.size_limit_bytes:
+                break
+            remove_path(self.get_entry_directory(key))
+            total_size -= size
+        return total_size
@@ -1,5 +1,16 @@
 import xml.etree.ElementTree as ET
 
+feature_generation_engines = ('legacy', 'batch')
+output_formats = ('text', 'npy', 'npz')
+visibility_modes = ('random', 'geometric')
+
+def read_optional_element(config, name:str, default):
+    #elements added after the first version of the config format are optional, so old config files stay valid
+    element = config.find(name)
+    if element is None or element.text is None:
+        return default
+    return element.text.strip()
+
 class Config:
     def __init__(self):
         self.number_of_features_per_cloud = 2000
@@ -15,6 +26,21 @@ class Config:
         self.pose_noise_position = 0.05
         self.pose_noise_rotation_deg = 3.0
         self.axes_length_in_dxf = 1.0
+        self.dxf_ray_decimation = 1 #only rays of features with id divisible by dxf_ray_decimation are written to dxf
+        self.max_rays_per_pose_in_dxf = 0 #0 - no limit
+        self.feature_generation_engine = 'legacy' #legacy (the original per-feature loop), batch (vectorized, required by streaming, workers, geometric visibility, state and memory budget)
+        self.visibility_mode = 'random' #random - features are matched only by matching_probability, geometric - also by range and vertical angle limits of query poses (batch engine only)
+        self.output_format = 'text' #text, npy, npz
+        self.use_streaming = False #writes results while simulating, one reference pose at a time (batch engine only)
+        self.number_of_workers = 1 #number of processes simulating reference poses in parallel (batch engine only)
+        self.use_float32_covariances = False #computes and stores covariances of points in single precision
+        self.seed = None #seed of all random streams, a new random seed is used for every run if not given
+        self.cache_directory = None #directory of the cache of simulation results, results are not cached if not given
+        self.cache_size_limit_mb = 1024.0 #least recently used results are removed from the cache above this size
+        self.export_problem_structure = False #writes sparsity structure of the optimization problem to problem_structure.npz (not available with streaming)
+        self.memory_budget_mb = 0.0 #observations above this size are spilled to scratch files (out-of-core simulation, batch engine only), 0 - all in memory
+        self.scratch_directory = None #directory of the scratch files of out-of-core simulation, the temporary directory of the system if not given
+        self.number_of_writer_threads = 1 #number of threads writing output files concurrently (pays off on slow or network file systems), 1 - files are written one after another
        
     def read_from_xml(self,path_to_xml_file):
         tree = ET.parse(path_to_xml_file)
@@ -32,6 +58,22 @@ class Config:
         self.pose_noise_position = float(config.find('pose_noise_position').text)
         self.pose_noise_rotation_deg = float(config.find('pose_noise_rotation_deg').text)
         self.axes_length_in_dxf = float(config.find('axes_length_in_dxf').text)
+        self.dxf_ray_decimation = int(read_optional_element(config, 'dxf_ray_decimation', self.dxf_ray_decimation))
+        self.max_rays_per_pose_in_dxf = int(read_optional_element(config, 'max_rays_per_pose_in_dxf', self.max_rays_per_pose_in_dxf))
+        self.feature_generation_engine = read_optional_element(config, 'feature_generation_engine', self.feature_generation_engine)
+        self.output_format = read_optional_element(config, 'output_format', self.output_format)
+        self.visibility_mode = read_optional_element(config, 'visibility_mode', self.visibility_mode)
+        self.use_streaming = read_optional_element(config, 'use_streaming', str(self.use_streaming)) == 'True'
+        self.number_of_workers = int(read_optional_element(config, 'number_of_workers', self.number_of_workers))
+        self.use_float32_covariances = read_optional_element(config, 'use_float32_covariances', str(self.use_float32_covariances)) == 'True'
+        seed = read_optional_element(config, 'seed', None)
+        self.seed = int(seed) if seed is not None else None
+        self.cache_directory = read_optional_element(config, 'cache_directory', self.cache_directory)
+        self.cache_size_limit_mb = float(read_optional_element(config, 'cache_size_limit_mb', self.cache_size_limit_mb))
+        self.export_problem_structure = read_optional_element(config, 'export_problem_structure', str(self.export_problem_structure)) == 'True'
+        self.memory_budget_mb = float(read_optional_element(config, 'memory_budget_mb', self.memory_budget_mb))
+        self.scratch_directory = read_optional_element(config, 'scratch_directory', self.scratch_directory)
+        self.number_of_writer_threads = int(read_optional_element(config, 'number_of_writer_threads', self.number_of_writer_threads))
         assert self.number_of_features_per_cloud > 0
         assert self.gaussian_noise_point_position >= 0.0
         assert self.gaussian_noise_angle_deg >= 0.0
@@ -46,7 +88,33 @@ class Config:
         assert self.pose_noise_position >= 0.0
         assert self.pose_noise_rotation_deg >= 0.0
         assert self.axes_length_in_dxf > 0.0
-        
+        assert self.dxf_ray_decimation >= 1
+        assert self.max_rays_per_pose_in_dxf >= 0
+        assert self.feature_generation_engine in feature_generation_engines
+        assert self.output_format in output_formats
+        assert self.visibility_mode in visibility_modes
+        assert self.visibility_mode == 'random' or self.feature_generation_engine == 'batch', 'Error! Geometric visibility is available only for the batch engine.'
+        assert not self.use_streaming or self.feature_generation_engine == 'batch', 'Error! Streaming is available only for the batch engine.'
+        assert not (self.use_streaming and self.export_problem_structure), 'Error! Problem structure can not be exported with streaming.'
+        assert self.number_of_workers >= 1
+        assert self.seed is None or self.seed >= 0
+        assert self.cache_size_limit_mb >= 0.0
+        assert self.number_of_workers == 1 or self.feature_generation_engine == 'batch', 'Error! Parallel simulation is available only for the batch engine.'
+        assert self.memory_budget_mb >= 0.0
+        assert self.memory_budget_mb == 0.0 or self.feature_generation_engine == 'batch', 'Error! Out-of-core simulation is available only for the batch engine.'
+        assert not (self.memory_budget_mb > 0.0 and self.export_problem_structure), 'Error! Problem structure can not be exported with out-of-core simulation.'
+        assert self.number_of_writer_threads >= 1
+
+    def write_to_xml(self, path_to_xml_file):
+        #writes all elements, so the file can be read by read_from_xml, seed is written only if it is set
+        config = ET.Element('simulation_config')
+        for (name, value) in vars(self).items():
+            if value is not None:
+                ET.SubElement(config, name).text = str(value)
+        tree = ET.ElementTree(config)
+        ET.indent(tree, '\t')
+        tree.write(path_to_xml_file, encoding = 'unicode', xml_declaration = True)
+
     number_of_features_per_cloud = 2000
     gaussian_noise_point_position = 0.01
     gaussian_noise_angle_deg = 0.01
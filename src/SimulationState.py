@@ -0,0 +1,71 @@
+import os
+import json
+import shutil
+import collections
+import numpy as np
+
+import input_output as io
+
+state_version = 3 #must be increased when the simulation of reference poses changes its output or the format of the state changes
+
+def get_column_types(config):
+    return {'pose_id': (np.int64, ()), 'feature_id': (np.int64, ()), 'number_of_measurements': (np.int32, ()),
+            'position': (np.float64, (3,)), 'covariance': (np.float32 if config.use_float32_covariances else np.float64, (3,3))}
+
+class SimulationState:
+    #observations of every reference pose of a previous run (with noise) and signatures of their inputs, stored in a directory:
+    #chunks/ with one memory-mapped .npy file per column (rows grouped by reference pose) and state.json
+    def __init__(self, path:str):
+        with open(os.path.join(path, 'state.json')) as file:
+            self.meta = json.load(file)
+        assert self.meta['version'] == state_version, f'Error! State {path} was saved by a different version of the simulator.'
+        self.seed = self.meta['seed']
+        self.columns = io.read_binary_output(os.path.join(path, 'chunks'))
+
+    def get_signature(self, reference_pose_id:int):
+        chunk = self.meta['chunks'].get(str(reference_pose_id))
+        return chunk['signature'] if chunk is not None else None
+
+    def get_feature_id_block(self, reference_pose_id:int):
+        #(first feature id, step between feature ids) of the reference pose, see Simulator.get_feature_id_blocks
+        return tuple(self.meta['chunks'][str(reference_pose_id)]['feature_id_block'])
+
+    def get_chunk(self, reference_pose_id:int):
+        #stored observations of the reference pose, neither feature ids nor noise realizations are changed
+        chunk = self.meta['chunks'][str(reference_pose_id)]
+        rows = slice(chunk['offset'], chunk['offset'] + chunk['length'])
+        columns = {name: np.array(column[rows]) for (name, column) in self.columns.items()}
+        columns['statistics'] = collections.Counter(chunk['statistics'])
+        return columns
+
+    def close(self):
+        #releases memory-mapped files, required before the state is replaced by a new one
+        self.columns = None
+
+class SimulationStateWriter:
+    #writes chunks to a temporary directory, close replaces the state at path with it
+    def __init__(self, path:str, config, seed:int, pose_ids:list[int]):
+        self.path = path
+        self.temporary_path = path + '.new'
+        if os.path.isdir(self.temporary_path):
+            shutil.rmtree(self.temporary_path)
+        os.makedirs(self.temporary_path)
+        self.columns_writer = io.ColumnsWriter(os.path.join(self.temporary_path, 'chunks'), 'npy', get_column_types(config))
+        self.meta = {'version': state_version, 'seed': int(seed), 'pose_ids': [int(pose_id) for pose_id in pose_ids], 'chunks': {}}
+        self.number_of_rows = 0
+
+    def write(self, reference_pose_id:int, signature:str, feature_id_block:tuple, columns:dict[str,np.ndarray]):
+        number_of_rows = len(columns['feature_id'])
+        self.meta['chunks'][str(reference_pose_id)] = {'signature': signature, 'offset': self.number_of_rows, 'length': number_of_rows,
+                                                       'feature_id_block': [int(value) for value in feature_id_block],
+                                                       'statistics': {name: int(value) for (name, value) in columns['statistics'].items()}}
+        self.columns_writer.write(columns)
+        self.number_of_rows += number_of_rows
+
+    def close(self):
+        self.columns_writer.close()
+        with open(os.path.join(self.temporary_path, 'state.json'), 'w') as file:
+            json.dump(self.meta, file)
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.temporary_path, self.path)
@@ -1,25 +1,52 @@
 import utils
 import SimulationConfig
 import geometry
+import FeatureStore
 
-import random
+import collections
 import numpy as np
 
+simulation_config_fields = ('number_of_features_per_cloud', 'gaussian_noise_point_position', 'gaussian_noise_angle_deg', 'gaussian_noise_distance',
+                            'use_anisotropic_noise', 'matching_probability', 'min_distance', 'max_distance', 'min_vertical_angle_deg',
+                            'max_vertical_angle_deg', 'visibility_mode', 'use_float32_covariances') #fields changing observations of reference poses
+worker_state = None #simulator and arguments shared by all tasks of a worker process
+
+def initialize_worker(simulator, pose_ids:list[int], add_noise:bool):
+    global worker_state
+    worker_state = (simulator, pose_ids, add_noise)
+
+def simulate_reference_pose_in_worker(pose_index:int):
+    (simulator, pose_ids, add_noise) = worker_state
+    return simulator.simulate_reference_pose_with_noise(pose_index, pose_ids, add_noise)
+
 
 class Simulator(object):
-    def __init__(self, config:SimulationConfig):
+    def __init__(self, config:SimulationConfig, seed:int = None):
         self.config = config
+        self.seed = utils.get_seed(seed if seed is not None else config.seed)
         self.point_id = 1
-        self.dict_of_features = {}
+        self.feature_store = FeatureStore.FeatureStore.empty()
         self.dict_of_poses_visibility = {}
+        self.relative_transformations = {}
         self.dict_of_feature_counts = {}
+        self.statistics = collections.Counter() #counters of the last simulation, e.g. reported by the --profile option
+        self.previous_state = None #SimulationState of a previous run, its observations are reused for reference poses with unchanged inputs
+        self.state_writer = None #SimulationStateWriter, observations of all reference poses are saved with it for the next run
         #the order in measuerement covariance is: slant_distance, horizontal_angle, vertical_angle
         self.measurement_covariance = np.zeros((3,3))
         self.measurement_covariance[0,0] = self.config.gaussian_noise_distance * self.config.gaussian_noise_distance
         self.measurement_covariance[1,1] = utils.deg_to_rad(self.config.gaussian_noise_angle_deg) * utils.deg_to_rad(self.config.gaussian_noise_angle_deg)
         self.measurement_covariance[2,2] = self.measurement_covariance[1,1]
+        self.measurement_variances = np.diag(self.measurement_covariance).copy()
+        self.covariance_dtype = np.float32 if self.config.use_float32_covariances else np.float64
+
+    def __getstate__(self):
+        #the simulator is sent to worker processes, which neither read nor write the state (open files cannot be pickled)
+        state = self.__dict__.copy()
+        state['previous_state'] = None
+        state['state_writer'] = None
+        return state
 
-        
     def repeat_range(self, n:int):
         while True:
             for i in range(n):
@@ -28,102 +55,350 @@ class Simulator(object):
     def run_simulations(self, poses:dict[int,geometry.Pose], graph:geometry.SimpleVisibilityGraph):
         self.point_id = 1
         self.dict_of_poses_visibility = self.create_dict_of_poses_visibility(graph)
+        if self.config.feature_generation_engine == 'batch': #noise is added separately to every reference pose
+            if self.config.use_anisotropic_noise:
+                print("Adding anisotropic noise using 3D covariance matrix!")
+            self.generate_features_batch(poses, add_noise = True)
+            return
         self.generate_features(poses)
         self.add_noise_to_feature_coordinates()
 
 
                 
-    def generate_random_feature(self, feature_id:int):
-        horizontal_angle = random.uniform(0, 2*np.pi)
-        vertical_angle = utils.deg_to_rad(random.uniform(self.config.min_vertical_angle_deg, self.config.max_vertical_angle_deg))
-        slant_distance = random.uniform(self.config.min_distance, self.config.max_distance)
+    def generate_random_feature(self, rng:np.random.Generator, feature_id:int):
+        horizontal_angle = rng.uniform(0, 2*np.pi)
+        vertical_angle = utils.deg_to_rad(rng.uniform(self.config.min_vertical_angle_deg, self.config.max_vertical_angle_deg))
+        slant_distance = rng.uniform(self.config.min_distance, self.config.max_distance)
         #horizontal_distance = slant_distance*np.cos(vertical_angle)
         x, y, z = geometry.spherical_to_cartesian(slant_distance, horizontal_angle, vertical_angle)
         #anisotropic covariance generation:
-        jacobian = geometry.get_jacobian_of_mapping_to_cartesian_coordinates(slant_distance, horizontal_angle, vertical_angle)
-        position_covariance = jacobian@self.measurement_covariance@np.transpose(jacobian)
+        position_covariance = geometry.get_covariances_of_cartesian_coordinates(slant_distance, horizontal_angle, vertical_angle, self.measurement_variances, self.covariance_dtype)
         feature = geometry.FeatureIn3d(id = feature_id, position = np.array([x,y,z]).reshape((3,1)), uncertainty = self.config.gaussian_noise_point_position, covariance = position_covariance)
         return feature
     
+    def generate_random_features(self, rng:np.random.Generator, number_of_features:int):
+        #batch version of generate_random_feature, returns N x 3 positions and N x 3 x 3 covariances
+        horizontal_angles = rng.uniform(0, 2*np.pi, number_of_features)
+        vertical_angles = utils.deg_to_rad(rng.uniform(self.config.min_vertical_angle_deg, self.config.max_vertical_angle_deg, number_of_features))
+        slant_distances = rng.uniform(self.config.min_distance, self.config.max_distance, number_of_features)
+        positions = np.column_stack(geometry.spherical_to_cartesian(slant_distances, horizontal_angles, vertical_angles))
+        covariances = geometry.get_covariances_of_cartesian_coordinates(slant_distances, horizontal_angles, vertical_angles, self.measurement_variances, self.covariance_dtype)
+        return positions, covariances
+
+    def get_covariances_of_points(self, positions):
+        return geometry.get_covariances_of_points(positions, self.measurement_variances, self.covariance_dtype)
+
+    def get_geometric_visibility(self, positions, reference_pose_id:int, query_pose_ids:list[int]):
+        #returns list with sorted indices of features (N x 3 positions in the reference frame) which lie within the range shell and the vertical
+        #angle limits of every query pose, candidates are found with range queries of a KD-tree of the features of the reference pose
+        #(not of all features in the world frame, so chunks of reference poses stay independent for streaming, workers and --memory-budget-mb)
+        visible_features = [np.zeros(0, dtype = np.int64) for _ in query_pose_ids]
+        if len(positions) == 0:
+            return visible_features
+        import scipy.spatial #imported only in the geometric mode, it is slow to import
+        features_index = scipy.spatial.cKDTree(positions)
+        for k, query_pose_id in enumerate(query_pose_ids):
+            transformation = self.relative_transformations[(query_pose_id, reference_pose_id)]
+            query_pose_position = -np.transpose(transformation[0:3,0:3])@transformation[0:3,3] #in the reference frame
+            candidates = np.array(features_index.query_ball_point(query_pose_position, self.config.max_distance, return_sorted = True), dtype = np.int64)
+            if len(candidates) == 0:
+                continue
+            positions_in_query = geometry.transform_points(transformation, positions[candidates])
+            slant_distances = np.linalg.norm(positions_in_query, axis = 1)
+            vertical_angles_deg = np.degrees(np.arccos(np.clip(positions_in_query[:,2]/slant_distances, -1.0, 1.0)))
+            is_visible = ((slant_distances >= self.config.min_distance) & (slant_distances <= self.config.max_distance) &
+                          (vertical_angles_deg >= self.config.min_vertical_angle_deg) & (vertical_angles_deg <= self.config.max_vertical_angle_deg))
+            visible_features[k] = candidates[is_visible]
+        return visible_features
+
+    def match_features(self, rng:np.random.Generator, number_of_features:int, query_pose_ids:list[int], statistics:collections.Counter = None, geometric_visibility = None):
+        #returns N x K boolean array, element [i,k] tells if feature i is visible from k-th query pose
+        #if geometric visibility is given (see get_geometric_visibility), the matching trials are drawn only for the geometrically visible features,
+        #so the work per query pose is bounded by the range query instead of the number of features
+        #if statistics are given, the numbers of accepted and rejected matches are added to them
+        #visibility is kept as W x N bitsets (word w of all features is a contiguous row, bit k%64 of word k//64 is set if the feature
+        #is visible from k-th query pose) while matching, see geometry.get_conflict_bitmasks
+        conflict_bitmasks = geometry.get_conflict_bitmasks(query_pose_ids, self.dict_of_poses_visibility)
+        visibility_bits = np.zeros((conflict_bitmasks.shape[1], number_of_features), dtype = conflict_bitmasks.dtype)
+        words_with_conflicts = [np.flatnonzero(bitmask).tolist() for bitmask in conflict_bitmasks] if conflict_bitmasks.shape[1] > 1 else \
+                               [[0] if has_conflicts else [] for has_conflicts in (conflict_bitmasks[:,0] != 0).tolist()]
+        for k in range(len(query_pose_ids)):
+            #Features can not be co-visible if poses are not co-visible
+            if geometric_visibility is None:
+                number_of_visible_features = number_of_features
+                is_matched = rng.uniform(0.0, 1.0, number_of_features) <= self.config.matching_probability
+                is_accepted = is_matched.copy()
+                for w in words_with_conflicts[k]:
+                    is_accepted &= (visibility_bits[w] & conflict_bitmasks[k,w]) == 0
+                visibility_bits[k//64] |= is_accepted.astype(visibility_bits.dtype) << np.uint64(k%64)
+                number_of_matches = int(np.count_nonzero(is_matched))
+                number_of_accepted_matches = int(np.count_nonzero(is_accepted))
+            else:
+                #indices of the features instead of masks, the geometrically visible features are usually a small part of all features
+                visible_features = geometric_visibility[k]
+                number_of_visible_features = len(visible_features)
+                accepted_features = visible_features[rng.uniform(0.0, 1.0, number_of_visible_features) <= self.config.matching_probability]
+                number_of_matches = len(accepted_features)
+                for w in words_with_conflicts[k]:
+                    accepted_features = accepted_features[(visibility_bits[w, accepted_features] & conflict_bitmasks[k,w]) == 0]
+                visibility_bits[k//64, accepted_features] |= visibility_bits.dtype.type(1 << (k%64))
+                number_of_accepted_matches = len(accepted_features)
+            if statistics is not None:
+                if geometric_visibility is not None:
+                    statistics['matches_rejected_by_geometry'] += number_of_features - number_of_visible_features
+                statistics['matches_rejected_by_matching_probability'] += number_of_visible_features - number_of_matches
+                statistics['matches_rejected_by_visibility_conflict'] += number_of_matches - number_of_accepted_matches
+                statistics['matches_accepted'] += number_of_accepted_matches
+        return np.unpackbits(np.ascontiguousarray(visibility_bits.T).view(np.uint8), axis = 1, count = len(query_pose_ids), bitorder = 'little').view(bool)
+
     def generate_features(self, poses:dict[int,geometry.Pose]):
-        random.seed()
+        if self.config.feature_generation_engine == 'batch':
+            self.generate_features_batch(poses)
+        else:
+            self.relative_transformations = geometry.get_table_of_relative_transformations(poses, self.dict_of_poses_visibility)
+            self.generate_features_legacy(poses)
+
+    def simulate_reference_pose(self, features_rng:np.random.Generator, matching_rng:np.random.Generator, pose_index:int, pose_ids:list[int]):
+        #simulates features of one reference pose with the same feature ids and matching rules as generate_features_legacy,
+        #returns columns with all observations of the matched features, rows are grouped by observing pose:
+        #pose_id, feature_id, number_of_measurements, position (N x 3) and covariance (N x 3 x 3)
+        reference_pose_id = pose_ids[pose_index]
+        number_of_features = self.config.number_of_features_per_cloud
+        feature_ids = pose_index + 1 + len(pose_ids)*np.arange(number_of_features, dtype = np.int64)
+        positions, covariances = self.generate_random_features(features_rng, number_of_features)
+        query_pose_ids = list(self.dict_of_poses_visibility[reference_pose_id])
+        statistics = collections.Counter()
+        geometric_visibility = None
+        if self.config.visibility_mode == 'geometric':
+            geometric_visibility = self.get_geometric_visibility(positions, reference_pose_id, query_pose_ids)
+        visibility = self.match_features(matching_rng, number_of_features, query_pose_ids, statistics, geometric_visibility)
+        is_matched = visibility.any(axis = 1) #features that were not matched are skipped
+        number_of_measurements = 1 + np.count_nonzero(visibility, axis = 1).astype(np.int32)
+
+        observations = [(reference_pose_id, is_matched, positions[is_matched], covariances[is_matched])]
+        for k, query_pose_id in enumerate(query_pose_ids):
+            is_visible = visibility[:,k]
+            positions_in_query = geometry.transform_points(self.relative_transformations[(query_pose_id, reference_pose_id)], positions[is_visible])
+            covariances_in_query = self.get_covariances_of_points(positions_in_query)
+            observations.append((query_pose_id, is_visible, positions_in_query, covariances_in_query))
+
+        columns = {}
+        columns['pose_id'] = np.concatenate([np.full(len(block_positions), pose_id, dtype = np.int64) for (pose_id, _, block_positions, _) in observations])
+        columns['feature_id'] = np.concatenate([feature_ids[mask] for (_, mask, _, _) in observations])
+        columns['number_of_measurements'] = np.concatenate([number_of_measurements[mask] for (_, mask, _, _) in observations])
+        columns['position'] = np.concatenate([block_positions for (_, _, block_positions, _) in observations])
+        columns['covariance'] = np.concatenate([block_covariances for (_, _, _, block_covariances) in observations])
+        statistics['features_generated'] += number_of_features
+        statistics['features_not_matched'] += number_of_features - int(np.count_nonzero(is_matched))
+        statistics['observations'] += len(columns['feature_id'])
+        columns['statistics'] = statistics #merged into Simulator.statistics by generate_feature_chunks
+        return columns
+
+    def simulate_reference_pose_with_noise(self, pose_index:int, pose_ids:list[int], add_noise:bool = True):
+        #every reference pose uses its own random streams, so the result does not depend on the order or on the process it is simulated in
+        reference_pose_id = pose_ids[pose_index]
+        features_rng = utils.create_random_generator(self.seed, 'features', reference_pose_id)
+        matching_rng = utils.create_random_generator(self.seed, 'matching', reference_pose_id)
+        columns = self.simulate_reference_pose(features_rng, matching_rng, pose_index, pose_ids)
+        if add_noise:
+            self.add_noise_to_columns(utils.create_random_generator(self.seed, 'point_noise', reference_pose_id), columns)
+        return columns
+
+    def get_chunk_signature(self, poses:dict[int,geometry.Pose], reference_pose_id:int):
+        #sha256 of everything the observations of one reference pose depend on: seed, config, the pose and its query poses (in the order of
+        #matching) and the edges between query poses (visibility conflicts), feature ids are not included, see get_feature_id_blocks
+        import hashlib, json #imported only for incremental simulation
+        hasher = hashlib.sha256()
+        fields = {name: getattr(self.config, name) for name in simulation_config_fields}
+        hasher.update(json.dumps({'seed': int(self.seed), 'reference_pose_id': int(reference_pose_id), 'config': fields}, sort_keys = True).encode())
+        query_pose_ids = list(self.dict_of_poses_visibility[reference_pose_id])
+        observing_pose_ids = [reference_pose_id] + query_pose_ids
+        hasher.update(np.array(observing_pose_ids, dtype = np.int64).tobytes())
+        hasher.update(np.array([poses[pose_id].position for pose_id in observing_pose_ids], dtype = np.float64).tobytes())
+        hasher.update(np.array([poses[pose_id].rotation_matrix() for pose_id in observing_pose_ids], dtype = np.float64).tobytes())
+        conflicts = [query_pose_ids[j] in self.dict_of_poses_visibility[query_pose_ids[k]] for k in range(len(query_pose_ids)) for j in range(k)]
+        hasher.update(np.packbits(np.array(conflicts, dtype = bool)).tobytes())
+        return hasher.hexdigest()
+
+    def get_feature_id_blocks(self, pose_ids:list[int], is_reused:list[bool], previous_state = None):
+        #feature ids of the chunk of every pose index are first + step*k for the k-th feature of its reference pose, (first, step) is
+        #(pose_index + 1, number of poses) by default, like in generate_features_legacy, reused chunks keep the ids stored in the state,
+        #if some of them do not follow the default (poses were added, removed or reordered), simulated chunks get new blocks above all reused ids,
+        #so adding a pose does not renumber features of unchanged reference poses
+        number_of_poses = len(pose_ids)
+        blocks = [(pose_index + 1, number_of_poses) for pose_index in range(number_of_poses)]
+        reused_blocks = {pose_index: previous_state.get_feature_id_block(pose_ids[pose_index]) for pose_index in range(number_of_poses) if is_reused[pose_index]}
+        if all(block == blocks[pose_index] for (pose_index, block) in reused_blocks.items()):
+            return blocks
+        number_of_features = self.config.number_of_features_per_cloud
+        next_feature_id = 1 + max(first + step*(number_of_features - 1) for (first, step) in reused_blocks.values())
+        for pose_index in range(number_of_poses):
+            if pose_index in reused_blocks:
+                blocks[pose_index] = reused_blocks[pose_index]
+            else:
+                blocks[pose_index] = (next_feature_id, 1)
+                next_feature_id += number_of_features
+        return blocks
+
+    def generate_feature_chunks(self, poses:dict[int,geometry.Pose], add_noise:bool = True, pose_indices:list[int] = None):
+        #yields observations of one reference pose at a time, in the order of poses (or of pose_indices), statistics of the chunks are summed up in the simulator,
+        #with previous_state only reference poses with changed signatures are simulated, the other chunks are read from the state,
+        #states hold observations with noise, so they are neither read nor written without it
+        self.statistics = collections.Counter()
+        pose_ids = list(poses.keys())
+        previous_state = self.previous_state if add_noise else None
+        state_writer = self.state_writer if add_noise else None
+        signatures = None
+        if previous_state is not None or state_writer is not None:
+            signatures = [self.get_chunk_signature(poses, pose_id) for pose_id in pose_ids]
+        is_reused = [False]*len(pose_ids)
+        if previous_state is not None:
+            is_reused = [previous_state.get_signature(pose_id) == signature for (pose_id, signature) in zip(pose_ids, signatures)]
+        feature_id_blocks = self.get_feature_id_blocks(pose_ids, is_reused, previous_state)
+        if pose_indices is None:
+            pose_indices = range(len(pose_ids))
+        simulated_chunks = self.simulate_feature_chunks(poses, add_noise, [pose_index for pose_index in pose_indices if not is_reused[pose_index]])
+        for pose_index in pose_indices:
+            if is_reused[pose_index]:
+                columns = previous_state.get_chunk(pose_ids[pose_index])
+            else:
+                columns = next(simulated_chunks)
+                (first, step) = feature_id_blocks[pose_index]
+                if (first, step) != (pose_index + 1, len(pose_ids)): #simulated with the default block
+                    columns['feature_id'] = first + step*((columns['feature_id'] - pose_index - 1)//len(pose_ids))
+            self.statistics.update(columns['statistics'])
+            if state_writer is not None:
+                state_writer.write(pose_ids[pose_index], signatures[pose_index], feature_id_blocks[pose_index], columns)
+            yield columns
+        self.statistics['reference_poses_reused'] += sum(is_reused)
+        self.statistics['reference_poses_simulated'] += len(pose_ids) - sum(is_reused)
+
+    def simulate_feature_chunks(self, poses:dict[int,geometry.Pose], add_noise:bool = True, pose_indices:list[int] = None):
+        #simulates the reference poses of pose_indices (all by default) in the given order,
+        #with more than one worker the reference poses are simulated by a process pool, at most a few chunks ahead of the consumer
+        pose_ids = list(poses.keys())
+        if pose_indices is None:
+            pose_indices = range(len(pose_ids))
+        visibility_of_simulated_poses = {pose_ids[pose_index]: self.dict_of_poses_visibility[pose_ids[pose_index]] for pose_index in pose_indices}
+        self.relative_transformations = geometry.get_table_of_relative_transformations(poses, visibility_of_simulated_poses)
+        number_of_workers = min(self.config.number_of_workers, len(pose_indices))
+        if number_of_workers <= 1:
+            for pose_index in pose_indices:
+                yield self.simulate_reference_pose_with_noise(pose_index, pose_ids, add_noise)
+            return
+        import concurrent.futures #imported only for parallel simulation
+        with concurrent.futures.ProcessPoolExecutor(number_of_workers, initializer = initialize_worker, initargs = (self, pose_ids, add_noise)) as executor:
+            pending_chunks = collections.deque()
+            for pose_index in pose_indices:
+                pending_chunks.append(executor.submit(simulate_reference_pose_in_worker, pose_index))
+                if len(pending_chunks) >= 2*number_of_workers:
+                    yield pending_chunks.popleft().result()
+            while pending_chunks:
+                yield pending_chunks.popleft().result()
+
+    def run_simulations_streaming(self, poses:dict[int,geometry.Pose], graph:geometry.SimpleVisibilityGraph):
+        #streaming version of the batch engine, the memory used does not depend on the size of the network
+        self.dict_of_poses_visibility = self.create_dict_of_poses_visibility(graph)
+        self.feature_store = FeatureStore.FeatureStore.empty(list(poses.keys()))
+        return self.generate_feature_chunks(poses)
+
+    def generate_features_batch(self, poses:dict[int,geometry.Pose], add_noise:bool = False):
+        self.feature_store.close()
+        self.feature_store = FeatureStore.FeatureStore.empty(list(poses.keys()))
+        if self.config.memory_budget_mb > 0.0:
+            self.generate_features_out_of_core(poses, add_noise)
+            return
+        list_of_columns = list(self.generate_feature_chunks(poses, add_noise))
+        self.feature_store = FeatureStore.FeatureStore.from_columns(list(poses.keys()), list_of_columns)
+
+    def generate_features_out_of_core(self, poses:dict[int,geometry.Pose], add_noise:bool = False):
+        #observations above the memory budget are spilled to scratch files (see FeatureStore.SpilledFeatureStore), reference poses are simulated
+        #in breadth first order of the visibility graph, so every spilled run holds a coherent block of poses and their neighbours,
+        #feature ids and random streams depend only on the order of poses, so the result is the same as in memory
+        pose_ids = list(poses.keys())
+        pose_indices = {pose_id: pose_index for (pose_index, pose_id) in enumerate(pose_ids)}
+        order = [pose_indices[pose_id] for pose_id in geometry.get_breadth_first_order(self.dict_of_poses_visibility, pose_ids)]
+        store = FeatureStore.SpilledFeatureStore(pose_ids, int(self.config.memory_budget_mb*2**20), self.config.scratch_directory)
+        try:
+            for columns in self.generate_feature_chunks(poses, add_noise, order):
+                store.append(columns)
+            store.finish()
+        except BaseException:
+            store.close()
+            raise
+        self.feature_store = store
+        self.statistics['spilled_runs'] = store.number_of_runs
+
+    def generate_features_legacy(self, poses:dict[int,geometry.Pose]):
+        features_rng = utils.create_random_generator(self.seed, 'features')
+        matching_rng = utils.create_random_generator(self.seed, 'matching')
         number_of_poses = len(poses)
         pose_ids = list(poses.keys())
         total_number_of_features = self.config.number_of_features_per_cloud * number_of_poses      
         pose_id_generator = self.repeat_range(number_of_poses)
+        self.statistics = collections.Counter()
+        self.statistics['features_generated'] = total_number_of_features
         
         #populating dictionary of features with empty lists:
-        self.dict_of_features = {} #clearing
+        dict_of_features = {}
         for pose_id in pose_ids:
-            self.dict_of_features[pose_id] = []
+            dict_of_features[pose_id] = []
 
+        #visibility of a feature is a bitset of indices of query poses of its reference pose, see geometry.get_conflict_bitmasks
+        query_pose_ids_of_poses = {pose_id: list(self.dict_of_poses_visibility[pose_id]) for pose_id in pose_ids}
+        conflict_bitmasks_of_poses = {}
         for feature_id in range(1,total_number_of_features+1):
             pose_index = next(pose_id_generator)
             reference_pose_id = pose_ids[pose_index] #id of current pose
             reference_pose = poses[reference_pose_id]
-            feature_visible_from_reference_pose = self.generate_random_feature(feature_id)
-            set_of_poses_feature_is_visible_from = set()
-            set_of_poses_feature_is_visible_from.add(reference_pose_id)
-            self.dict_of_features[reference_pose_id].append(feature_visible_from_reference_pose)
-            ids_of_visible_poses = self.dict_of_poses_visibility[reference_pose_id]
-            for query_pose_id in ids_of_visible_poses:
-                rnd = random.uniform(0.0,1.0) 
+            feature_visible_from_reference_pose = self.generate_random_feature(features_rng, feature_id)
+            dict_of_features[reference_pose_id].append(feature_visible_from_reference_pose)
+            query_pose_ids = query_pose_ids_of_poses[reference_pose_id]
+            if not reference_pose_id in conflict_bitmasks_of_poses:
+                conflict_bitmasks_of_poses[reference_pose_id] = [int.from_bytes(bitmask.tobytes(), 'little') for bitmask in geometry.get_conflict_bitmasks(query_pose_ids, self.dict_of_poses_visibility)]
+            conflict_bitmasks = conflict_bitmasks_of_poses[reference_pose_id]
+            visibility_bits = 0
+            for k, query_pose_id in enumerate(query_pose_ids):
+                rnd = matching_rng.uniform(0.0,1.0) 
                 if rnd > self.config.matching_probability:
+                    self.statistics['matches_rejected_by_matching_probability'] += 1
                     continue #sorry, this feature is not visible, skipp
-                visibility_conflict = False #Features can not be co-visible if poses are not co-visible
-                for id in set_of_poses_feature_is_visible_from:
-                    if not (id in self.dict_of_poses_visibility[query_pose_id]):
-                        visibility_conflict = True
-                if visibility_conflict:
+                if visibility_bits & conflict_bitmasks[k]: #Features can not be co-visible if poses are not co-visible
+                    self.statistics['matches_rejected_by_visibility_conflict'] += 1
                     continue
+                self.statistics['matches_accepted'] += 1
                 query_pose = poses[query_pose_id]
-                point_in_query = (query_pose.T_inv()@reference_pose.T())@feature_visible_from_reference_pose.as_homogenous_vector()
-                #compute the polar coordinates and afterwards comput anisotropic noise covariance matrix:
-                (d, alpha, beta) = geometry.cartesian_to_spherical(point_in_query[0,0], point_in_query[1,0], point_in_query[2,0] )
-                jacobian = geometry.get_jacobian_of_mapping_to_cartesian_coordinates(d, alpha, beta)
-                position_covariance = jacobian@self.measurement_covariance@np.transpose(jacobian)
+                point_in_query = self.relative_transformations[(query_pose_id, reference_pose_id)]@feature_visible_from_reference_pose.as_homogenous_vector()
+                #compute anisotropic noise covariance matrix:
+                position_covariance = self.get_covariances_of_points(point_in_query[0:3,:].reshape((1,3)))[0]
                 feature_visible_from_query_pose = geometry.FeatureIn3d(id = feature_id, position = point_in_query[0:3,:], uncertainty = self.config.gaussian_noise_point_position, covariance=position_covariance) 
                 feature_in_world_q = query_pose.T()@feature_visible_from_query_pose.as_homogenous_vector()
                 feature_in_world_r = reference_pose.T()@feature_visible_from_reference_pose.as_homogenous_vector()
                 assert np.allclose(feature_in_world_q, feature_in_world_r, rtol=1e-05, atol=1e-08, equal_nan=False), "check for world coordinate consistency failed!" 
-                set_of_poses_feature_is_visible_from.add(query_pose_id)
-                self.dict_of_features[query_pose_id].append(feature_visible_from_query_pose)
-            for pose_id in set_of_poses_feature_is_visible_from:
-                self.dict_of_features[pose_id][-1].visibility = set_of_poses_feature_is_visible_from
-            if len(set_of_poses_feature_is_visible_from) == 1: #this feature was not matched, removing it
-                self.dict_of_features[reference_pose_id].pop()
+                visibility_bits |= 1 << k
+                dict_of_features[query_pose_id].append(feature_visible_from_query_pose)
+            if visibility_bits == 0: #this feature was not matched, removing it
+                dict_of_features[reference_pose_id].pop()
+                self.statistics['features_not_matched'] += 1
+        self.feature_store = FeatureStore.FeatureStore.from_dict_of_features(dict_of_features)
+        self.statistics['observations'] = len(self.feature_store)
                     
     def create_dict_of_poses_visibility(self, graph:geometry.SimpleVisibilityGraph):
-        dict_of_poses_visibility = {}
-        for node in graph.nodes:
-           visible_nodes = set()
-           for edge in graph.edges:
-               if node == edge.from_id:
-                   visible_nodes.add(edge.to_id)
-               if node == edge.to_id:
-                   visible_nodes.add(edge.from_id)
-           dict_of_poses_visibility[node] = visible_nodes
-        return dict_of_poses_visibility
+        #the graph keeps its adjacency up to date, so it is used directly (and must not be modified by the simulator)
+        return graph.adjacency
 
     def add_noise_to_feature_coordinates(self):
+        if self.config.use_anisotropic_noise: #using anisotropic full covariance 3D noise
+            print("Adding anisotropic noise using 3D covariance matrix!")
+        rng = utils.create_random_generator(self.seed, 'point_noise')
+        self.feature_store.update_positions(lambda columns: self.add_noise_to_columns(rng, columns))
+
+    def add_noise_to_columns(self, rng:np.random.Generator, columns:dict[str,np.ndarray]):
+        #adds noise to positions of observations stored in columns, positions are modified in place
         if not self.config.use_anisotropic_noise and self.config.gaussian_noise_point_position == 0.0:
             return
+        positions = columns['position']
         if not self.config.use_anisotropic_noise:
-            random.seed()
-            for (_, features) in self.dict_of_features.items():
-                for feature in features:
-                    feature.position[0,0] += utils.gaussian_noise_with_limit(self.config.gaussian_noise_point_position)
-                    feature.position[1,0] += utils.gaussian_noise_with_limit(self.config.gaussian_noise_point_position)
-                    feature.position[2,0] += utils.gaussian_noise_with_limit(self.config.gaussian_noise_point_position)
-        else: #using anisotropic full covariance 3D noise
-            print("Adding anisotropic noise using 3D covariance matrix!")
-            random.seed()
-            for (_, features) in self.dict_of_features.items():
-                for feature in features:
-                    noise = np.random.multivariate_normal(np.array([0,0,0]), feature.covariance)
-                    feature.position[0,0] += noise[0]
-                    feature.position[1,0] += noise[1]
-                    feature.position[2,0] += noise[2]
-
-
-
+            positions += utils.gaussian_noise_with_limit_batch(self.config.gaussian_noise_point_position, positions.shape, rng)
+        else:
+            positions += utils.multivariate_gaussian_noise_with_limit(columns['covariance'], rng)
@@ -0,0 +1,301 @@
+import sys
+import os
+import getopt
+import json
+import time
+import tracemalloc
+import tempfile
+import platform
+import itertools
+import subprocess
+import numpy as np
+import scipy
+
+import SimulationConfig
+import Simulator
+import geometry
+import utils
+import input_output as io
+
+#stages of a simulation run, in the order they are executed, every stage is timed separately
+stages = ('load', 'graph_validation', 'generate_features', 'noise', 'save_features', 'save_all_feature_data', 'save_network_to_dxf', 'save_poses')
+
+def create_synthetic_network(number_of_poses:int, average_degree:float, seed:int):
+    #poses along a random walk with steps of about 3 m, the first pose is fixed,
+    #the graph is a chain (so it is connected) with random edges between poses that are at most 2*average_degree steps apart
+    rng = utils.create_random_generator(seed, 'network')
+    steps = rng.normal(0.0, 1.0, (number_of_poses, 3))*np.array([3.0, 3.0, 0.1])
+    positions = np.cumsum(steps, axis = 0).reshape((-1,3,1))
+    rotation_matrices = geometry.euler_zyx_to_matrices(np.column_stack((rng.uniform(0.0, 360.0, number_of_poses), rng.normal(0.0, 1.0, (number_of_poses, 2)))), True)
+    types = ['fixed'] + ['free']*(number_of_poses - 1)
+    poses = dict(zip(range(1, number_of_poses + 1), geometry.create_poses(positions, rotation_matrices, types)))
+
+    edges = {(pose_id, pose_id + 1) for pose_id in range(1, number_of_poses)}
+    window = max(2, int(2*average_degree))
+    number_of_edges = min(int(round(average_degree*number_of_poses/2)), number_of_poses*(number_of_poses - 1)//2)
+    while len(edges) < number_of_edges:
+        from_ids = rng.integers(1, number_of_poses + 1, number_of_edges)
+        to_ids = from_ids + rng.integers(1, window + 1, number_of_edges)
+        for (from_id, to_id) in zip(from_ids.tolist(), to_ids.tolist()):
+            if to_id <= number_of_poses and len(edges) < number_of_edges:
+                edges.add((from_id, to_id))
+        window = min(2*window, number_of_poses) #dense graphs of few poses need longer edges
+    edges = np.array(sorted(edges), dtype = np.int64).reshape((-1,2))
+    graph = geometry.SimpleVisibilityGraph.from_edge_arrays(edges[:,0], edges[:,1])
+    return poses, graph
+
+def measure_stage(measurements:dict, stage:str, function, *args):
+    #measures time of the stage or, when tracemalloc is tracing, peak of memory allocated by the stage (memory of worker processes is not included)
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+        memory_at_start = tracemalloc.get_traced_memory()[0]
+        result = function(*args)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        measurements[stage] = {'peak_memory_bytes': peak_memory - memory_at_start, 'peak_traced_memory_bytes': peak_memory}
+        return result
+    start = time.perf_counter()
+    result = function(*args)
+    measurements[stage] = {'time_s': time.perf_counter() - start}
+    return result
+
+def load_inputs(path_file_config_xml:str, path_file_poses:str, path_file_graph:str):
+    config = SimulationConfig.Config()
+    config.read_from_xml(path_file_config_xml)
+    return config, io.read_poses(path_file_poses), io.read_graph(path_file_graph)
+
+def validate_graph(poses:dict[int,geometry.Pose], graph:geometry.SimpleVisibilityGraph):
+    assert set(poses.keys()) == graph.nodes, 'Error! ids of poses must match nodes in visibility graph!'
+    assert len(graph.get_connected_components()) == 1, 'Error! Visibility graph is not connected.'
+
+def generate_features(simulator:Simulator.Simulator, poses:dict[int,geometry.Pose], graph:geometry.SimpleVisibilityGraph):
+    #the same as Simulator.run_simulations, but without noise, so the noise is timed separately
+    simulator.dict_of_poses_visibility = simulator.create_dict_of_poses_visibility(graph)
+    simulator.generate_features(poses)
+
+def run_case(directory:str, config:SimulationConfig.Config, number_of_poses:int, average_degree:float, seed:int, trace_memory:bool = False):
+    #simulates a synthetic network and writes all outputs to directory, returns measurements of all stages,
+    #times or peaks of memory, because tracing of memory allocations slows down the stages
+    poses, graph = create_synthetic_network(number_of_poses, average_degree, seed)
+    path_file_config_xml = os.path.join(directory, 'config.xml')
+    path_file_poses = os.path.join(directory, 'poses.txt')
+    path_file_graph = os.path.join(directory, 'graph_edges.txt')
+    config.write_to_xml(path_file_config_xml)
+    io.save_poses_text(path_file_poses, poses)
+    io.save_graph_text(path_file_graph, graph)
+
+    measurements = {}
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        config, poses, graph = measure_stage(measurements, 'load', load_inputs, path_file_config_xml, path_file_poses, path_file_graph)
+        measure_stage(measurements, 'graph_validation', validate_graph, poses, graph)
+        simulator = Simulator.Simulator(config, seed)
+        measure_stage(measurements, 'generate_features', generate_features, simulator, poses, graph)
+        measure_stage(measurements, 'noise', simulator.add_noise_to_feature_coordinates)
+        measure_stage(measurements, 'save_features', io.save_features, directory, simulator, config.output_format)
+        measure_stage(measurements, 'save_all_feature_data', io.save_all_feature_data, directory, simulator, poses, config.output_format)
+        measure_stage(measurements, 'save_network_to_dxf', io.save_network_to_dxf, directory, simulator, poses)
+        measure_stage(measurements, 'save_poses', io.save_poses, directory, poses, (config.pose_noise_position, config.pose_noise_rotation_deg), simulator.seed)
+        peak_memory = max(measurement['peak_traced_memory_bytes'] for measurement in measurements.values()) if trace_memory else None
+    finally:
+        tracemalloc.stop()
+    result = {'number_of_edges': len(graph.edges), 'number_of_observations': len(simulator.feature_store),
+              'number_of_features': len(simulator.feature_store.unique_feature_ids), 'peak_memory_bytes': peak_memory, 'stages': measurements}
+    simulator.feature_store.close() #removes scratch files of out-of-core simulation
+    return result
+
+def summarize_repeats(repeats:list[dict], memory:dict = None):
+    #time of a stage is the best of the repeats (the least disturbed by other processes), memory comes from a separate traced run
+    summary = {key: repeats[0][key] for key in ('number_of_edges', 'number_of_observations', 'number_of_features')}
+    summary['peak_memory_bytes'] = memory['peak_memory_bytes'] if memory is not None else None
+    summary['stages'] = {}
+    for stage in stages:
+        times = [repeat['stages'][stage]['time_s'] for repeat in repeats]
+        summary['stages'][stage] = {'time_s': min(times), 'median_time_s': float(np.median(times)),
+                                    'peak_memory_bytes': memory['stages'][stage]['peak_memory_bytes'] if memory is not None else None}
+    summary['total_time_s'] = sum(summary['stages'][stage]['time_s'] for stage in stages)
+    simulation_time = summary['stages']['generate_features']['time_s'] + summary['stages']['noise']['time_s']
+    summary['simulation_throughput_observations_per_s'] = summary['number_of_observations']/simulation_time if simulation_time > 0.0 else None
+    summary['total_throughput_observations_per_s'] = summary['number_of_observations']/summary['total_time_s']
+    return summary
+
+def get_scaling_exponents(cases:list[dict]):
+    #slope of log(time) over log(number of observations) for every stage, 1.0 means linear scaling
+    observations = np.array([case['number_of_observations'] for case in cases], dtype = np.float64)
+    if len(np.unique(observations[observations > 0])) < 2:
+        return {}
+    exponents = {}
+    for stage in stages + ('total',):
+        times = np.array([case['total_time_s'] if stage == 'total' else case['stages'][stage]['time_s'] for case in cases])
+        valid = (observations > 0) & (times > 0.0)
+        if len(np.unique(observations[valid])) >= 2:
+            exponents[stage] = float(np.polyfit(np.log(observations[valid]), np.log(times[valid]), 1)[0])
+    return exponents
+
+def run_benchmark(config:SimulationConfig.Config, list_of_number_of_poses:list[int], list_of_number_of_features:list[int],
+                  list_of_matching_probability:list[float], average_degree:float, repeats:int, seed:int, trace_memory:bool = True):
+    cases = []
+    for (number_of_poses, number_of_features, matching_probability) in itertools.product(list_of_number_of_poses, list_of_number_of_features, list_of_matching_probability):
+        config.number_of_features_per_cloud = number_of_features
+        config.matching_probability = matching_probability
+        print(f'Benchmarking {number_of_poses} poses, {number_of_features} features per cloud, matching probability {matching_probability}.')
+        results_of_repeats = []
+        memory = None
+        for repeat in range(repeats + trace_memory):
+            with tempfile.TemporaryDirectory() as directory:
+                if repeat < repeats:
+                    results_of_repeats.append(run_case(directory, config, number_of_poses, average_degree, seed))
+                else:
+                    memory = run_case(directory, config, number_of_poses, average_degree, seed, True)
+        case = {'number_of_poses': number_of_poses, 'number_of_features_per_cloud': number_of_features, 'matching_probability': matching_probability}
+        case.update(summarize_repeats(results_of_repeats, memory))
+        cases.append(case)
+    return {'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+                            'platform': platform.platform(), 'number_of_cpus': os.cpu_count()},
+            'settings': {'feature_generation_engine': config.feature_generation_engine, 'output_format': config.output_format,
+                         'number_of_workers': config.number_of_workers, 'average_degree': average_degree, 'repeats': repeats, 'seed': seed,
+                         'trace_memory': trace_memory},
+            'cases': cases, 'scaling_exponents': get_scaling_exponents(cases)}
+
+def get_import_times(importtime_output:str):
+    #cumulative import time of every top-level module (imported directly by the script) from the output of python -X importtime
+    import_times = {}
+    for line in importtime_output.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[0].startswith('import time:') and fields[1].strip().isdigit() and not fields[2].startswith('  '):
+            import_times[fields[2].strip()] = int(fields[1])*1e-6
+    return import_times
+
+def measure_startup(config:SimulationConfig.Config, repeats:int, network:str = 'corridor:10'):
+    #wall time of fresh interpreters: the interpreter alone, import of NumPy (needed by every run), import of the simulator
+    #and a small run of the simulator (generated network, all outputs), the best and the median of the repeats,
+    #and import times of modules of the small run, which show if slow optional dependencies (e.g. scipy) are imported
+    script_directory = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as directory:
+        path_file_config_xml = os.path.join(directory, 'config.xml')
+        config.write_to_xml(path_file_config_xml)
+        small_run = [os.path.join(script_directory, 'point_cloud_optimization_simulator.py'), '-c', path_file_config_xml, '-o', directory,
+                     '--network', network, '--seed', str(config.seed)]
+        commands = {'interpreter': ['-c', 'pass'], 'import_numpy': ['-c', 'import numpy'],
+                    'import_simulator': ['-c', 'import point_cloud_optimization_simulator'], 'small_run': small_run}
+        results = {}
+        for (name, arguments) in commands.items():
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                subprocess.run([sys.executable] + arguments, cwd = script_directory, capture_output = True, check = True)
+                times.append(time.perf_counter() - start)
+            results[name] = {'time_s': min(times), 'median_time_s': float(np.median(times))}
+        importtime_output = subprocess.run([sys.executable, '-X', 'importtime'] + small_run, cwd = script_directory, capture_output = True, text = True, check = True).stderr
+    import_times = get_import_times(importtime_output)
+    return {'network': network, 'repeats': repeats, 'commands': results, 'import_times_s': import_times,
+            'scipy_imported_by_small_run': any(line.split('|')[-1].strip().startswith('scipy') for line in importtime_output.splitlines())}
+
+def parse_list(text:str, type):
+    return [type(value) for value in text.split(',') if value.strip() != '']
+
+def main():
+    path_file_output = 'benchmark_results.json'
+    path_file_config_xml = ''
+    list_of_number_of_poses = [10, 100, 1000]
+    list_of_number_of_features = [200]
+    list_of_matching_probability = [0.2]
+    average_degree = 4.0
+    repeats = 1
+    seed = 0
+    feature_generation_engine = ''
+    output_format = ''
+    number_of_workers = 0
+    trace_memory = True
+    startup = False
+    try:
+      opts, args = getopt.getopt(sys.argv[1:],'o:c:n:m:d:r:e:f:w:',['output=', 'config=', 'poses=', 'features=', 'matching=', 'degree=', 'repeats=', 'engine=', 'output-format=', 'workers=', 'seed=', 'no-memory', 'startup'])
+      for opt, arg in opts:
+        if opt in ('-o', '--output'):
+           path_file_output = arg
+        elif opt in ('-c', '--config'):
+           path_file_config_xml = arg
+        elif opt == '--poses':
+           list_of_number_of_poses = parse_list(arg, int)
+        elif opt in ('-n', '--features'):
+           list_of_number_of_features = parse_list(arg, int)
+        elif opt in ('-m', '--matching'):
+           list_of_matching_probability = parse_list(arg, float)
+        elif opt in ('-d', '--degree'):
+           average_degree = float(arg)
+        elif opt in ('-r', '--repeats'):
+           repeats = int(arg)
+        elif opt in ('-e', '--engine'):
+           feature_generation_engine = arg
+        elif opt in ('-f', '--output-format'):
+           output_format = arg
+        elif opt in ('-w', '--workers'):
+           number_of_workers = int(arg)
+        elif opt == '--seed':
+           seed = int(arg)
+        elif opt == '--no-memory':
+           trace_memory = False
+        elif opt == '--startup':
+           startup = True
+    except (getopt.GetoptError, ValueError):
+      print ('error while parsing command line arguments')
+      print ('all arguments are optional:')
+      print ('-o, --output : path to json file with results (default benchmark_results.json)')
+      print ('-c, --config : path to xml config file with the remaining settings of the simulation')
+      print ('--poses : comma separated numbers of poses of synthetic networks (default 10,100,1000)')
+      print ('-n, --features : comma separated numbers of features per cloud (default 200)')
+      print ('-m, --matching : comma separated matching probabilities (default 0.2)')
+      print ('-d, --degree : average number of edges of a pose in the visibility graph (default 4)')
+      print ('-r, --repeats : number of runs of every case, the best time is reported (default 1)')
+      print ('-e, --engine : feature generation engine, legacy or batch')
+      print ('-f, --output-format : format of measurements and feature data, text, npy or npz')
+      print ('-w, --workers : number of processes simulating reference poses in parallel (batch engine only)')
+      print ('--seed : seed of the synthetic networks and of the simulation (default 0)')
+      print ('--no-memory : skip the additional run of every case that measures peak memory with tracemalloc')
+      print ('--startup : measure only startup time of the simulator in fresh processes (at least 10 repeats) and import times of its modules')
+      sys.exit(2)
+
+    config = SimulationConfig.Config()
+    config.min_vertical_angle_deg = 0.2 #the default -30 is not accepted by read_from_xml
+    if path_file_config_xml != '':
+       config.read_from_xml(path_file_config_xml)
+    if feature_generation_engine != '':
+       config.feature_generation_engine = feature_generation_engine
+    if output_format != '':
+       config.output_format = output_format
+    if number_of_workers != 0:
+       config.number_of_workers = number_of_workers
+    config.use_streaming = False
+    config.seed = seed
+    if (not config.feature_generation_engine in SimulationConfig.feature_generation_engines or not config.output_format in SimulationConfig.output_formats
+        or config.number_of_workers < 1 or (config.number_of_workers > 1 and config.feature_generation_engine != 'batch')):
+       print('Invalid engine, output format or number of workers!')
+       sys.exit(2)
+    if min(list_of_number_of_poses, default = 0) < 2 or min(list_of_number_of_features, default = 0) < 1 or repeats < 1 or average_degree < 1.0 or seed < 0:
+       print('Networks need at least 2 poses, clouds at least 1 feature, average degree must be at least 1 and repeats positive!')
+       sys.exit(2)
+    if len(list_of_matching_probability) == 0 or not all(0.0 < matching_probability < 1.0 for matching_probability in list_of_matching_probability):
+       print('Matching probabilities must be between 0 and 1!')
+       sys.exit(2)
+
+    if startup:
+       results = measure_startup(config, max(repeats, 10))
+       with open(path_file_output, 'w') as file:
+           json.dump(results, file, indent = 2)
+       for (name, measurement) in results['commands'].items():
+          print(f"{name}: {1000*measurement['time_s']:.1f} ms (median {1000*measurement['median_time_s']:.1f} ms)")
+       print(f"scipy imported by the small run: {results['scipy_imported_by_small_run']}")
+       print(f'Results saved to {path_file_output}.')
+       return
+
+    results = run_benchmark(config, list_of_number_of_poses, list_of_number_of_features, list_of_matching_probability, average_degree, repeats, seed, trace_memory)
+    with open(path_file_output, 'w') as file:
+        json.dump(results, file, indent = 2)
+    for case in results['cases']:
+        print(f"{case['number_of_poses']} poses, {case['number_of_features_per_cloud']} features, matching {case['matching_probability']}: "
+              f"{case['number_of_observations']} observations in {case['total_time_s']:.3f} s"
+              + (f", peak memory {case['peak_memory_bytes']/2**20:.1f} MiB" if case['peak_memory_bytes'] is not None else ''))
+    print(f'Results saved to {path_file_output}.')
+
+if __name__ == '__main__':
+   main()
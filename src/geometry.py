@@ -1,6 +1,7 @@
 import numpy as np
-import scipy.spatial.transform as transf
-import copy as cp
+import collections
+import itertools
+import weakref
 
 def spherical_to_cartesian(slant_distance,horizontal_angle_rad, vertical_angle_rad ):
     horizontal_distance = slant_distance*np.sin(vertical_angle_rad)
@@ -25,33 +26,276 @@ def get_jacobian_of_mapping_to_cartesian_coordinates(slant_distance, horizontal_
                          [cv, 0.0, -slant_distance*sv]])
     return jacobian
 
+def get_jacobians_of_mapping_to_cartesian_coordinates(slant_distances, horizontal_angles_rad, vertical_angles_rad):
+    #vectorized version of get_jacobian_of_mapping_to_cartesian_coordinates, returns N x 3 x 3 stack of jacobians
+    ch = np.cos(horizontal_angles_rad)
+    sh = np.sin(horizontal_angles_rad)
+    cv = np.cos(vertical_angles_rad)
+    sv = np.sin(vertical_angles_rad)
+    jacobians = np.zeros((len(slant_distances), 3, 3))
+    jacobians[:,0,0] = sv*ch
+    jacobians[:,0,1] = -slant_distances*sv*sh
+    jacobians[:,0,2] = slant_distances*cv*ch
+    jacobians[:,1,0] = sv*sh
+    jacobians[:,1,1] = slant_distances*sv*ch
+    jacobians[:,1,2] = slant_distances*cv*sh
+    jacobians[:,2,0] = cv
+    jacobians[:,2,2] = -slant_distances*sv
+    return jacobians
 
+def propagate_covariance(jacobians, covariance):
+    #computes J@covariance@J.T for every jacobian in N x 3 x 3 stack
+    return np.einsum('nij,jk,nlk->nil', jacobians, covariance, jacobians)
+
+def get_covariances_of_cartesian_coordinates(slant_distances, horizontal_angles_rad, vertical_angles_rad, measurement_variances, dtype = np.float64):
+    #closed form of J@diag(measurement_variances)@J.T, where J is the jacobian of mapping spherical coordinates to cartesian coordinates
+    #measurement_variances are variances of slant distance, horizontal angle and vertical angle, works for scalars and arrays of coordinates
+    slant_distances = np.asarray(slant_distances, dtype = dtype)
+    ch = np.cos(np.asarray(horizontal_angles_rad, dtype = dtype))
+    sh = np.sin(np.asarray(horizontal_angles_rad, dtype = dtype))
+    cv = np.cos(np.asarray(vertical_angles_rad, dtype = dtype))
+    sv = np.sin(np.asarray(vertical_angles_rad, dtype = dtype))
+    return get_covariances_from_directions(slant_distances, ch, sh, cv, sv, measurement_variances, dtype)
+
+def get_covariances_of_points(points, measurement_variances, dtype = np.float64):
+    #the same as get_covariances_of_cartesian_coordinates, but for N x 3 array of cartesian coordinates (no trigonometric functions needed)
+    points = np.asarray(points, dtype = dtype)
+    horizontal_distances = np.hypot(points[:,0], points[:,1])
+    slant_distances = np.hypot(horizontal_distances, points[:,2])
+    on_vertical_axis = horizontal_distances == 0.0
+    safe_horizontal_distances = np.where(on_vertical_axis, 1.0, horizontal_distances)
+    ch = np.where(on_vertical_axis, 1.0, points[:,0]/safe_horizontal_distances).astype(dtype)
+    sh = np.where(on_vertical_axis, 0.0, points[:,1]/safe_horizontal_distances).astype(dtype)
+    return get_covariances_from_directions(slant_distances, ch, sh, points[:,2]/slant_distances, horizontal_distances/slant_distances, measurement_variances, dtype)
+
+def get_covariances_from_directions(slant_distances, ch, sh, cv, sv, measurement_variances, dtype):
+    #the columns of the jacobian are orthogonal, so the covariance is the sum of three rank one matrices
+    variance_distance = dtype(measurement_variances[0])
+    variance_horizontal = dtype(measurement_variances[1])*slant_distances*slant_distances*sv*sv
+    variance_vertical = dtype(measurement_variances[2])*slant_distances*slant_distances
+    covariances = np.empty(np.shape(slant_distances) + (3,3), dtype = dtype)
+    covariances[...,0,0] = variance_distance*sv*sv*ch*ch + variance_horizontal*sh*sh + variance_vertical*cv*cv*ch*ch
+    covariances[...,0,1] = (variance_distance*sv*sv - variance_horizontal + variance_vertical*cv*cv)*ch*sh
+    covariances[...,0,2] = (variance_distance - variance_vertical)*sv*cv*ch
+    covariances[...,1,1] = variance_distance*sv*sv*sh*sh + variance_horizontal*ch*ch + variance_vertical*cv*cv*sh*sh
+    covariances[...,1,2] = (variance_distance - variance_vertical)*sv*cv*sh
+    covariances[...,2,2] = variance_distance*cv*cv + variance_vertical*sv*sv
+    covariances[...,1,0] = covariances[...,0,1]
+    covariances[...,2,0] = covariances[...,0,2]
+    covariances[...,2,1] = covariances[...,1,2]
+    return covariances
+
+def transform_points(transformation, points):
+    #applies 4 x 4 transformation to N x 3 array of points
+    return points@np.transpose(transformation[0:3,0:3]) + transformation[0:3,3]
+
+def read_only(array):
+    #cached matrices are shared between callers, so they must not be modified in place
+    array.flags.writeable = False
+    return array
+
+#rotations of poses are kept as 3 x 3 matrices and converted with NumPy, scipy (slow to import) is loaded only when Pose.rotation is used
+
+def euler_zyx_to_matrices(yaw_pitch_roll, degrees:bool = False):
+    #rotation matrices Rz(yaw)@Ry(pitch)@Rx(roll) of N x 3 angles (3 x 3 matrix of 3 angles), the same as scipy 'ZYX' Euler angles
+    angles = np.asarray(yaw_pitch_roll, dtype = np.float64)
+    angles = np.radians(angles) if degrees else angles
+    (cos, sin) = (np.cos(angles), np.sin(angles))
+    (cy, cp, cr) = (cos[...,0], cos[...,1], cos[...,2])
+    (sy, sp, sr) = (sin[...,0], sin[...,1], sin[...,2])
+    matrices = np.stack((cy*cp, cy*sp*sr - sy*cr, cy*sp*cr + sy*sr,
+                         sy*cp, sy*sp*sr + cy*cr, sy*sp*cr - cy*sr,
+                         -sp, cp*sr, cp*cr), axis = -1)
+    return matrices.reshape(angles.shape[:-1] + (3,3))
+
+def matrices_to_euler_zyx(matrices, degrees:bool = False):
+    #yaw, pitch, roll of N x 3 x 3 rotation matrices, yaw and roll in (-pi, pi], pitch in [-pi/2, pi/2],
+    #roll is computed after removing yaw, so the angles are consistent also close to the gimbal lock (pitch +-90 deg), where yaw is 0
+    matrices = np.asarray(matrices, dtype = np.float64)
+    cos_pitch = np.hypot(matrices[...,0,0], matrices[...,1,0])
+    pitch = np.arctan2(-matrices[...,2,0], cos_pitch)
+    yaw = np.where(cos_pitch > 1e-12, np.arctan2(matrices[...,1,0], matrices[...,0,0]), 0.0)
+    (cy, sy) = (np.cos(yaw), np.sin(yaw))
+    roll = np.arctan2(sy*matrices[...,0,2] - cy*matrices[...,1,2], cy*matrices[...,1,1] - sy*matrices[...,0,1])
+    angles = np.stack((yaw, pitch, roll), axis = -1)
+    return np.degrees(angles) if degrees else angles
+
+def matrices_to_quaternions_wxyz(matrices):
+    #unit quaternions (w, x, y, z) of N x 3 x 3 rotation matrices, computed from the largest of the diagonal and the trace
+    #(the same method and signs as scipy Rotation.from_matrix)
+    matrices = np.asarray(matrices, dtype = np.float64)
+    shape = matrices.shape[:-2]
+    matrices = matrices.reshape((-1,3,3))
+    decision = np.column_stack((matrices[:,0,0], matrices[:,1,1], matrices[:,2,2], matrices[:,0,0] + matrices[:,1,1] + matrices[:,2,2]))
+    choices = np.argmax(decision, axis = 1)
+    quaternions = np.empty((len(matrices), 4)) #x, y, z, w
+    rows = np.flatnonzero(choices == 3)
+    quaternions[rows] = np.column_stack((matrices[rows,2,1] - matrices[rows,1,2], matrices[rows,0,2] - matrices[rows,2,0],
+                                         matrices[rows,1,0] - matrices[rows,0,1], 1.0 + decision[rows,3]))
+    for i in range(3):
+        (j, k) = ((i + 1) % 3, (i + 2) % 3)
+        rows = np.flatnonzero(choices == i)
+        quaternions[rows,i] = 1.0 - decision[rows,3] + 2.0*matrices[rows,i,i]
+        quaternions[rows,j] = matrices[rows,j,i] + matrices[rows,i,j]
+        quaternions[rows,k] = matrices[rows,k,i] + matrices[rows,i,k]
+        quaternions[rows,3] = matrices[rows,k,j] - matrices[rows,j,k]
+    quaternions /= np.linalg.norm(quaternions, axis = 1)[:,None]
+    return quaternions[:,[3,0,1,2]].reshape(shape + (4,))
+
+def rotation_vectors_to_matrices(rotation_vectors):
+    #rotation matrices of N x 3 rotation vectors (axis times angle in radians), Rodrigues formula
+    rotation_vectors = np.asarray(rotation_vectors, dtype = np.float64)
+    theta = np.linalg.norm(rotation_vectors, axis = -1)[...,None,None]
+    skew = np.zeros(rotation_vectors.shape[:-1] + (3,3))
+    skew[...,0,1], skew[...,0,2], skew[...,1,2] = -rotation_vectors[...,2], rotation_vectors[...,1], -rotation_vectors[...,0]
+    skew -= np.swapaxes(skew, -1, -2)
+    #sin(theta)/theta and (1 - cos(theta))/theta^2 with their limits for small angles
+    is_small = theta < 1e-8
+    safe_theta = np.where(is_small, 1.0, theta)
+    a = np.where(is_small, 1.0 - theta**2/6.0, np.sin(safe_theta)/safe_theta)
+    b = np.where(is_small, 0.5 - theta**2/24.0, (1.0 - np.cos(safe_theta))/safe_theta**2)
+    return np.eye(3) + a*skew + b*(skew@skew)
 
 class Pose:
-    def __init__(self, position = np.zeros((3,1)), rotation = transf.Rotation([0,0,0,1]), type:str = 'free' ):
+    def __init__(self, position = np.zeros((3,1)), rotation = None, type:str = 'free' ):
+        #rotation is a scipy Rotation, None means no rotation
+        self._version = 0
         self.position = position
         self.rotation = rotation
         self.type = type #free, fixed
+        
+    #T, T_inv and relative transformations are computed once and cached, changing position or rotation clears the cache
+    @property
+    def position(self):
+        return self._position
+    
+    @position.setter
+    def position(self, position):
+        self._position = position
+        self.clear_cache()
+        
+    @property
+    def rotation(self):
+        if self._rotation is None: #scipy Rotation is created from the matrix on first use
+            import scipy.spatial.transform as transf
+            self._rotation = transf.Rotation.from_matrix(self._rotation_matrix)
+        return self._rotation
+    
+    @rotation.setter
+    def rotation(self, rotation):
+        self.set_rotation_matrix(np.eye(3) if rotation is None else rotation.as_matrix())
+        self._rotation = rotation
+        
+    def set_rotation_matrix(self, rotation_matrix):
+        self._rotation = None
+        self._rotation_matrix = read_only(np.array(rotation_matrix, dtype = np.float64))
+        self.clear_cache()
+        
+    def __getstate__(self): #cache is not pickled, e.g. when poses are sent to worker processes
+        return {'position': self.position, 'rotation_matrix': self._rotation_matrix, 'type': self.type}
+    
+    def __setstate__(self, state):
+        self._version = 0
+        self.position = state['position']
+        self.set_rotation_matrix(state['rotation_matrix'])
+        self.type = state['type']
+        
+    def clear_cache(self):
+        self._T = None
+        self._T_inv = None
+        self._relative_transformations = weakref.WeakKeyDictionary()
+        self._version += 1
                 
     def set_position(self,position):
         self.position = position
         
     def set_rotation_from_euler(self, yaw_pitch_roll):
-        self.rotation = transf.Rotation.from_euler('ZYX', yaw_pitch_roll, False)
+        self.set_rotation_matrix(euler_zyx_to_matrices(yaw_pitch_roll))
         
     def get_rotation_as_wxyz_quaternion(self):
-        xyzw_quaternion = self.rotation.as_quat()
-        wxyz_quaternion = [xyzw_quaternion[3], xyzw_quaternion[0], xyzw_quaternion[1], xyzw_quaternion[2]]
-        return wxyz_quaternion
+        return matrices_to_quaternions_wxyz(self._rotation_matrix).tolist()
+    
+    def rotation_matrix(self):
+        return self._rotation_matrix
     
     def T(self): #converts pose to transformation matrix
-        T = np.block([[self.rotation.as_matrix(), self.position],[np.zeros((1,3)), np.eye(1)]])
-        return T
+        if self._T is None:
+            self._T = read_only(np.block([[self.rotation_matrix(), self.position],[np.zeros((1,3)), np.eye(1)]]))
+        return self._T
     
     def T_inv(self): #converts pose to the inverse transfomration matrix
-        rt = np.transpose(self.rotation.as_matrix())
-        T_inv = np.block([[rt, -rt@self.position],[np.zeros((1,3)), np.eye(1)]])
-        return T_inv
+        if self._T_inv is None:
+            rt = np.transpose(self.rotation_matrix())
+            self._T_inv = read_only(np.block([[rt, -rt@self.position],[np.zeros((1,3)), np.eye(1)]]))
+        return self._T_inv
+    
+    def relative_transformation(self, other_pose): #transformation from the frame of other_pose to the frame of this pose
+        cached = self._relative_transformations.get(other_pose)
+        if cached is not None and cached[0] == other_pose._version:
+            return cached[1]
+        relative_transformation = read_only(self.T_inv()@other_pose.T())
+        self._relative_transformations[other_pose] = (other_pose._version, relative_transformation)
+        return relative_transformation
+    
+def create_poses(positions, rotation_matrices, types):
+    #creates poses from N x 3 x 1 positions and N x 3 x 3 rotation matrices, poses share the (read only) arrays
+    rotation_matrices = read_only(np.array(rotation_matrices, dtype = np.float64).reshape((-1,3,3)))
+    poses = []
+    for (index, type_of_pose) in enumerate(types):
+        pose = Pose.__new__(Pose)
+        pose._version = 0
+        pose._position = positions[index]
+        pose._rotation = None
+        pose._rotation_matrix = rotation_matrices[index]
+        pose.type = type_of_pose
+        pose.clear_cache()
+        poses.append(pose)
+    return poses
+
+def get_breadth_first_order(dict_of_poses_visibility:dict[int,set], pose_ids:list[int]):
+    #pose ids in breadth first order of the visibility graph (every component from its first pose in pose_ids, neighbours by id),
+    #consecutive poses of the order are close in the graph, e.g. they form coherent blocks for out-of-core simulation
+    order = []
+    visited = set()
+    for start_pose_id in pose_ids:
+        if start_pose_id in visited:
+            continue
+        visited.add(start_pose_id)
+        poses_to_visit = collections.deque([start_pose_id])
+        while poses_to_visit:
+            pose_id = poses_to_visit.popleft()
+            order.append(pose_id)
+            for neighbour in sorted(dict_of_poses_visibility[pose_id] - visited):
+                visited.add(neighbour)
+                poses_to_visit.append(neighbour)
+    return order
+
+def get_table_of_relative_transformations(poses:dict[int,Pose], dict_of_poses_visibility:dict[int,set]):
+    #returns dictionary (query_pose_id, reference_pose_id) -> transformation from reference pose frame to query pose frame
+    table = {}
+    for reference_pose_id, visible_pose_ids in dict_of_poses_visibility.items():
+        for query_pose_id in visible_pose_ids:
+            table[(query_pose_id, reference_pose_id)] = poses[query_pose_id].relative_transformation(poses[reference_pose_id])
+    return table
+
+def get_conflict_bitmasks(query_pose_ids:list[int], dict_of_poses_visibility:dict[int,set]):
+    #returns K x W uint64 array of bitsets over indices of query poses of one reference pose (bit j of row k is bit j%64 of word j//64),
+    #row k has bits of the earlier query poses (j < k) that are not co-visible with query pose k, a feature matched with any of them
+    #can not be matched with query pose k, so the visibility conflict check is a bitwise AND of the feature visibility bitset with row k
+    number_of_query_poses = len(query_pose_ids)
+    number_of_words = max(1, (number_of_query_poses + 63)//64)
+    is_not_covisible = np.tril(np.ones((number_of_query_poses, 64*number_of_words), dtype = bool), -1)
+    if number_of_query_poses > 1:
+        #pairs (k, neighbour of query pose k) of all query poses, neighbours which are query poses are mapped to their indices
+        numbers_of_neighbours = [len(dict_of_poses_visibility[pose_id]) for pose_id in query_pose_ids]
+        neighbour_ids = np.fromiter(itertools.chain.from_iterable(dict_of_poses_visibility[pose_id] for pose_id in query_pose_ids), np.int64, sum(numbers_of_neighbours))
+        rows = np.repeat(np.arange(number_of_query_poses), numbers_of_neighbours)
+        query_pose_ids = np.asarray(query_pose_ids, dtype = np.int64)
+        order = np.argsort(query_pose_ids)
+        positions = np.minimum(np.searchsorted(query_pose_ids[order], neighbour_ids), number_of_query_poses - 1)
+        is_query_pose = query_pose_ids[order][positions] == neighbour_ids
+        is_not_covisible[rows[is_query_pose], order[positions[is_query_pose]]] = False
+    return np.packbits(is_not_covisible, axis = 1, bitorder = 'little').view('<u8')
     
 class FeatureIn3d:
     def __init__(self,*, id:int = 0, position = np.zeros((3,1)), uncertainty:float = 0.01, covariance:np.array  ):
@@ -59,7 +303,7 @@ class FeatureIn3d:
         self.position = position
         self.uncertainty = uncertainty
         self.covariance = covariance #this is 'full', 3 x 3 covariance matrix
-        self.visibility = set() #which stations this feature is visible from
+        self.visibility = None #poses the feature is visible from are kept by FeatureStore (CSR visibility index), not by every feature
         
     def as_homogenous_vector(self): #returns position as 4 x 1 homogenous vector
         homogenous_vector = np.block([[self.position],[1]])
@@ -70,46 +314,75 @@ class GraphEdge:
         self.from_id = from_id
         self.to_id = to_id
 
+def get_indices_of_duplicated_edges(from_ids, to_ids):
+    #returns indices of edges that repeat an earlier edge or its inverse
+    edges = np.sort(np.column_stack((from_ids, to_ids)), axis = 1)
+    _, first_indices = np.unique(edges, axis = 0, return_index = True)
+    is_duplicate = np.ones(len(edges), dtype = bool)
+    is_duplicate[first_indices] = False
+    return np.flatnonzero(is_duplicate)
+
 class SimpleVisibilityGraph:
     def __init__(self, nodes = set()):
         self.nodes = nodes
         self.edges = []
-        
+        self.adjacency = {node: set() for node in nodes} #node id -> set of ids of nodes visible from that node
+
+    @classmethod
+    def from_edge_arrays(cls, from_ids, to_ids, nodes = None):
+        #builds the graph from arrays of edge ends in one pass, nodes are the ends of the edges and the given nodes (e.g. poses without edges),
+        #the edges must be unique (also when the direction is ignored)
+        from_ids = np.asarray(from_ids, dtype = np.int64).reshape(-1)
+        to_ids = np.asarray(to_ids, dtype = np.int64).reshape(-1)
+        assert len(from_ids) == len(to_ids), 'Error! Arrays of edge ends have different lengths.'
+        assert len(get_indices_of_duplicated_edges(from_ids, to_ids)) == 0, 'Error! Duplicated edges.'
+        sources = np.concatenate((from_ids, to_ids))
+        targets = np.concatenate((to_ids, from_ids))
+        order = np.argsort(sources, kind = 'stable')
+        edge_nodes, first_indices = np.unique(sources[order], return_index = True)
+        graph = cls(nodes = set(edge_nodes.tolist()) | (set(nodes) if nodes is not None else set()))
+        graph.edges = [GraphEdge(from_id, to_id) for (from_id, to_id) in zip(from_ids.tolist(), to_ids.tolist())]
+        for node, neighbours in zip(edge_nodes.tolist(), np.split(targets[order], first_indices[1:])):
+            graph.adjacency[node] = set(neighbours.tolist())
+        return graph
+
     def try_add_edge(self, edge_to_add:GraphEdge):
         if not edge_to_add.from_id in self.nodes:
             return False
         if not edge_to_add.to_id in self.nodes:
             return False
-        for existing_edge in self.edges:
-            if (existing_edge.from_id == edge_to_add.from_id and existing_edge.to_id == edge_to_add.to_id):
-                return False
-            if (existing_edge.from_id == edge_to_add.to_id and existing_edge.to_id == edge_to_add.from_id):
-                return False
+        if edge_to_add.to_id in self.adjacency[edge_to_add.from_id]: #edge or its inverse already exists
+            return False
         self.edges.append(edge_to_add)
+        self.adjacency[edge_to_add.from_id].add(edge_to_add.to_id)
+        self.adjacency[edge_to_add.to_id].add(edge_to_add.from_id)
         return True
     
+    def get_connected_components(self):
+        #breadth first search, returns list of sets of node ids, the component of the first node goes first
+        components = []
+        visited_nodes = set()
+        for start_node in self.nodes:
+            if start_node in visited_nodes:
+                continue
+            component = {start_node}
+            nodes_to_visit = collections.deque([start_node])
+            while nodes_to_visit:
+                node = nodes_to_visit.popleft()
+                for neighbour in self.adjacency[node]:
+                    if not neighbour in component:
+                        component.add(neighbour)
+                        nodes_to_visit.append(neighbour)
+            visited_nodes.update(component)
+            components.append(component)
+        return components
+    
     def verify_node_connections(self):
-        connected_nodes = set()
-        connected_nodes.add(list(self.nodes)[0])
-        found_connected_node = True
-        edges_to_check = cp.deepcopy(self.edges)
- 
-        while found_connected_node:
-            found_connected_node = False
-            for edge in edges_to_check:
-                if (edge.from_id in connected_nodes) and not (edge.to_id in connected_nodes):
-                    connected_nodes.add(edge.to_id)
-                    found_connected_node = True
-                    edges_to_check.remove(edge)
-                    break
-                if (edge.to_id in connected_nodes) and not (edge.from_id in connected_nodes):
-                    connected_nodes.add(edge.from_id)
-                    found_connected_node = True
-                    edges_to_check.remove(edge)
-                    break
-        
-        unconnected_nodes = self.nodes.difference(connected_nodes) 
-
+        #returns nodes that are not connected with the first node of the graph
+        components = self.get_connected_components()
+        if len(components) == 0:
+            return set()
+        unconnected_nodes = self.nodes.difference(components[0])
         return unconnected_nodes
         
     
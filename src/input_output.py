@@ -1,198 +1,585 @@
 import numpy as np
-import scipy.spatial.transform as transf
 import os
-import random
+import time
 import utils
 
 import geometry
 import Simulator
+import SimulationConfig
+
+pose_types = ('free', 'fixed')
+
+def read_text_table(file_name:str, number_of_columns:int):
+    #reads comma separated file with a header line into N x number_of_columns array of strings,
+    #returns the array and numbers of the lines of its rows (blank lines are skipped)
+    with open(file_name) as file:
+        lines = file.read().splitlines()[1:]
+    line_numbers = [line_number for (line_number, line) in enumerate(lines, 2) if line.strip() != '']
+    rows = [lines[line_number - 2].split(',') for line_number in line_numbers]
+    for (line_number, row) in zip(line_numbers, rows):
+        if len(row) != number_of_columns:
+            raise ValueError(f'Error! Line {line_number} of {file_name} has {len(row)} values instead of {number_of_columns}.')
+    table = np.char.strip(np.array(rows, dtype = str).reshape((-1, number_of_columns)))
+    return table, np.array(line_numbers, dtype = np.int64)
+
+def get_row_description(file_name:str, line_numbers, index:int):
+    #rows of text files are reported by line numbers, rows of binary files by indices
+    if line_numbers is None:
+        return f'Row {index} of {file_name}'
+    return f'Line {line_numbers[index]} of {file_name}'
+
+def parse_column(values:np.ndarray, dtype, file_name:str, line_numbers:np.ndarray, column_name:str):
+    #converts all values at once, when it fails the first malformed value is reported with its line number
+    try:
+        return values.astype(dtype)
+    except ValueError:
+        for (index, row) in enumerate(values.reshape((len(values), -1))):
+            for value in row:
+                try:
+                    np.array(value).astype(dtype)
+                except ValueError:
+                    raise ValueError(f'Error! {get_row_description(file_name, line_numbers, index)}: {column_name} \'{value}\' is not a valid {np.dtype(dtype).name} number.') from None
+        raise
+
+def create_poses(pose_ids, positions, yaw_pitch_roll_deg, types, file_name:str, line_numbers = None):
+    #creates dictionary pose id -> geometry.Pose, rotations of all poses are computed in one call
+    pose_ids = np.asarray(pose_ids, dtype = np.int64).reshape(-1)
+    positions = np.asarray(positions, dtype = np.float64).reshape((-1,3,1))
+    yaw_pitch_roll_deg = np.asarray(yaw_pitch_roll_deg, dtype = np.float64).reshape((-1,3))
+    types = np.asarray(types, dtype = str).reshape(-1)
+    assert len(pose_ids) == len(positions) == len(yaw_pitch_roll_deg) == len(types), f'Error! Columns of {file_name} have different lengths.'
+    _, first_indices = np.unique(pose_ids, return_index = True)
+    is_duplicate = np.ones(len(pose_ids), dtype = bool)
+    is_duplicate[first_indices] = False
+    if np.any(is_duplicate):
+        index = np.argmax(is_duplicate)
+        raise ValueError(f'Error! {get_row_description(file_name, line_numbers, index)}: pose id {pose_ids[index]} is duplicated.')
+    is_unknown_type = ~np.isin(types, pose_types)
+    if np.any(is_unknown_type):
+        index = np.argmax(is_unknown_type)
+        raise ValueError(f'Error! {get_row_description(file_name, line_numbers, index)}: pose type \'{types[index]}\' is not one of {pose_types}.')
+    if len(pose_ids) == 0:
+        return {}
+    rotation_matrices = geometry.euler_zyx_to_matrices(yaw_pitch_roll_deg, True)
+    return dict(zip(pose_ids.tolist(), geometry.create_poses(positions, rotation_matrices, types.tolist())))
 
 def read_poses(file_name:str):
-    data = np.loadtxt(file_name, dtype = str, skiprows = 1, delimiter = ',')
-    assert data.shape[1] == 8, 'Error! File with poses is wrong or missformated. Data in the file must be interpretable as array with 7 columns.'
-    poses = {}
-    for pose_entry in data:
-        id = int(pose_entry[0])
-        position = np.array(pose_entry[1:4].astype(float)).reshape(3,1)
-        rotation = transf.Rotation.from_euler('ZYX',pose_entry[4:7].astype(float),True)
-        type_of_pose = pose_entry[7]
-        poses[id] = geometry.Pose(position, rotation, type_of_pose)
-    return poses
+    #text file: id,x,y,z,yaw[deg],pitch[deg],roll[deg],type or npz file written by save_poses_npz
+    if file_name.endswith('.npz'):
+        return read_poses_npz(file_name)
+    data, line_numbers = read_text_table(file_name, 8)
+    pose_ids = parse_column(data[:,0], np.int64, file_name, line_numbers, 'pose id')
+    coordinates = parse_column(data[:,1:7], np.float64, file_name, line_numbers, 'pose coordinate')
+    return create_poses(pose_ids, coordinates[:,0:3], coordinates[:,3:6], data[:,7], file_name, line_numbers)
+
+def read_poses_npz(file_name:str):
+    #arrays: id (N), position (N x 3), yaw_pitch_roll_deg (N x 3), type (N)
+    with np.load(file_name) as data:
+        for name in ('id', 'position', 'yaw_pitch_roll_deg', 'type'):
+            assert name in data, f'Error! Array {name} is missing in {file_name}.'
+        return create_poses(data['id'], data['position'], data['yaw_pitch_roll_deg'], data['type'], file_name)
+
+def save_poses_npz(file_name:str, poses:dict[int,geometry.Pose]):
+    #binary input of poses, read by read_poses
+    np.savez(file_name, id = np.array(list(poses.keys()), dtype = np.int64),
+             position = np.reshape([pose.position for pose in poses.values()], (-1,3)).astype(np.float64),
+             yaw_pitch_roll_deg = get_yaw_pitch_roll_deg(poses), type = np.array([pose.type for pose in poses.values()], dtype = str))
+
+def get_yaw_pitch_roll_deg(poses:dict[int,geometry.Pose]):
+    if len(poses) == 0:
+        return np.zeros((0,3))
+    return geometry.matrices_to_euler_zyx(np.reshape([pose.rotation_matrix() for pose in poses.values()], (-1,3,3)), True)
+
+def save_poses_text(file_name:str, poses:dict[int,geometry.Pose]):
+    #text input of poses, read by read_poses
+    rows = np.column_stack((np.reshape([pose.position for pose in poses.values()], (-1,3)), get_yaw_pitch_roll_deg(poses)))
+    with open(file_name, 'w') as file:
+        file.write('id,x,y,z,yaw[deg],pitch[deg],roll[deg],type\n')
+        file.write(''.join(['%d,%.17g,%.17g,%.17g,%.17g,%.17g,%.17g,%s\n' % ((pose_id,) + tuple(row) + (pose.type,)) for ((pose_id, pose), row) in zip(poses.items(), rows)]))
+
+def create_graph(from_ids, to_ids, file_name:str, line_numbers = None):
+    from_ids = np.asarray(from_ids, dtype = np.int64).reshape(-1)
+    to_ids = np.asarray(to_ids, dtype = np.int64).reshape(-1)
+    assert len(from_ids) == len(to_ids), f'Error! Columns of {file_name} have different lengths.'
+    duplicated_edges = geometry.get_indices_of_duplicated_edges(from_ids, to_ids)
+    if len(duplicated_edges) > 0:
+        index = duplicated_edges[0]
+        raise ValueError(f'Error! {get_row_description(file_name, line_numbers, index)}: edge {from_ids[index]},{to_ids[index]} or its inverse is duplicated.')
+    return geometry.SimpleVisibilityGraph.from_edge_arrays(from_ids, to_ids)
 
 def read_graph(file_name:str):
-    data = np.loadtxt(file_name, dtype = int, skiprows = 1, delimiter = ',')
-    assert data.shape[1] == 2, 'Error! File with graph edges is wrong or missformated. Data in the file must be interpretable as array with 2 columns.'
-    edges = []
-    nodes = set()
-    for edge_data in data:
-        nodes.add(edge_data[0])
-        nodes.add(edge_data[1])
-        edges.append(geometry.GraphEdge(edge_data[0], edge_data[1]))
-    graph = geometry.SimpleVisibilityGraph(nodes = nodes)
-    for edge in edges:
-        assert graph.try_add_edge(edge), 'error while constructing visibilit graph'
-    return graph
+    #text file: from_id,to_id or npz file written by save_graph_npz
+    if file_name.endswith('.npz'):
+        return read_graph_npz(file_name)
+    data, line_numbers = read_text_table(file_name, 2)
+    edges = parse_column(data, np.int64, file_name, line_numbers, 'pose id')
+    return create_graph(edges[:,0], edges[:,1], file_name, line_numbers)
+
+def read_graph_npz(file_name:str):
+    #arrays: from_id (E), to_id (E)
+    with np.load(file_name) as data:
+        for name in ('from_id', 'to_id'):
+            assert name in data, f'Error! Array {name} is missing in {file_name}.'
+        return create_graph(data['from_id'], data['to_id'], file_name)
+
+def save_graph_text(file_name:str, graph:geometry.SimpleVisibilityGraph):
+    #text input of graph, read by read_graph
+    with open(file_name, 'w') as file:
+        file.write('from_id,to_id\n')
+        file.write(''.join([f'{edge.from_id},{edge.to_id}\n' for edge in graph.edges]))
+
+def save_graph_npz(file_name:str, graph:geometry.SimpleVisibilityGraph):
+    #binary input of graph, read by read_graph
+    np.savez(file_name, from_id = np.array([edge.from_id for edge in graph.edges], dtype = np.int64),
+             to_id = np.array([edge.to_id for edge in graph.edges], dtype = np.int64))
 
 def print_features(simulator:Simulator):
-    for (pose_id, features) in simulator.dict_of_features.items():
+    store = simulator.feature_store
+    for (pose_id, columns) in store.pose_views():
         print(f'{pose_id=}')
-        for feature in features:
-            print(f'{feature.id=} : {feature.position[0,0]:.3f} {feature.position[1,0]:.3f} {feature.position[2,0]:.3f}  {feature.visibility=}')
+        for (feature_id, position) in zip(columns['feature_id'].tolist(), columns['position'].tolist()):
+            visibility = set(store.get_visibility(feature_id).tolist())
+            print(f'{feature_id=} : {position[0]:.3f} {position[1]:.3f} {position[2]:.3f}  {visibility=}')
+            
+class NpyColumnFile:
+    #.npy file that grows by appending rows, the header reserves space for the shape and is rewritten on close
+    header_length = 128
+    
+    def __init__(self, path:str, dtype, row_shape:tuple = ()):
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.number_of_rows = 0
+        self.file = open(path, 'wb')
+        self.write_header()
+        
+    def write_header(self):
+        shape = (self.number_of_rows,) + self.row_shape
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.lib.format.dtype_to_descr(self.dtype), shape)
+        header = header.ljust(self.header_length - 11) + '\n'
+        self.file.seek(0)
+        self.file.write(b'\x93NUMPY\x01\x00' + np.array(len(header), '<u2').tobytes() + header.encode('latin1'))
+        
+    def append(self, array:np.ndarray):
+        array = np.ascontiguousarray(array, dtype = self.dtype)
+        assert array.shape[1:] == self.row_shape, 'Error! Shape of appended rows does not match the column.'
+        self.file.write(array.tobytes())
+        self.number_of_rows += array.shape[0]
+        
+    def close(self):
+        self.write_header()
+        self.file.close()
+
+class ColumnsWriter:
+    #npy: directory with one .npy file per column, every file can be memory-mapped with np.load(..., mmap_mode='r')
+    #npz: single uncompressed archive with the same arrays
+    def __init__(self, path_without_extension:str, output_format:str, column_types:dict[str,tuple]):
+        self.output_format = output_format
+        self.path_without_extension = path_without_extension
+        self.directory = path_without_extension if output_format == 'npy' else path_without_extension + '.parts'
+        os.makedirs(self.directory, exist_ok = True)
+        self.columns = {}
+        for (name, (dtype, row_shape)) in column_types.items():
+            self.columns[name] = NpyColumnFile(os.path.join(self.directory, name + '.npy'), dtype, row_shape)
+            
+    def write(self, arrays:dict[str,np.ndarray]):
+        for (name, column) in self.columns.items():
+            column.append(arrays[name])
             
-def save_features(output_direcotry:str, simulator:Simulator):
-    path_to_output_file = os.path.join(output_direcotry, 'lidar_measurements.txt')
-    with open(path_to_output_file,'w') as file:
-        if simulator.config.use_anisotropic_noise:
-            header = 'pose_id,feature_id,x,y,z,cov_xx,cov_xy,cov_xz,cov_yx,cov_yy,cov_yz,cov_zx,cov_zy,cov_zz\n'
-            file.write(header)
-            for (pose_id, features) in simulator.dict_of_features.items():
-                for feature in features:
-                    file.write('%d,' % pose_id)
-                    file.write('%d,' % feature.id)
-                    file.write('%.5f,%.5f,%.5f,' % (feature.position[0,0], feature.position[1,0], feature.position[2,0]) )
-                    for i in range(8):
-                        row = i // 3
-                        col = i % 3
-                        file.write('%.15f,' % feature.covariance[row,col])
-                    file.write('%.15f\n' % feature.covariance[2,2] )
+    def close(self):
+        for column in self.columns.values():
+            column.close()
+        if self.output_format == 'npz':
+            import zipfile, shutil #imported only for the npz format
+            with zipfile.ZipFile(self.path_without_extension + '.npz', 'w', zipfile.ZIP_STORED, allowZip64 = True) as archive:
+                for name in self.columns.keys():
+                    archive.write(os.path.join(self.directory, name + '.npy'), name + '.npy')
+            shutil.rmtree(self.directory)
+
+def read_binary_output(path:str, mmap_mode = 'r'):
+    #reads output saved in npy or npz format, arrays of the npy format are memory-mapped unless mmap_mode is None
+    if path.endswith('.npz'):
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+    arrays = {}
+    for file_name in sorted(os.listdir(path)):
+        if file_name.endswith('.npy'):
+            arrays[file_name[:-4]] = np.load(os.path.join(path, file_name), mmap_mode = mmap_mode)
+    return arrays
+
+def get_output_paths(output_direcotry:str, output_format:str = 'text', export_problem_structure:bool = False):
+    #paths of all outputs of a simulation run, npy outputs are directories
+    extension = {'text': '.txt', 'npy': '', 'npz': '.npz'}[output_format]
+    output_paths = [os.path.join(output_direcotry, 'lidar_measurements' + extension), os.path.join(output_direcotry, 'feature_data' + extension),
+                    os.path.join(output_direcotry, 'network.dxf'), os.path.join(output_direcotry, 'poses.txt')]
+    if export_problem_structure:
+        output_paths.append(os.path.join(output_direcotry, 'problem_structure.npz'))
+    return output_paths
+
+def remove_outputs(output_direcotry:str, output_format:str = 'text'):
+    #outputs may be hard links to entries of the result cache, so they are removed instead of being overwritten in place,
+    #the problem structure is always removed, so a stale one never stays next to new measurements
+    for path in get_output_paths(output_direcotry, output_format, True):
+        if os.path.isdir(path):
+            import shutil #imported only if there are npy outputs
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+text_buffer_size = 1 << 20 #large buffers, so text outputs are written in few large writes (e.g. to network file systems)
+
+#Writers below consume observations in columns (see FeatureStore.get_columns and Simulator.simulate_reference_pose),
+#so they can write the output either at once or chunk by chunk, while the simulation is running.
+class MeasurementsWriter:
+    def __init__(self, output_direcotry:str, config:SimulationConfig.Config, output_format:str = 'text'):
+        self.output_format = output_format
+        self.use_anisotropic_noise = config.use_anisotropic_noise
+        self.uncertainty = config.gaussian_noise_point_position
+        if output_format != 'text':
+            column_types = {'pose_id': (np.int64, ()), 'feature_id': (np.int64, ()), 'position': (np.float64, (3,))}
+            if self.use_anisotropic_noise:
+                column_types['covariance'] = (np.float32 if config.use_float32_covariances else np.float64, (3,3))
+            else:
+                column_types['sigma'] = (np.float64, (3,))
+            self.columns_writer = ColumnsWriter(os.path.join(output_direcotry, 'lidar_measurements'), output_format, column_types)
+            return
+        self.file = open(os.path.join(output_direcotry, 'lidar_measurements.txt'), 'w', buffering = text_buffer_size)
+        if self.use_anisotropic_noise:
+            self.file.write('pose_id,feature_id,x,y,z,cov_xx,cov_xy,cov_xz,cov_yx,cov_yy,cov_yz,cov_zx,cov_zy,cov_zz\n')
+            self.row_format = '%d,%d,%.5f,%.5f,%.5f,' + ','.join(['%.15f']*9) + '\n'
         else:
-            header = 'pose_id,feature_id,x,y,z,sigma_x,sigma_y,sigma_z\n'
-            uncertainty = simulator.config.gaussian_noise_point_position
-            file.write(header)
-            for (pose_id, features) in simulator.dict_of_features.items():
-                for feature in features:
-                    file.write('%d,' % pose_id)
-                    file.write('%d,' % feature.id)
-                    file.write('%.5f,%.5f,%.5f,' % (feature.position[0,0], feature.position[1,0], feature.position[2,0]) )
-                    file.write('%.5f,%.5f,%.5f\n' % (uncertainty, uncertainty, uncertainty) )
-                
+            self.file.write('pose_id,feature_id,x,y,z,sigma_x,sigma_y,sigma_z\n')
+            self.row_format = '%%d,%%d,%%.5f,%%.5f,%%.5f,%.5f,%.5f,%.5f\n' % (self.uncertainty, self.uncertainty, self.uncertainty)
+    
+    def write(self, columns:dict[str,np.ndarray]):
+        if self.output_format != 'text':
+            arrays = {'pose_id': columns['pose_id'], 'feature_id': columns['feature_id'], 'position': columns['position']}
+            if self.use_anisotropic_noise:
+                arrays['covariance'] = columns['covariance']
+            else:
+                arrays['sigma'] = np.full((len(columns['pose_id']), 3), self.uncertainty)
+            self.columns_writer.write(arrays)
+            return
+        rows = zip(columns['pose_id'].tolist(), columns['feature_id'].tolist(), columns['position'].tolist(), columns['covariance'].reshape((-1,9)).tolist())
+        if self.use_anisotropic_noise:
+            self.file.writelines(self.row_format % (pose_id, feature_id, *position, *covariance) for (pose_id, feature_id, position, covariance) in rows)
+        else:
+            self.file.writelines(self.row_format % (pose_id, feature_id, *position) for (pose_id, feature_id, position, _) in rows)
+        
+    def close(self):
+        if self.output_format != 'text':
+            self.columns_writer.close()
+        else:
+            self.file.close()
+            
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exception):
+        self.close()
+
+def get_pose_ids_of_rows(columns:dict[str,np.ndarray]):
+    #unique pose ids of the rows, with return_index np.unique does not import numpy.ma, which slows down the start of small runs
+    return np.unique(columns['pose_id'], return_index = True)[0].tolist()
+
+def get_global_positions(columns:dict[str,np.ndarray], poses:dict[int,geometry.Pose]):
+    #world coordinates are computed once per chunk and shared by all writers of the chunk
+    if not 'position_global' in columns:
+        position_global = np.empty_like(columns['position'])
+        for pose_id in get_pose_ids_of_rows(columns):
+            rows = columns['pose_id'] == pose_id
+            position_global[rows] = geometry.transform_points(poses[pose_id].T(), columns['position'][rows])
+        columns['position_global'] = position_global
+    return columns['position_global']
+
+class FeatureDataWriter:
+    def __init__(self, output_direcotry:str, poses:dict[int,geometry.Pose], output_format:str = 'text'):
+        self.output_format = output_format
+        self.poses = poses
+        if output_format != 'text':
+            column_types = {'pose_id': (np.int64, ()), 'feature_id': (np.int64, ()), 'number_of_measurements': (np.int32, ()),
+                            'position': (np.float64, (3,)), 'position_global': (np.float64, (3,))}
+            self.columns_writer = ColumnsWriter(os.path.join(output_direcotry, 'feature_data'), output_format, column_types)
+            return
+        self.file = open(os.path.join(output_direcotry, 'feature_data.txt'), 'w', buffering = text_buffer_size)
+        self.file.write('pose_id,feature_id,number_of_measurements,x,y,z,x_global,y_global,z_global\n')
+        
+    def write(self, columns:dict[str,np.ndarray]):
+        position_global = get_global_positions(columns, self.poses)
+        if self.output_format != 'text':
+            arrays = {'pose_id': columns['pose_id'], 'feature_id': columns['feature_id'], 'number_of_measurements': columns['number_of_measurements'],
+                      'position': columns['position'], 'position_global': position_global}
+            self.columns_writer.write(arrays)
+            return
+        rows = zip(columns['pose_id'].tolist(), columns['feature_id'].tolist(), columns['number_of_measurements'].tolist(), columns['position'].tolist(), position_global.tolist())
+        self.file.writelines('%d,%d,%d,%.4f,%.4f,%.4f,%.4f,%.4f,%.4f\n' % (pose_id, feature_id, number_of_measurements, *position, *global_coordinates) 
+                             for (pose_id, feature_id, number_of_measurements, position, global_coordinates) in rows)
+        
+    def close(self):
+        if self.output_format != 'text':
+            self.columns_writer.close()
+        else:
+            self.file.close()
+            
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exception):
+        self.close()
+
+def save_features(output_direcotry:str, simulator:Simulator, output_format:str = 'text'):
+    with MeasurementsWriter(output_direcotry, simulator.config, output_format) as writer:
+        for (_, columns) in simulator.feature_store.pose_views():
+            writer.write(columns)
                 
-def save_all_feature_data(output_direcotry:str, simulator:Simulator, poses:dict[int,geometry.Pose]):
-    path_to_output_file = os.path.join(output_direcotry, 'feature_data.txt')
-    with open(path_to_output_file,'w') as file:
-        header = 'pose_id,feature_id,number_of_measurements,x,y,z,x_global,y_global,z_global\n'
-        file.write(header)
-        for (pose_id, features) in simulator.dict_of_features.items():
-            for feature in features:
-                pose = poses[pose_id]
-                global_coordinates = pose.T()@feature.as_homogenous_vector()
-                file.write('%d,' % pose_id)
-                file.write('%d,' % feature.id)
-                file.write('%d,' % len(feature.visibility))
-                file.write('%.4f,%.4f,%.4f,' % (feature.position[0,0], feature.position[1,0], feature.position[2,0]) )
-                file.write('%.4f,%.4f,%.4f\n' % (global_coordinates[0,0], global_coordinates[1,0], global_coordinates[2,0]))
-
-
-def save_poses(output_direcotry:str, poses:dict[int,geometry.Pose], position_rotation_noise ):
-    path_to_output_file = os.path.join(output_direcotry, 'poses.txt')
-    deg_to_rad = np.pi/180.0
+def save_all_feature_data(output_direcotry:str, simulator:Simulator, poses:dict[int,geometry.Pose], output_format:str = 'text'):
+    with FeatureDataWriter(output_direcotry, poses, output_format) as writer:
+        for (_, columns) in simulator.feature_store.pose_views():
+            writer.write(columns)
+
+def get_envelope_size(pattern, ranks):
+    #number of elements between the first nonzero of every row and the diagonal of symmetric pattern with rows and columns in order of ranks
+    row_lengths = np.diff(pattern.indptr)
+    is_nonempty = row_lengths > 0
+    if not np.any(is_nonempty):
+        return 0
+    first_column_ranks = np.minimum.reduceat(ranks[pattern.indices], pattern.indptr[:-1][is_nonempty])
+    return int(np.sum(ranks[is_nonempty] - np.minimum(first_column_ranks, ranks[is_nonempty])))
+
+def get_problem_structure(simulator:Simulator, poses:dict[int,geometry.Pose]):
+    #sparsity structure of the optimization problem of the simulated observations (see FeatureStore.get_incidence), with indices of poses
+    #in pose_ids, landmarks in feature_ids, rows of observations in the order of rows of lidar_measurements and:
+    #reduced_offsets, reduced_indices - CSR pattern of pose by pose blocks of the Schur complement (poses sharing a landmark, with the diagonal),
+    #pose_ordering - fill-reducing order of poses, reverse Cuthill-McKee of the reduced pattern or the order of poses if its envelope is smaller,
+    #feature_ordering - landmarks sorted by the first of their poses in pose_ordering, e.g. for elimination of landmarks before poses
+    import scipy.sparse, scipy.sparse.csgraph #imported only when the structure is exported, it is slow to import
+    store = simulator.feature_store
+    structure = store.get_incidence()
+    number_of_poses = len(store.pose_ids)
+    number_of_features = len(store.unique_feature_ids)
+    structure['pose_ids'] = np.array(store.pose_ids, dtype = np.int64)
+    structure['is_fixed'] = np.array([poses[pose_id].type == 'fixed' for pose_id in store.pose_ids], dtype = bool)
+    structure['feature_ids'] = store.unique_feature_ids
+    incidence = scipy.sparse.csr_matrix((np.ones(len(store), dtype = np.int8), structure['feature_indices'], structure['pose_offsets']), shape = (number_of_poses, number_of_features))
+    reduced = (incidence.astype(np.int32)@incidence.T.astype(np.int32)).tocsr()
+    reduced.sort_indices()
+    structure['reduced_offsets'] = reduced.indptr.astype(np.int64)
+    structure['reduced_indices'] = reduced.indices.astype(np.int32)
+    pose_ordering = scipy.sparse.csgraph.reverse_cuthill_mckee(reduced, symmetric_mode = True).astype(np.int32)
+    pose_ranks = np.empty(number_of_poses, dtype = np.int32)
+    pose_ranks[pose_ordering] = np.arange(number_of_poses, dtype = np.int32)
+    natural_ranks = np.arange(number_of_poses, dtype = np.int32)
+    if get_envelope_size(reduced, natural_ranks) <= get_envelope_size(reduced, pose_ranks): #e.g. poses already ordered along a trajectory
+        (pose_ordering, pose_ranks) = (natural_ranks, natural_ranks)
+    structure['pose_ordering'] = pose_ordering
+    first_ranks = np.full(number_of_features, number_of_poses, dtype = np.int32)
+    np.minimum.at(first_ranks, structure['feature_indices'], pose_ranks[structure['pose_indices']])
+    structure['feature_ordering'] = np.argsort(first_ranks, kind = 'stable').astype(np.int32)
+    return structure
+
+def save_problem_structure(output_direcotry:str, simulator:Simulator, poses:dict[int,geometry.Pose]):
+    #writes problem_structure.npz, so a solver can allocate its sparse system without rebuilding it from lidar_measurements
+    np.savez(os.path.join(output_direcotry, 'problem_structure.npz'), **get_problem_structure(simulator, poses))
+
+def save_simulation_streaming(output_direcotry:str, simulator:Simulator, poses:dict[int,geometry.Pose], graph:geometry.SimpleVisibilityGraph, output_format:str = 'text'):
+    #runs the simulation and writes measurements, feature data and network.dxf in a single pass, one reference pose at a time,
+    #rows are grouped by reference pose (and then by observing pose) instead of only by observing pose
+    #with more than one writer thread (config.number_of_writer_threads) every writer runs in its own thread, so reference poses are simulated
+    #while the previous ones are written
+    use_threads = simulator.config.number_of_writer_threads > 1
+    with MeasurementsWriter(output_direcotry, simulator.config, output_format) as measurements_writer, \
+         FeatureDataWriter(output_direcotry, poses, output_format) as feature_data_writer, \
+         NetworkDxfWriter(output_direcotry, simulator.config, poses) as dxf_writer:
+        writers = [measurements_writer, feature_data_writer, dxf_writer]
+        if use_threads:
+            writers = [BackgroundWriter(writer, name) for (writer, name) in zip(writers, ('lidar_measurements', 'feature_data', 'network.dxf'))]
+        try:
+            for columns in simulator.run_simulations_streaming(poses, graph):
+                if use_threads:
+                    get_global_positions(columns, poses) #computed once, before the chunk is shared by the threads
+                for writer in writers:
+                    writer.write(columns)
+        finally:
+            if use_threads:
+                for writer in writers:
+                    writer.stop()
+        if use_threads:
+            for writer in writers:
+                writer.raise_error()
+
+class BackgroundWriter:
+    #runs writes of writer (MeasurementsWriter, FeatureDataWriter or NetworkDxfWriter) in a thread, chunks are passed through a bounded queue,
+    #so at most queue_size chunks wait in memory, an error of the writer is raised by the next write or by raise_error, closing is left to the owner
+    def __init__(self, writer, name:str, queue_size:int = 4):
+        self.writer = writer
+        self.name = name
+        import queue, threading #imported only for concurrent writing
+        self.queue = queue.Queue(queue_size)
+        self.error = None
+        self.thread = threading.Thread(target = self.run, name = f'writer of {name}', daemon = True)
+        self.thread.start()
+
+    def run(self):
+        #every failure is recorded and the queue is drained until the end, so write and stop never wait for a failed writer
+        while True:
+            columns = self.queue.get()
+            if columns is None:
+                return
+            if self.error is None:
+                try:
+                    self.writer.write(columns)
+                except BaseException as error:
+                    self.error = error
+
+    def write(self, columns:dict[str,np.ndarray]):
+        self.raise_error()
+        if not self.thread.is_alive():
+            raise RuntimeError(f'Error! The thread writing {self.name} is not running.')
+        self.queue.put(columns)
+
+    def stop(self):
+        #waits until all chunks are written
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def raise_error(self):
+        #errors of the file system name the file, other errors are raised as they are
+        if isinstance(self.error, OSError):
+            raise OSError(f'Error! Writing {self.name} failed: {self.error}') from self.error
+        if self.error is not None:
+            raise self.error
+
+def get_output_writers(output_directory:str, simulator:Simulator, poses:dict[int,geometry.Pose], output_format:str = 'text'):
+    #independent writers of all outputs of a simulation without streaming, name of stage -> (function, arguments)
+    config = simulator.config
+    writers = {'save_features': (save_features, (output_directory, simulator, output_format)),
+               'save_all_feature_data': (save_all_feature_data, (output_directory, simulator, poses, output_format)),
+               'save_network_to_dxf': (save_network_to_dxf, (output_directory, simulator, poses))}
+    if config.export_problem_structure:
+        writers['save_problem_structure'] = (save_problem_structure, (output_directory, simulator, poses))
+    writers['save_poses'] = (save_poses, (output_directory, poses, (config.pose_noise_position, config.pose_noise_rotation_deg), simulator.seed))
+    return writers
+
+def run_writer(function, arguments):
+    start = time.perf_counter()
+    try:
+        function(*arguments)
+        error = None
+    except Exception:
+        import traceback
+        error = traceback.format_exc()
+    return {'time_s': time.perf_counter() - start, 'error': error}
+
+def run_writers(writers:dict[str,tuple], number_of_threads:int = 1):
+    #runs writers (see get_output_writers), with more than one thread concurrently in a thread pool: formatting of text holds the GIL,
+    #but writing to disk (e.g. network file systems) and most of NumPy do not, so the writers overlap,
+    #returns name -> {'time_s', 'error'} in the order of writers, error is the traceback of a failed writer or None, a failure does not stop the others
+    if number_of_threads <= 1 or len(writers) <= 1:
+        return {name: run_writer(function, arguments) for (name, (function, arguments)) in writers.items()}
+    import concurrent.futures #imported only for concurrent writers
+    with concurrent.futures.ThreadPoolExecutor(min(number_of_threads, len(writers)), thread_name_prefix = 'writer') as executor:
+        futures = {name: executor.submit(run_writer, function, arguments) for (name, (function, arguments)) in writers.items()}
+        return {name: future.result() for (name, future) in futures.items()}
+
+
+def get_pose_arrays_with_noise(poses:dict[int,geometry.Pose], position_rotation_noise, seed:int = None):
+    #returns N x 3 positions and N x 3 x 3 rotation matrices of poses with noise of position and rotation (standard deviations in units of
+    #positions and in degrees), only free poses get noise, the noise of all poses is drawn at once from the pose_noise stream of the seed
     sigma_pos = position_rotation_noise[0]
-    sigma_rot = position_rotation_noise[1]*deg_to_rad
-    random.seed()
-    with open(path_to_output_file,'w') as file:
+    sigma_rot = position_rotation_noise[1]*(np.pi/180.0)
+    rng = utils.create_random_generator(utils.get_seed(seed), 'pose_noise')
+    is_free = np.array([pose.type == 'free' for pose in poses.values()], dtype = bool)
+    position_noise = np.zeros((len(poses), 3))
+    rotation_vectors = np.zeros((len(poses), 3))
+    (position_noise[is_free], rotation_vectors[is_free]) = utils.generate_pose_noise_batch(int(np.count_nonzero(is_free)), sigma_pos, sigma_rot, rng)
+    positions = np.reshape([pose.position for pose in poses.values()], (-1,3)) + position_noise
+    rotation_matrices = np.reshape([pose.rotation_matrix() for pose in poses.values()], (-1,3,3))@geometry.rotation_vectors_to_matrices(rotation_vectors)
+    return positions, rotation_matrices
+
+def add_noise_to_poses(poses:dict[int,geometry.Pose], position_rotation_noise, seed:int = None):
+    #returns new poses with noise, see get_pose_arrays_with_noise
+    if len(poses) == 0:
+        return {}
+    (positions, rotation_matrices) = get_pose_arrays_with_noise(poses, position_rotation_noise, seed)
+    return dict(zip(poses.keys(), geometry.create_poses(positions.reshape((-1,3,1)), rotation_matrices, [pose.type for pose in poses.values()])))
+
+def save_poses(output_direcotry:str, poses:dict[int,geometry.Pose], position_rotation_noise, seed:int = None):
+    path_to_output_file = os.path.join(output_direcotry, 'poses.txt')
+    with open(path_to_output_file,'w', buffering = text_buffer_size) as file:
         header = 'id,x,y,z,qw,qx,qy,qz,type\n'
         file.write(header)
-        for pose_id, pose in poses.items():
-            noise_position = np.zeros((3,1))
-            noise_rotation = np.eye(3)
-            if sigma_pos > 0.0 and pose.type == 'free':
-                vx = utils.gaussian_noise_with_limit(sigma_pos)
-                vy = utils.gaussian_noise_with_limit(sigma_pos)
-                vz = utils.gaussian_noise_with_limit(sigma_pos)
-                noise_position += np.array([vx, vy, vz]).reshape((3,1))
-            if sigma_rot > 0.0 and pose.type == 'free':
-                noise_rotation = utils.generate_noise_on_so3(sigma_rot)
-            position = pose.position + noise_position
-            rotation = transf.Rotation.from_matrix(pose.rotation.as_matrix()@noise_rotation)          
-            pose_with_noise = geometry.Pose(position, rotation)
-            quat = pose_with_noise.get_rotation_as_wxyz_quaternion()
-            file.write('%d,' % pose_id)
-            file.write('%.4f,%.4f,%.4f,' % (pose_with_noise.position[0,0], pose_with_noise.position[1,0], pose_with_noise.position[2,0]))
-            file.write('%.15f,%.15f,%.15f,%.15f,' % (quat[0], quat[1], quat[2], quat[3]))
-            file.write('%s\n' % pose.type)
+        if len(poses) == 0:
+            return
+        (positions, rotation_matrices) = get_pose_arrays_with_noise(poses, position_rotation_noise, seed)
+        rows = np.column_stack((positions, geometry.matrices_to_quaternions_wxyz(rotation_matrices)))
+        file.write(''.join(['%d,%.4f,%.4f,%.4f,%.15f,%.15f,%.15f,%.15f,%s\n' % ((pose_id,) + tuple(row) + (pose.type,)) for ((pose_id, pose), row) in zip(poses.items(), rows)]))
  
 def save_network_to_dxf(output_direcotry:str, simulator:Simulator, poses:dict[int,geometry.Pose]):
-    path_to_output_file = os.path.join(output_direcotry, 'network.dxf')
-    with open(path_to_output_file,'w') as _:
-        pass
-    initialize_dxf_entities(path_to_output_file)
-    save_poses_to_dxf(path_to_output_file, simulator, poses)
-    save_rays_to_dxf(path_to_output_file, simulator, poses)
-    close_dxf_entities(path_to_output_file)
-    
-def initialize_dxf_entities(dxf_filename:str):
-    with open(dxf_filename,'a') as file:
-        file.write('0\n')
-        file.write('SECTION\n')
-        file.write('2\n')
-        file.write('HEADER\n')
-        file.write('9\n')
-        file.write('$ACADVER\n')
-        file.write('1\n')
-        file.write('AC1009\n')
-        file.write('0\n')
-        file.write('ENDSEC\n')
-        file.write('0\n')
-        file.write('SECTION\n')
-        file.write('2\n')
-        file.write('ENTITIES\n')
-        file.write('0\n')
+    with NetworkDxfWriter(output_direcotry, simulator.config, poses) as writer:
+        for (_, columns) in simulator.feature_store.pose_views():
+            writer.write(columns)
+
+class NetworkDxfWriter:
+    #writes network.dxf in a single pass: poses are written on opening, rays of every written chunk are appended
+    #level of detail: only rays of every config.dxf_ray_decimation-th feature and at most config.max_rays_per_pose_in_dxf rays per pose (0 - no limit)
+    def __init__(self, output_direcotry:str, config:SimulationConfig.Config, poses:dict[int,geometry.Pose]):
+        self.poses = poses
+        self.ray_decimation = config.dxf_ray_decimation
+        self.max_rays_per_pose = config.max_rays_per_pose_in_dxf
+        self.number_of_rays_of_poses = {}
+        self.file = open(os.path.join(output_direcotry, 'network.dxf'), 'w', buffering = dxf_buffer_size)
+        write_dxf_header(self.file)
+        write_poses_to_dxf(self.file, config, poses)
         
-def close_dxf_entities(dxf_filename:str):
-    with open(dxf_filename,'a') as file:
-        file.write('ENDSEC\n')
-        file.write('0\n') 
-                
-def save_poses_to_dxf(dxf_filename:str, simulator:Simulator, poses:dict[int,geometry.Pose]):  
-    with open(dxf_filename,'a') as file:
-        colors_of_the_axes = ['1','3','5']
-        for _,pose in poses.items():
-            axes = simulator.config.axes_length_in_dxf * pose.rotation.as_matrix()
-            for i in range(0,3):
-                file.write('LINE\n')
-                file.write('8\n')
-                file.write('cs\n')
-                file.write('39\n')
-                file.write('4\n')
-                file.write('62\n')
-                file.write('%s\n' % colors_of_the_axes[i])
-                file.write('10\n')
-                file.write('%.5f\n' % (pose.position[0,0]))
-                file.write('20\n')
-                file.write('%.5f\n' % (pose.position[1,0]))
-                file.write('30\n')
-                file.write('%.5f\n' % (pose.position[2,0]))
-                file.write('11\n')
-                file.write('%.5f\n' % (pose.position[0,0] + axes[0,i]))
-                file.write('21\n')
-                file.write('%.5f\n' % (pose.position[1,0] + axes[1,i]))
-                file.write('31\n')
-                file.write('%.5f\n' % (pose.position[2,0] + axes[2,i]))
-                file.write('0\n')
+    def write(self, columns:dict[str,np.ndarray]):
+        position_global = get_global_positions(columns, self.poses)
+        is_drawn = columns['feature_id'] % self.ray_decimation == 0
+        for pose_id in get_pose_ids_of_rows(columns):
+            rows = np.flatnonzero(is_drawn & (columns['pose_id'] == pose_id))
+            if self.max_rays_per_pose > 0:
+                number_of_rays = self.number_of_rays_of_poses.get(pose_id, 0)
+                rows = rows[:max(self.max_rays_per_pose - number_of_rays, 0)]
+                self.number_of_rays_of_poses[pose_id] = number_of_rays + len(rows)
+            starts = np.broadcast_to(self.poses[pose_id].position[:,0], (len(rows), 3))
+            write_dxf_lines(self.file, dxf_ray_template, np.hstack((starts, position_global[rows])))
             
-def save_rays_to_dxf(dxf_filename:str, simulator:Simulator, poses:dict[int,geometry.Pose]):
-    with open(dxf_filename,'a') as file:
-        for pose_id, features in simulator.dict_of_features.items():
-            pose = poses[pose_id]
-            for feature in features:
-                feature_in_world = pose.T()@feature.as_homogenous_vector()
-                file.write('LINE\n')
-                file.write('8\n')
-                file.write('rays\n')
-                file.write('39\n')
-                file.write('4\n')
-                file.write('62\n')
-                file.write('8\n')
-                file.write('10\n')
-                file.write('%.5f\n' % (pose.position[0,0]))
-                file.write('20\n')
-                file.write('%.5f\n' % (pose.position[1,0]))
-                file.write('30\n')
-                file.write('%.5f\n' % (pose.position[2,0]))
-                file.write('11\n')
-                file.write('%.5f\n' % (feature_in_world[0,0]))
-                file.write('21\n')
-                file.write('%.5f\n' % (feature_in_world[1,0]))
-                file.write('31\n')
-                file.write('%.5f\n' % (feature_in_world[2,0]))
-                file.write('0\n')
\ No newline at end of file
+    def close(self):
+        write_dxf_footer(self.file)
+        self.file.close()
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exception):
+        self.close()
+
+dxf_buffer_size = 1 << 20
+dxf_lines_per_block = 10000
+
+def write_dxf_header(file):
+    file.write('0\nSECTION\n2\nHEADER\n9\n$ACADVER\n1\nAC1009\n0\nENDSEC\n0\nSECTION\n2\nENTITIES\n0\n')
+    
+def write_dxf_footer(file):
+    file.write('ENDSEC\n0\n') 
+    
+def get_dxf_line_template(layer:str, color:str):
+    #LINE entity with coordinates of the start and the end point as format fields
+    return 'LINE\n8\n%s\n39\n4\n62\n%s\n10\n%%.5f\n20\n%%.5f\n30\n%%.5f\n11\n%%.5f\n21\n%%.5f\n31\n%%.5f\n0\n' % (layer, color)
+
+dxf_ray_template = get_dxf_line_template('rays', '8')
+dxf_axes_templates = [get_dxf_line_template('cs', color) for color in ('1','3','5')]
+
+def write_dxf_lines(file, template:str, coordinates):
+    #formats the template once for every row of coordinates, in blocks with one formatting call per block
+    for first_line in range(0, len(coordinates), dxf_lines_per_block):
+        block = coordinates[first_line:first_line + dxf_lines_per_block]
+        file.write((template*len(block)) % tuple(block.ravel().tolist()))
+    
+def write_poses_to_dxf(file, config:SimulationConfig.Config, poses:dict[int,geometry.Pose]):
+    if len(poses) == 0:
+        return
+    positions = np.stack([pose.position[:,0] for pose in poses.values()])
+    axes = config.axes_length_in_dxf * np.stack([pose.rotation_matrix() for pose in poses.values()])
+    ends = positions[:,np.newaxis,:] + np.transpose(axes, (0,2,1)) #ends[i,j] is the end of j-th axis of i-th pose
+    coordinates = np.concatenate((np.repeat(positions[:,np.newaxis,:], 3, axis = 1), ends), axis = 2) #start and end of every axis
+    write_dxf_lines(file, ''.join(dxf_axes_templates), coordinates.reshape((-1,18)))
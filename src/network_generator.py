@@ -0,0 +1,152 @@
+import sys
+import getopt
+import numpy as np
+
+import geometry
+import utils
+import input_output as io
+
+layouts = ('grid', 'corridor', 'trajectory')
+graph_types = ('window', 'distance')
+
+def create_poses_from_arrays(positions, yaw_pitch_roll_deg):
+    #poses with ids 1..N, the first pose is fixed like in the sample data
+    number_of_poses = len(positions)
+    rotation_matrices = geometry.euler_zyx_to_matrices(yaw_pitch_roll_deg, True)
+    types = ['fixed'] + ['free']*(number_of_poses - 1)
+    return dict(zip(range(1, number_of_poses + 1), geometry.create_poses(np.reshape(positions, (-1,3,1)), rotation_matrices, types)))
+
+def create_grid_poses(number_of_poses:int, spacing:float, rng:np.random.Generator):
+    #terrestrial survey, stations on a square grid visited line by line (serpentine order), levelled, with random yaw
+    number_of_columns = int(np.ceil(np.sqrt(number_of_poses)))
+    indices = np.arange(number_of_poses)
+    rows = indices//number_of_columns
+    columns = np.where(rows % 2 == 0, indices % number_of_columns, number_of_columns - 1 - indices % number_of_columns)
+    positions = np.column_stack((columns*spacing, rows*spacing, rng.normal(0.0, 0.02*spacing, number_of_poses)))
+    yaw_pitch_roll_deg = np.column_stack((rng.uniform(0.0, 360.0, number_of_poses), rng.normal(0.0, 0.5, (number_of_poses, 2))))
+    return create_poses_from_arrays(positions, yaw_pitch_roll_deg)
+
+def create_corridor_poses(number_of_poses:int, spacing:float, rng:np.random.Generator):
+    #stations along a straight corridor (x axis), alternating between its sides, looking roughly along the corridor
+    positions = np.column_stack((np.arange(number_of_poses)*spacing, np.where(np.arange(number_of_poses) % 2 == 0, -0.25, 0.25)*spacing,
+                                 rng.normal(0.0, 0.02*spacing, number_of_poses)))
+    yaw_pitch_roll_deg = np.column_stack((rng.normal(0.0, 10.0, number_of_poses), rng.normal(0.0, 0.5, (number_of_poses, 2))))
+    return create_poses_from_arrays(positions, yaw_pitch_roll_deg)
+
+def create_trajectory_poses(number_of_poses:int, spacing:float, rng:np.random.Generator):
+    #mobile mapping, poses every spacing meters along a smooth path, the heading is a random walk and the vehicle looks along the path
+    headings_deg = np.cumsum(rng.normal(0.0, 2.0, number_of_poses))
+    headings_deg[0] = 0.0
+    steps = np.column_stack((np.cos(np.radians(headings_deg)), np.sin(np.radians(headings_deg)), rng.normal(0.0, 0.01, number_of_poses)))*spacing
+    steps[0] = 0.0
+    positions = np.cumsum(steps, axis = 0)
+    yaw_pitch_roll_deg = np.column_stack((headings_deg, rng.normal(0.0, 1.0, (number_of_poses, 2))))
+    return create_poses_from_arrays(positions, yaw_pitch_roll_deg)
+
+def get_sliding_window_edges(number_of_poses:int, window_size:int):
+    #pairs of indices of poses at most window_size steps apart, the order of poses is the order of acquisition
+    offsets = np.arange(1, window_size + 1)
+    from_indices = np.repeat(np.arange(number_of_poses), len(offsets))
+    to_indices = from_indices + np.tile(offsets, number_of_poses)
+    is_valid = to_indices < number_of_poses
+    return from_indices[is_valid], to_indices[is_valid]
+
+def get_distance_edges(positions, max_distance:float, max_neighbours:int = 0):
+    #pairs of indices of poses at most max_distance apart found with a KD-tree, with max_neighbours > 0 only the nearest
+    #max_neighbours poses of every pose are connected (a pose can have more edges, if it is among the nearest of other poses)
+    import scipy.spatial #imported only for distance graphs, it is slow to import
+    tree = scipy.spatial.cKDTree(positions)
+    if max_neighbours <= 0:
+        pairs = tree.query_pairs(max_distance, output_type = 'ndarray')
+        return pairs[:,0], pairs[:,1]
+    (_, neighbours) = tree.query(positions, max_neighbours + 1, distance_upper_bound = max_distance)
+    from_indices = np.repeat(np.arange(len(positions)), max_neighbours + 1)
+    to_indices = neighbours.reshape(-1)
+    is_valid = (to_indices < len(positions)) & (to_indices != from_indices) #missing neighbours are marked with len(positions)
+    pairs = np.unique(np.sort(np.column_stack((from_indices[is_valid], to_indices[is_valid])), axis = 1), axis = 0)
+    return pairs[:,0], pairs[:,1]
+
+def create_graph(poses:dict[int,geometry.Pose], graph_type:str, parameter:float, max_neighbours:int = 0):
+    #visibility graph of poses: window - every pose sees the next int(parameter) poses, distance - poses at most parameter meters apart,
+    #poses without edges are nodes of the graph, so validation of the graph reports them
+    pose_ids = np.array(list(poses.keys()), dtype = np.int64)
+    if graph_type == 'window':
+        (from_indices, to_indices) = get_sliding_window_edges(len(pose_ids), int(parameter))
+    else:
+        positions = np.reshape([pose.position for pose in poses.values()], (-1,3))
+        (from_indices, to_indices) = get_distance_edges(positions, parameter, max_neighbours)
+    return geometry.SimpleVisibilityGraph.from_edge_arrays(pose_ids[from_indices], pose_ids[to_indices], pose_ids.tolist())
+
+def parse_network(network:str):
+    #layout:number_of_poses[:spacing], e.g. trajectory:100000:2.0, spacing is 1 m by default
+    fields = network.split(':')
+    if not fields[0] in layouts or not len(fields) in (2, 3):
+        raise ValueError(f'Error! Network \'{network}\' is not layout:number_of_poses[:spacing] with layout {", ".join(layouts)}.')
+    (number_of_poses, spacing) = (int(fields[1]), float(fields[2]) if len(fields) == 3 else 1.0)
+    if number_of_poses < 2 or spacing <= 0.0:
+        raise ValueError(f'Error! Network \'{network}\' needs at least 2 poses and positive spacing.')
+    return fields[0], number_of_poses, spacing
+
+def parse_graph(graph:str):
+    #window:size or distance:max_distance[:max_neighbours]
+    fields = graph.split(':')
+    if not fields[0] in graph_types or not len(fields) in ((2,) if fields[0] == 'window' else (2, 3)):
+        raise ValueError(f'Error! Graph \'{graph}\' is not window:size or distance:max_distance[:max_neighbours].')
+    (parameter, max_neighbours) = (float(fields[1]), int(fields[2]) if len(fields) == 3 else 0)
+    if parameter <= 0.0 or (fields[0] == 'window' and parameter != int(parameter)) or max_neighbours < 0:
+        raise ValueError(f'Error! Graph \'{graph}\' needs a positive integer window size or a positive distance.')
+    return fields[0], parameter, max_neighbours
+
+def create_network(network:str, graph:str, seed:int):
+    #poses and visibility graph from descriptions accepted by parse_network and parse_graph, positions are drawn from the network stream of seed
+    (layout, number_of_poses, spacing) = parse_network(network)
+    (graph_type, parameter, max_neighbours) = parse_graph(graph)
+    rng = utils.create_random_generator(seed, 'network')
+    create_poses = {'grid': create_grid_poses, 'corridor': create_corridor_poses, 'trajectory': create_trajectory_poses}[layout]
+    poses = create_poses(number_of_poses, spacing, rng)
+    return poses, create_graph(poses, graph_type, parameter, max_neighbours)
+
+def main():
+    network = ''
+    graph = 'window:4'
+    seed = None
+    path_file_poses = ''
+    path_file_graph = ''
+    try:
+      opts, args = getopt.getopt(sys.argv[1:],'n:g:p:e:',['network=', 'graph=', 'poses=', 'edges=', 'seed='])
+      for opt, arg in opts:
+        if opt in ('-n', '--network'):
+           network = arg
+        elif opt in ('-g', '--graph'):
+           graph = arg
+        elif opt in ('-p', '--poses'):
+           path_file_poses = arg
+        elif opt in ('-e', '--edges'):
+           path_file_graph = arg
+        elif opt == '--seed':
+           seed = int(arg)
+      parse_network(network)
+      parse_graph(graph)
+    except (getopt.GetoptError, ValueError):
+      print ('error while parsing command line arguments')
+      print ('-n, --network : layout:number_of_poses[:spacing], layout grid, corridor or trajectory, spacing of poses in meters (default 1)')
+      print ('-g, --graph : window:size (every pose sees the next size poses, default window:4) or distance:max_distance[:max_neighbours]')
+      print ('-p, --poses : path to output file with poses, .txt or .npz')
+      print ('-e, --edges : path to output file with graph edges, .txt or .npz')
+      print ('--seed : non-negative integer seed of the network (a new random seed if not given)')
+      sys.exit(2)
+
+    if path_file_poses == '' or path_file_graph == '':
+       print('Paths of output files of poses and graph edges are required!')
+       sys.exit(2)
+    seed = utils.get_seed(seed)
+    (poses, visibility_graph) = create_network(network, graph, seed)
+    number_of_components = len(visibility_graph.get_connected_components())
+    (io.save_poses_npz if path_file_poses.endswith('.npz') else io.save_poses_text)(path_file_poses, poses)
+    (io.save_graph_npz if path_file_graph.endswith('.npz') else io.save_graph_text)(path_file_graph, visibility_graph)
+    print(f'Created {len(poses)} poses and {len(visibility_graph.edges)} edges with seed {seed}, saved to {path_file_poses} and {path_file_graph}.')
+    if number_of_components > 1:
+       print(f'Warning! The graph consists of {number_of_components} connected components, the simulator does not accept it.')
+
+if __name__ == '__main__':
+   main()
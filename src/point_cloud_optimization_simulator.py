@@ -4,15 +4,38 @@ import getopt
 
 import SimulationConfig
 import Simulator
+import Profiler
+import utils
 import input_output as io
+#ResultCache, SimulationState and network_generator (and scipy, see geometry) are imported only by runs which use them, so small runs start faster
 
 def main():
     path_file_config_xml = ''
     path_file_poses = ''
     path_file_graph = ''
     path_directory_output = ''
+    feature_generation_engine = ''
+    output_format = ''
+    use_streaming = False
+    number_of_workers = 0
+    seed = None
+    dxf_ray_decimation = None
+    max_rays_per_pose_in_dxf = None
+    use_profiler = False
+    profiler_capture_modes = []
+    cache_directory = None
+    cache_size_limit_mb = None
+    bypass_cache = False
+    visibility_mode = ''
+    path_state = None
+    export_problem_structure = False
+    network = None
+    network_graph = 'window:4'
+    memory_budget_mb = None
+    scratch_directory = None
+    number_of_writer_threads = None
     try:
-      opts, args = getopt.getopt(sys.argv[1:],'c:p:g:o:',['config=','poses=', 'graph=', 'output='])
+      opts, args = getopt.getopt(sys.argv[1:],'c:p:g:o:e:f:sw:',['config=','poses=', 'graph=', 'output=', 'engine=', 'output-format=', 'streaming', 'workers=', 'seed=', 'dxf-ray-decimation=', 'dxf-max-rays-per-pose=', 'profile', 'profile-capture=', 'cache-dir=', 'cache-size-mb=', 'no-cache', 'visibility=', 'state=', 'problem-structure', 'network=', 'network-graph=', 'memory-budget-mb=', 'scratch-dir=', 'writer-threads='])
     except:
       print ('error while parsing command line arguments')
       print ('you need to provid all 4 arguments:')
@@ -20,6 +43,27 @@ def main():
       print ('-p, --poses : path to textfile with poses')
       print ('-g, --graph : path to textfile with graph edges')
       print ('-o, --output : path to output directory, where the results will be saved')
+      print ('optional arguments:')
+      print ('-e, --engine : feature generation engine, legacy or batch (overrides the config file)')
+      print ('-f, --output-format : format of measurements and feature data, text, npy or npz (overrides the config file)')
+      print ('-s, --streaming : write results while simulating, one reference pose at a time (batch engine only)')
+      print ('-w, --workers : number of processes simulating reference poses in parallel (batch engine only, overrides the config file)')
+      print ('--visibility : random or geometric, geometric matches only features within range and vertical angle limits of query poses (batch engine only, overrides the config file)')
+      print ('--seed : non-negative integer seed of all random streams, makes the run reproducible (overrides the config file)')
+      print ('--dxf-ray-decimation : only rays of every n-th feature are written to network.dxf (overrides the config file)')
+      print ('--dxf-max-rays-per-pose : maximal number of rays of a pose in network.dxf, 0 - no limit (overrides the config file)')
+      print ('--profile : save times of stages, counters and sizes of written files to profile.json in the output directory')
+      print ('--profile-capture : comma separated deep profiling modes, cprofile and/or tracemalloc (implies --profile)')
+      print ('--cache-dir : directory of the cache of results, identical runs restore their outputs from it (overrides the config file)')
+      print ('--cache-size-mb : size limit of the cache, least recently used results are removed above it (overrides the config file)')
+      print ('--no-cache : always simulate, the cache is neither read nor updated')
+      print ('--problem-structure : save sparsity structure of the optimization problem to problem_structure.npz (not available with streaming)')
+      print ('--state : directory with the state of the previous run, only reference poses with changed poses or edges are simulated again, the state is updated, the cache is not read with a state (batch engine only)')
+      print ('--network : layout:number_of_poses[:spacing], simulates a generated network of poses (grid, corridor or trajectory) instead of -p and -g')
+      print ('--network-graph : visibility graph of the generated network, window:size (default window:4) or distance:max_distance[:max_neighbours]')
+      print ('--memory-budget-mb : observations above this size are spilled to scratch files and merged into the outputs, 0 - all in memory (batch engine only, overrides the config file)')
+      print ('--scratch-dir : directory of the scratch files of --memory-budget-mb, the temporary directory of the system by default (overrides the config file)')
+      print ('--writer-threads : number of threads writing output files concurrently, 1 - one file after another (overrides the config file)')
       sys.exit(2)
     for opt, arg in opts:
       if opt in ('-c', '--config'):
@@ -30,6 +74,46 @@ def main():
          path_file_graph = arg
       elif opt in ('-o', '--output'):
          path_directory_output = arg
+      elif opt in ('-e', '--engine'):
+         feature_generation_engine = arg
+      elif opt in ('-f', '--output-format'):
+         output_format = arg
+      elif opt in ('-s', '--streaming'):
+         use_streaming = True
+      elif opt in ('-w', '--workers'):
+         number_of_workers = int(arg)
+      elif opt == '--seed':
+         seed = int(arg)
+      elif opt == '--dxf-ray-decimation':
+         dxf_ray_decimation = int(arg)
+      elif opt == '--dxf-max-rays-per-pose':
+         max_rays_per_pose_in_dxf = int(arg)
+      elif opt == '--profile':
+         use_profiler = True
+      elif opt == '--profile-capture':
+         profiler_capture_modes = [mode.strip() for mode in arg.split(',') if mode.strip() != '']
+      elif opt == '--cache-dir':
+         cache_directory = arg
+      elif opt == '--cache-size-mb':
+         cache_size_limit_mb = float(arg)
+      elif opt == '--no-cache':
+         bypass_cache = True
+      elif opt == '--visibility':
+         visibility_mode = arg
+      elif opt == '--state':
+         path_state = arg
+      elif opt == '--problem-structure':
+         export_problem_structure = True
+      elif opt == '--network':
+         network = arg
+      elif opt == '--network-graph':
+         network_graph = arg
+      elif opt == '--memory-budget-mb':
+         memory_budget_mb = float(arg)
+      elif opt == '--scratch-dir':
+         scratch_directory = arg
+      elif opt == '--writer-threads':
+         number_of_writer_threads = int(arg)
       else:
          assert False, 'unhandled option'
          
@@ -37,11 +121,20 @@ def main():
        print('Config xml file does not exist!')
        sys.exit(2)
        
-    if not os.path.exists(path_file_poses):
+    if network is not None:
+       import network_generator
+       try:
+          network_generator.parse_network(network)
+          network_generator.parse_graph(network_graph)
+       except ValueError as error:
+          print(error)
+          sys.exit(2)
+    
+    if network is None and not os.path.exists(path_file_poses):
        print('Poses file does not exist!')
        sys.exit(2)
     
-    if not os.path.exists(path_file_graph):
+    if network is None and not os.path.exists(path_file_graph):
        print('Graph file does not exist!')
        sys.exit(2)
        
@@ -49,35 +142,210 @@ def main():
        print('Output directory does not exist!')
        sys.exit(2)
        
-    config = SimulationConfig.Config()    
-    config.read_from_xml(path_file_config_xml)
+    if not all(mode in Profiler.capture_modes for mode in profiler_capture_modes):
+       print(f'Unknown profiling mode, available modes: {", ".join(Profiler.capture_modes)}!')
+       sys.exit(2)
+       
+    profiler = Profiler.Profiler(use_profiler, profiler_capture_modes)
+    profiler.start()
     
-    poses = io.read_poses(path_file_poses)
-    visibility_graph = io.read_graph(path_file_graph)
+    with profiler.stage('load_config'):
+       config = SimulationConfig.Config()    
+       config.read_from_xml(path_file_config_xml)
     
-    #checking if all poses are represented by nodes in the visibilit graph
-    set_of_pose_ids = set()
-    for pose_id in poses.keys():
-       set_of_pose_ids.add(pose_id)
-    assert set_of_pose_ids == visibility_graph.nodes, 'Error while checking visibility graph! ids of poses must match nodes in visibility graph!'
+    if feature_generation_engine != '':
+       if not feature_generation_engine in SimulationConfig.feature_generation_engines:
+          print(f'Unknown feature generation engine: {feature_generation_engine}!')
+          sys.exit(2)
+       config.feature_generation_engine = feature_generation_engine
+    
+    if output_format != '':
+       if not output_format in SimulationConfig.output_formats:
+          print(f'Unknown output format: {output_format}!')
+          sys.exit(2)
+       config.output_format = output_format
+       
+    if visibility_mode != '':
+       if not visibility_mode in SimulationConfig.visibility_modes:
+          print(f'Unknown visibility mode: {visibility_mode}!')
+          sys.exit(2)
+       config.visibility_mode = visibility_mode
+       
+    if config.visibility_mode == 'geometric' and config.feature_generation_engine != 'batch':
+       print('Geometric visibility is available only for the batch engine!')
+       sys.exit(2)
+       
+    if use_streaming:
+       config.use_streaming = True
+       
+    if config.use_streaming and config.feature_generation_engine != 'batch':
+       print('Streaming is available only for the batch engine!')
+       sys.exit(2)
+       
+    if export_problem_structure:
+       config.export_problem_structure = True
+       
+    if config.use_streaming and config.export_problem_structure:
+       print('Problem structure can not be exported with streaming!')
+       sys.exit(2)
+       
+    if memory_budget_mb is not None:
+       config.memory_budget_mb = memory_budget_mb
+       
+    if scratch_directory is not None:
+       config.scratch_directory = scratch_directory
+       
+    if config.memory_budget_mb < 0.0 or (config.memory_budget_mb > 0.0 and (config.feature_generation_engine != 'batch' or config.export_problem_structure)):
+       print('Memory budget must not be negative and out-of-core simulation is available only for the batch engine, without problem structure!')
+       sys.exit(2)
+       
+    if number_of_writer_threads is not None:
+       config.number_of_writer_threads = number_of_writer_threads
+       
+    if config.number_of_writer_threads < 1:
+       print('Number of writer threads must be positive!')
+       sys.exit(2)
+       
+    if seed is not None:
+       if seed < 0:
+          print('Seed must be a non-negative integer!')
+          sys.exit(2)
+       config.seed = seed
+       
+    if dxf_ray_decimation is not None:
+       config.dxf_ray_decimation = dxf_ray_decimation
+       
+    if max_rays_per_pose_in_dxf is not None:
+       config.max_rays_per_pose_in_dxf = max_rays_per_pose_in_dxf
+       
+    if config.dxf_ray_decimation < 1 or config.max_rays_per_pose_in_dxf < 0:
+       print('Ray decimation must be positive and maximal number of rays per pose must not be negative!')
+       sys.exit(2)
+       
+    if cache_directory is not None:
+       config.cache_directory = cache_directory
+       
+    if cache_size_limit_mb is not None:
+       config.cache_size_limit_mb = cache_size_limit_mb
+       
+    if config.cache_size_limit_mb < 0.0:
+       print('Size limit of the cache must not be negative!')
+       sys.exit(2)
+       
+    if number_of_workers != 0:
+       config.number_of_workers = number_of_workers
+       
+    if config.number_of_workers < 1 or (config.number_of_workers > 1 and config.feature_generation_engine != 'batch'):
+       print('Number of workers must be positive and parallel simulation is available only for the batch engine!')
+       sys.exit(2)
+    
+    if path_state is not None and config.feature_generation_engine != 'batch':
+       print('Incremental simulation with a state is available only for the batch engine!')
+       sys.exit(2)
+       
+    previous_state = None
+    if path_state is not None:
+       import SimulationState
+    if path_state is not None and os.path.exists(path_state):
+       with profiler.stage('load_state'):
+          previous_state = SimulationState.SimulationState(path_state)
+       if config.seed is None: #the seed of the previous run, otherwise nothing could be reused
+          config.seed = previous_state.seed
+    
+    if network is not None:
+       config.seed = utils.get_seed(config.seed) #the network and the simulation share the seed, so the run can be repeated
+       with profiler.stage('generate_network'):
+          (poses, visibility_graph) = network_generator.create_network(network, network_graph, config.seed)
+    else:
+       with profiler.stage('load_poses'):
+          poses = io.read_poses(path_file_poses)
+       with profiler.stage('load_graph'):
+          visibility_graph = io.read_graph(path_file_graph)
+    
+    with profiler.stage('graph_validation'):
+       #checking if all poses are represented by nodes in the visibilit graph
+       set_of_pose_ids = set()
+       for pose_id in poses.keys():
+          set_of_pose_ids.add(pose_id)
+       assert set_of_pose_ids == visibility_graph.nodes, 'Error while checking visibility graph! ids of poses must match nodes in visibility graph!'
+       connected_components = visibility_graph.get_connected_components()
     
     print(f'Created visibility graph with {len(visibility_graph.nodes)} nodes and {len(visibility_graph.edges)} edges.')
 
-    uconnected_nodes = visibility_graph.verify_node_connections()
-
-    if len(uconnected_nodes) != 0:
+    if len(connected_components) > 1:
+       uconnected_nodes = visibility_graph.nodes.difference(connected_components[0])
        print('Visibility graph is invalid!')
        print(f'{len(uconnected_nodes)} nodes of the graph are not connected.')
+       print(f'The graph consists of {len(connected_components)} connected components:')
+       for component in connected_components:
+          print(f'{len(component)} nodes: {sorted(component)}')
        print('Exiting.')
        sys.exit(2)
        
     simulator = Simulator.Simulator(config)
-    print
-    simulator.run_simulations(poses, visibility_graph)
-    io.save_features(path_directory_output, simulator)
-    io.save_all_feature_data(path_directory_output, simulator, poses)
-    io.save_network_to_dxf(path_directory_output, simulator, poses)
-    io.save_poses(path_directory_output, poses, (config.pose_noise_position, config.pose_noise_rotation_deg))
+    print(f'Using random seed {simulator.seed}.')
+    output_paths = io.get_output_paths(path_directory_output, config.output_format, config.export_problem_structure)
+    result_cache = None
+    restored_from_cache = False
+    if config.cache_directory is not None and not bypass_cache:
+       import ResultCache
+       with profiler.stage('cache_lookup'):
+          result_cache = ResultCache.ResultCache(config.cache_directory, int(config.cache_size_limit_mb*2**20))
+          cache_key = ResultCache.get_cache_key(poses, visibility_graph, config, simulator.seed)
+          #with a state the cache is only updated, restored outputs would leave the state of the previous run behind,
+          #reference poses which did not change are read from the state anyway
+          restored_from_cache = path_state is None and result_cache.restore(cache_key, output_paths)
+       if restored_from_cache:
+          print(f'Results restored from cache {config.cache_directory}.')
+          
+    if not restored_from_cache:
+       io.remove_outputs(path_directory_output, config.output_format)
+       if path_state is not None:
+          simulator.previous_state = previous_state
+          simulator.state_writer = SimulationState.SimulationStateWriter(path_state, config, simulator.seed, list(poses.keys()))
+       if config.use_streaming:
+          with profiler.stage('simulation_and_saving_streaming'):
+             try:
+                io.save_simulation_streaming(path_directory_output, simulator, poses, visibility_graph, config.output_format)
+             except OSError as error:
+                print(error)
+                print('Exiting.')
+                sys.exit(2)
+          with profiler.stage('save_poses'):
+             io.save_poses(path_directory_output, poses, (config.pose_noise_position, config.pose_noise_rotation_deg), simulator.seed)
+       else:
+          with profiler.stage('simulation'):
+             simulator.run_simulations(poses, visibility_graph)
+          with profiler.stage('save_outputs'):
+             writer_results = io.run_writers(io.get_output_writers(path_directory_output, simulator, poses, config.output_format), config.number_of_writer_threads)
+          simulator.feature_store.close() #removes scratch files of out-of-core simulation
+          profiler.add_stage_times({name: result['time_s'] for (name, result) in writer_results.items()})
+          for (name, result) in writer_results.items():
+             print(f"{name} {'failed' if result['error'] is not None else 'finished'} in {result['time_s']:.2f} s.")
+          failed_writers = [name for (name, result) in writer_results.items() if result['error'] is not None]
+          if len(failed_writers) > 0:
+             for name in failed_writers:
+                print(f'Error in {name}:')
+                print(writer_results[name]['error'])
+             print('Exiting.')
+             sys.exit(2)
+       if simulator.state_writer is not None:
+          with profiler.stage('save_state'):
+             if previous_state is not None:
+                previous_state.close()
+             simulator.state_writer.close()
+          print(f"Reused observations of {simulator.statistics['reference_poses_reused']} of {len(poses)} reference poses, state saved to {path_state}.")
+       if result_cache is not None:
+          with profiler.stage('cache_store'):
+             result_cache.store(cache_key, output_paths)
+    
+    profiler.stop()
+    if profiler.enabled:
+       profiler.add_counters({'poses': len(poses), 'edges': len(visibility_graph.edges), 'cache_hits': int(restored_from_cache)})
+       profiler.add_counters(simulator.statistics)
+       profiler.record_file_sizes(io.get_output_paths(path_directory_output, config.output_format, config.export_problem_structure))
+       profiler.save_report(os.path.join(path_directory_output, 'profile.json'))
+       print(f'Profile saved to {os.path.join(path_directory_output, "profile.json")}.')
 
 if __name__ == '__main__':
    main()
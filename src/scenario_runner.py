@@ -0,0 +1,151 @@
+import sys
+import os
+import getopt
+import json
+import time
+import traceback
+import concurrent.futures
+
+import SimulationConfig
+import Simulator
+import geometry
+import utils
+import input_output as io
+
+network_state = None #poses and graph shared by all scenarios of a process, loaded and validated once
+
+def initialize_network(poses:dict[int,geometry.Pose], graph:geometry.SimpleVisibilityGraph):
+    #relative transformations are computed once per process, poses cache them, so every scenario only looks them up
+    global network_state
+    geometry.get_table_of_relative_transformations(poses, graph.adjacency)
+    network_state = (poses, graph)
+
+def read_manifest(file_name:str):
+    #text file with header and rows: config,seed,output, paths are relative to the directory of the manifest,
+    #empty seed means a new random seed, returns list of (config, seed, output directory)
+    data, line_numbers = io.read_text_table(file_name, 3)
+    manifest_directory = os.path.dirname(os.path.abspath(file_name))
+    scenarios = []
+    for (row, line_number) in zip(data, line_numbers):
+        (path_file_config_xml, seed, path_directory_output) = row.tolist()
+        path_file_config_xml = os.path.join(manifest_directory, path_file_config_xml)
+        if not os.path.exists(path_file_config_xml):
+            raise ValueError(f'Error! Line {line_number} of {file_name}: config xml file {path_file_config_xml} does not exist.')
+        if seed != '' and (not seed.isdigit()):
+            raise ValueError(f'Error! Line {line_number} of {file_name}: seed \'{seed}\' is not a non-negative integer.')
+        if path_directory_output == '':
+            raise ValueError(f'Error! Line {line_number} of {file_name}: output directory is missing.')
+        config = SimulationConfig.Config()
+        config.read_from_xml(path_file_config_xml)
+        scenarios.append((config, utils.get_seed(int(seed) if seed != '' else config.seed), os.path.join(manifest_directory, path_directory_output)))
+    return scenarios
+
+def run_scenario(config:SimulationConfig.Config, seed:int, path_directory_output:str):
+    #simulates one scenario with the shared network and writes its outputs, errors are reported in the result instead of being raised
+    (poses, graph) = network_state
+    result = {'seed': seed, 'output': path_directory_output, 'status': 'ok', 'error': None}
+    start = time.perf_counter()
+    simulator = None
+    try:
+        os.makedirs(path_directory_output, exist_ok = True)
+        io.remove_outputs(path_directory_output, config.output_format)
+        simulator = Simulator.Simulator(config, seed)
+        if config.use_streaming:
+            io.save_simulation_streaming(path_directory_output, simulator, poses, graph, config.output_format)
+            io.save_poses(path_directory_output, poses, (config.pose_noise_position, config.pose_noise_rotation_deg), simulator.seed)
+        else:
+            simulator.run_simulations(poses, graph)
+            writer_results = io.run_writers(io.get_output_writers(path_directory_output, simulator, poses, config.output_format), config.number_of_writer_threads)
+            errors = [result['error'] for result in writer_results.values() if result['error'] is not None]
+            if len(errors) > 0:
+                raise OSError('Error! Writing outputs failed:\n' + '\n'.join(errors))
+        result['observations'] = int(simulator.statistics['observations'])
+        result['features'] = int(simulator.statistics['features_generated'] - simulator.statistics['features_not_matched'])
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    finally:
+        if simulator is not None: #removes scratch files of out-of-core simulation
+            simulator.feature_store.close()
+    result['time_s'] = time.perf_counter() - start
+    return result
+
+def run_scenarios(poses:dict[int,geometry.Pose], graph:geometry.SimpleVisibilityGraph, scenarios:list[tuple], number_of_workers:int = 1):
+    #returns results of scenarios in the order of the manifest, with more than one worker every worker loads the network once
+    #and scenarios are simulated with one process each (number_of_workers of their configs is ignored)
+    if number_of_workers <= 1:
+        initialize_network(poses, graph)
+        return [run_scenario(config, seed, path_directory_output) for (config, seed, path_directory_output) in scenarios]
+    for (config, _, _) in scenarios:
+        config.number_of_workers = 1
+    with concurrent.futures.ProcessPoolExecutor(number_of_workers, initializer = initialize_network, initargs = (poses, graph)) as executor:
+        futures = [executor.submit(run_scenario, config, seed, path_directory_output) for (config, seed, path_directory_output) in scenarios]
+        return [future.result() for future in futures]
+
+def main():
+    path_file_poses = ''
+    path_file_graph = ''
+    path_file_manifest = ''
+    path_file_summary = ''
+    number_of_workers = 1
+    try:
+      opts, args = getopt.getopt(sys.argv[1:],'p:g:m:s:w:',['poses=', 'graph=', 'manifest=', 'summary=', 'workers='])
+      for opt, arg in opts:
+        if opt in ('-p', '--poses'):
+           path_file_poses = arg
+        elif opt in ('-g', '--graph'):
+           path_file_graph = arg
+        elif opt in ('-m', '--manifest'):
+           path_file_manifest = arg
+        elif opt in ('-s', '--summary'):
+           path_file_summary = arg
+        elif opt in ('-w', '--workers'):
+           number_of_workers = int(arg)
+    except (getopt.GetoptError, ValueError):
+      print ('error while parsing command line arguments')
+      print ('-p, --poses : path to file with poses')
+      print ('-g, --graph : path to file with graph edges')
+      print ('-m, --manifest : path to text file with scenarios, rows: config,seed,output (relative to the manifest, seed can be empty)')
+      print ('-s, --summary : path to json summary of all scenarios (default: summary.json next to the manifest)')
+      print ('-w, --workers : number of processes simulating scenarios in parallel (default 1)')
+      sys.exit(2)
+
+    for (path, name) in ((path_file_poses, 'Poses file'), (path_file_graph, 'Graph file'), (path_file_manifest, 'Manifest file')):
+       if not os.path.exists(path):
+          print(f'{name} does not exist!')
+          sys.exit(2)
+    if number_of_workers < 1:
+       print('Number of workers must be positive!')
+       sys.exit(2)
+    if path_file_summary == '':
+       path_file_summary = os.path.join(os.path.dirname(os.path.abspath(path_file_manifest)), 'summary.json')
+
+    start = time.perf_counter()
+    scenarios = read_manifest(path_file_manifest)
+    poses = io.read_poses(path_file_poses)
+    visibility_graph = io.read_graph(path_file_graph)
+    assert set(poses.keys()) == visibility_graph.nodes, 'Error while checking visibility graph! ids of poses must match nodes in visibility graph!'
+    if len(visibility_graph.get_connected_components()) > 1:
+       print('Visibility graph is invalid! Not all nodes are connected.')
+       sys.exit(2)
+    preprocessing_time = time.perf_counter() - start
+    print(f'Loaded {len(scenarios)} scenarios, {len(poses)} poses and {len(visibility_graph.edges)} edges.')
+
+    results = run_scenarios(poses, visibility_graph, scenarios, number_of_workers)
+    for (index, result) in enumerate(results):
+       result['scenario'] = index + 1
+       print(f"scenario {index + 1}: {result['status']}, seed {result['seed']}, {result['time_s']:.3f} s, output {result['output']}")
+       if result['error'] is not None:
+          print(result['error'])
+    number_of_failed_scenarios = sum(result['status'] != 'ok' for result in results)
+    summary = {'poses': path_file_poses, 'graph': path_file_graph, 'manifest': path_file_manifest, 'number_of_workers': number_of_workers,
+               'preprocessing_time_s': preprocessing_time, 'total_time_s': time.perf_counter() - start,
+               'number_of_scenarios': len(results), 'number_of_failed_scenarios': number_of_failed_scenarios, 'scenarios': results}
+    with open(path_file_summary, 'w') as file:
+        json.dump(summary, file, indent = 2)
+    print(f'{len(results) - number_of_failed_scenarios} of {len(results)} scenarios succeeded, summary saved to {path_file_summary}.')
+    if number_of_failed_scenarios > 0:
+       sys.exit(1)
+
+if __name__ == '__main__':
+   main()
@@ -1,6 +1,24 @@
 import geometry as geo
 import numpy as np
 import utils as utils
+import SimulationConfig
+import Simulator
+import FeatureStore
+import input_output as io
+import scipy.spatial.transform as transf
+import scipy.sparse
+import tempfile
+import os
+import json
+import sys
+import pickle
+import subprocess
+import benchmark
+import Profiler
+import scenario_runner
+import ResultCache
+import SimulationState
+import network_generator
 
 nodes_ids = {1,2,3,4,5,6}
 nodes_ids_2 = {1,2,3,4,5,6,1}
@@ -35,16 +53,23 @@ unconnected_apples = graph_apples.verify_node_connections()
 print("unconnected_apples:", unconnected_apples)
 assert unconnected_apples == {6,7,8,9} or unconnected_apples == {1,2,3,4,5}
 
+components_of_apples = graph_apples.get_connected_components()
+assert len(components_of_apples) == 2
+assert {1,2,3,4,5} in components_of_apples and {6,7,8,9} in components_of_apples
+assert graph_apples.adjacency[1] == {2,3,4,5}
+assert graph_apples.adjacency[9] == {6,8}
+assert len(graph_banana.get_connected_components()) == 1
+
 print("testing coordiante conversions")
 
 
-polar_coords = [(4.5, 0.4, np.pi/6),
+polar_coords_list = [(4.5, 0.4, np.pi/6),
 (4.5, -0.4, np.pi/6),
 (4.5, 0.0, np.pi/6),
 (4.5, 0.4, 0.01),
 (4.5, 0.0, 0.01)]
 
-for p in polar_coords:  
+for p in polar_coords_list:  
     cart_coords = geo.spherical_to_cartesian(p[0], p[1], p[2])
     polar_coords = geo.cartesian_to_spherical(cart_coords[0], cart_coords[1], cart_coords[2])
     for i in (0,1,2):
@@ -73,6 +98,726 @@ assert(abs(jacobian[2,0]) < 1e-13)
 assert(abs(jacobian[2,1]) < 1e-13)
 assert(jacobian[2,2] < -1e-13)
 
-#TODO: test Pose class
+print ('testing vectorized jacobians and covariance propagation...')
+
+slant_distances = np.array([p[0] for p in polar_coords_list])
+horizontal_angles = np.array([p[1] for p in polar_coords_list])
+vertical_angles = np.array([p[2] for p in polar_coords_list])
+jacobians = geo.get_jacobians_of_mapping_to_cartesian_coordinates(slant_distances, horizontal_angles, vertical_angles)
+measurement_covariance = np.diag([0.003**2, 1e-8, 2e-8])
+covariances = geo.propagate_covariance(jacobians, measurement_covariance)
+for i, p in enumerate(polar_coords_list):
+    jacobian = geo.get_jacobian_of_mapping_to_cartesian_coordinates(p[0], p[1], p[2])
+    assert np.allclose(jacobians[i], jacobian, rtol = 0, atol = 1e-15)
+    assert np.allclose(covariances[i], jacobian@measurement_covariance@np.transpose(jacobian), rtol = 1e-12, atol = 1e-20)
+
+print ('testing closed form covariances...')
+
+covariances_closed_form = geo.get_covariances_of_cartesian_coordinates(slant_distances, horizontal_angles, vertical_angles, np.diag(measurement_covariance))
+assert np.allclose(covariances_closed_form, covariances, rtol = 1e-10, atol = 1e-20)
+points = np.column_stack(geo.spherical_to_cartesian(slant_distances, horizontal_angles, vertical_angles))
+assert np.allclose(geo.get_covariances_of_points(points, np.diag(measurement_covariance)), covariances, rtol = 1e-10, atol = 1e-20)
+covariances_float32 = geo.get_covariances_of_points(points, np.diag(measurement_covariance), np.float32)
+assert covariances_float32.dtype == np.float32
+assert np.allclose(covariances_float32, covariances, rtol = 1e-4, atol = 1e-12)
+point_on_vertical_axis = np.array([[0.0, 0.0, 2.0]])
+jacobian = geo.get_jacobian_of_mapping_to_cartesian_coordinates(2.0, 0.0, 0.0)
+assert np.allclose(geo.get_covariances_of_points(point_on_vertical_axis, np.diag(measurement_covariance))[0], jacobian@measurement_covariance@jacobian.T, rtol = 1e-10, atol = 1e-20)
+scalar_covariance = geo.get_covariances_of_cartesian_coordinates(4.5, 0.4, np.pi/6, np.diag(measurement_covariance))
+assert scalar_covariance.shape == (3,3) and np.allclose(scalar_covariance, covariances[0], rtol = 1e-10, atol = 1e-20)
+
+print ('testing batched noise...')
+
+rng = np.random.default_rng(3)
+covariance = np.array([[4.0, 1.0, 0.5], [1.0, 2.0, 0.3], [0.5, 0.3, 1.0]])*1e-4
+singular_covariance = np.diag([1e-4, 0.0, 4e-4])
+samples = utils.multivariate_gaussian_noise_with_limit(np.stack([covariance]*100000), rng)
+assert np.allclose(np.cov(samples.T), covariance, rtol = 0.03, atol = 1e-6)
+samples = utils.multivariate_gaussian_noise_with_limit(np.stack([covariance, singular_covariance]*50000), rng)
+assert np.allclose(np.cov(samples[1::2].T), singular_covariance, rtol = 0.03, atol = 1e-6)
+samples = utils.gaussian_noise_with_limit_batch(0.01, (100000, 3), rng)
+assert np.all(np.abs(samples) <= 0.07)
+assert abs(np.std(samples) - 0.01) < 0.0002
+
+print ('testing Pose class and its cache of transformations...')
+
+pose_a = geo.Pose(np.array([1.0, 2.0, 3.0]).reshape((3,1)), transf.Rotation.from_euler('ZYX', [30.0, 5.0, -2.0], True))
+pose_b = geo.Pose(np.array([-1.0, 0.5, 0.2]).reshape((3,1)), transf.Rotation.from_euler('ZYX', [120.0, -1.0, 3.0], True))
+assert np.allclose(pose_a.T()@pose_a.T_inv(), np.eye(4))
+assert pose_a.T() is pose_a.T() #cached
+assert np.allclose(pose_a.relative_transformation(pose_b), pose_a.T_inv()@pose_b.T())
+relative_transformation = pose_a.relative_transformation(pose_b)
+assert pose_a.relative_transformation(pose_b) is relative_transformation
+pose_b.set_position(np.array([4.0, 0.0, 0.0]).reshape((3,1))) #cache of pose_a must notice that pose_b changed
+assert pose_a.relative_transformation(pose_b) is not relative_transformation
+assert np.allclose(pose_a.relative_transformation(pose_b), pose_a.T_inv()@pose_b.T())
+pose_a.set_rotation_from_euler([0.1, 0.2, 0.3])
+assert np.allclose(pose_a.rotation_matrix(), transf.Rotation.from_euler('ZYX', [0.1, 0.2, 0.3]).as_matrix())
+assert np.allclose(pose_a.relative_transformation(pose_b), np.linalg.inv(pose_a.T())@pose_b.T())
+
+print ('testing rotations without scipy...')
+
+rng = np.random.default_rng(4)
+test_angles = np.column_stack((rng.uniform(-180.0, 180.0, 1000), rng.uniform(-90.0, 90.0, 1000), rng.uniform(-180.0, 180.0, 1000)))
+test_angles[:3,1] = [90.0, -90.0, 89.9999999] #gimbal lock
+test_matrices = transf.Rotation.from_euler('ZYX', test_angles, True).as_matrix()
+assert np.allclose(geo.euler_zyx_to_matrices(test_angles, True), test_matrices, rtol = 0, atol = 1e-14)
+assert geo.euler_zyx_to_matrices([0.1, 0.2, 0.3]).shape == (3,3)
+assert np.allclose(geo.euler_zyx_to_matrices(geo.matrices_to_euler_zyx(test_matrices, True), True), test_matrices, rtol = 0, atol = 1e-14)
+assert np.allclose(geo.matrices_to_euler_zyx(test_matrices[3:], True), test_angles[3:], rtol = 0, atol = 1e-8)
+assert np.allclose(geo.matrices_to_quaternions_wxyz(test_matrices), transf.Rotation.from_matrix(test_matrices).as_quat()[:,[3,0,1,2]], rtol = 0, atol = 1e-14)
+assert np.allclose(geo.matrices_to_quaternions_wxyz(np.eye(3)), [1.0, 0.0, 0.0, 0.0])
+test_rotation_vectors = np.vstack((np.zeros((1,3)), np.full((1,3), 1e-10), rng.normal(0.0, 1.0, (100,3))))
+assert np.allclose(geo.rotation_vectors_to_matrices(test_rotation_vectors), transf.Rotation.from_rotvec(test_rotation_vectors).as_matrix(), rtol = 0, atol = 1e-14)
+pose_c = pickle.loads(pickle.dumps(geo.create_poses(np.zeros((1,3,1)), test_matrices[3:4], ['free'])[0]))
+assert np.array_equal(pose_c.rotation_matrix(), test_matrices[3]) and np.allclose(pose_c.rotation.as_matrix(), test_matrices[3])
+assert np.allclose(pose_c.get_rotation_as_wxyz_quaternion(), transf.Rotation.from_matrix(test_matrices[3]).as_quat()[[3,0,1,2]])
+assert np.array_equal(geo.Pose().rotation_matrix(), np.eye(3))
+#the simulator must start without scipy, it is imported only by the options which need it
+imported_modules = subprocess.run([sys.executable, '-c', 'import sys, point_cloud_optimization_simulator; print(" ".join(sys.modules))'],
+                                  cwd = os.path.dirname(os.path.abspath(__file__)), capture_output = True, text = True, check = True).stdout.split()
+assert not any(module.startswith('scipy') for module in imported_modules)
+assert benchmark.get_import_times('import time: self [us] | cumulative | imported package\nimport time:       250 |       1500 | numpy\nimport time:       100 |        200 |   numpy.random\n') == {'numpy': 0.0015}
+
+def create_test_network():
+    poses = {}
+    poses[1] = geo.Pose(np.array([1.0, 1.3, 0.0]).reshape((3,1)), transf.Rotation.from_euler('ZYX', [14.0, 0.0, 0.0], True), 'fixed')
+    poses[2] = geo.Pose(np.array([4.2, 1.4, -0.12]).reshape((3,1)), transf.Rotation.from_euler('ZYX', [250.0, 0.0, 0.7], True))
+    poses[3] = geo.Pose(np.array([7.1, 1.7, 0.05]).reshape((3,1)), transf.Rotation.from_euler('ZYX', [106.0, 1.3, -0.6], True))
+    poses[4] = geo.Pose(np.array([4.3, 3.8, -0.08]).reshape((3,1)), transf.Rotation.from_euler('ZYX', [188.0, 0.0, 0.03], True))
+    graph = geo.SimpleVisibilityGraph({1,2,3,4})
+    for edge in [geo.GraphEdge(1,2), geo.GraphEdge(2,3), geo.GraphEdge(3,4), geo.GraphEdge(4,2)]:
+        graph.try_add_edge(edge)
+    return poses, graph
+
+def verify_simulated_features(simulator, poses):
+    store = simulator.feature_store
+    features_in_world = {}
+    for pose_id, columns in store.pose_views():
+        assert np.all(np.diff(columns['feature_id']) > 0)
+        assert np.all(columns['number_of_measurements'] > 1)
+        for feature_id, position in zip(columns['feature_id'].tolist(), columns['position']):
+            visibility = store.get_visibility(feature_id).tolist()
+            assert pose_id in visibility
+            for id in visibility: #poses of the feature must be co-visible
+                assert id == pose_id or id in simulator.dict_of_poses_visibility[pose_id]
+            feature_in_world = geo.transform_points(poses[pose_id].T(), position.reshape((1,3)))[0]
+            if feature_id in features_in_world:
+                assert np.allclose(features_in_world[feature_id], feature_in_world)
+            else:
+                features_in_world[feature_id] = feature_in_world
+    return len(store)
+
+print ('testing feature generation engines...')
+
+test_poses, test_graph = create_test_network()
+number_of_observations = {}
+for engine in SimulationConfig.feature_generation_engines:
+    config = SimulationConfig.Config()
+    config.number_of_features_per_cloud = 500
+    config.matching_probability = 0.4
+    config.feature_generation_engine = engine
+    simulator = Simulator.Simulator(config)
+    simulator.dict_of_poses_visibility = simulator.create_dict_of_poses_visibility(test_graph)
+    simulator.generate_features(test_poses)
+    number_of_observations[engine] = verify_simulated_features(simulator, test_poses)
+    statistics = simulator.statistics
+    assert statistics['observations'] == number_of_observations[engine] == len(simulator.feature_store)
+    assert statistics['features_generated'] == 500*len(test_poses)
+    assert statistics['observations'] == statistics['features_generated'] - statistics['features_not_matched'] + statistics['matches_accepted']
+    number_of_match_candidates = statistics['matches_accepted'] + statistics['matches_rejected_by_matching_probability'] + statistics['matches_rejected_by_visibility_conflict']
+    assert number_of_match_candidates == 500*sum(len(test_graph.adjacency[pose_id]) for pose_id in test_poses)
+    assert statistics['matches_rejected_by_visibility_conflict'] > 0
+#both engines should produce statistically the same number of observations
+assert abs(number_of_observations['legacy'] - number_of_observations['batch']) < 0.1*number_of_observations['legacy']
+
+print ('testing bitsets of visibility conflicts...')
+
+conflict_bitmasks = geo.get_conflict_bitmasks([3, 4, 5], {3: {1, 4}, 4: {1, 3}, 5: {1, 3}})
+assert conflict_bitmasks.shape == (3, 1) and conflict_bitmasks[:,0].tolist() == [0, 0, 0b10] #5 is not co-visible with 4
+number_of_query_poses = 150 #three words of bitsets
+dense_visibility = {0: set(range(1, number_of_query_poses + 1))}
+for pose_id in range(1, number_of_query_poses + 1):
+    dense_visibility[pose_id] = {0} | {other_id for other_id in range(1, number_of_query_poses + 1) if other_id != pose_id and abs(other_id - pose_id) <= 100}
+config = SimulationConfig.Config()
+config.matching_probability = 0.02
+simulator = Simulator.Simulator(config, seed = 3)
+simulator.dict_of_poses_visibility = dense_visibility
+query_pose_ids = list(dense_visibility[0])
+visibility = simulator.match_features(np.random.default_rng(8), 300, query_pose_ids)
+matching_rng = np.random.default_rng(8)
+expected_visibility = np.zeros_like(visibility)
+for k, query_pose_id in enumerate(query_pose_ids): #the same draws, conflicts checked with sets of poses of every feature
+    is_matched = matching_rng.uniform(0.0, 1.0, 300) <= config.matching_probability
+    for i in np.flatnonzero(is_matched):
+        if all(query_pose_ids[j] in dense_visibility[query_pose_id] for j in np.flatnonzero(expected_visibility[i,:k])):
+            expected_visibility[i,k] = True
+assert np.array_equal(visibility, expected_visibility) and np.count_nonzero(visibility[:,64:]) > 0
+
+print ('testing geometric visibility...')
+
+config = SimulationConfig.Config()
+config.feature_generation_engine = 'batch'
+config.number_of_features_per_cloud = 3000
+config.min_vertical_angle_deg = 0.2
+config.max_vertical_angle_deg = 120.0
+config.visibility_mode = 'geometric'
+simulator = Simulator.Simulator(config, seed = 3)
+simulator.dict_of_poses_visibility = simulator.create_dict_of_poses_visibility(test_graph)
+simulator.generate_features(test_poses)
+verify_simulated_features(simulator, test_poses)
+slant_distances = np.linalg.norm(simulator.feature_store.positions, axis = 1)
+vertical_angles_deg = np.degrees(np.arccos(simulator.feature_store.positions[:,2]/slant_distances))
+#every observation lies within the range shell and the vertical angle limits of the observing pose
+assert np.all((slant_distances >= config.min_distance) & (slant_distances <= config.max_distance))
+assert np.all((vertical_angles_deg >= config.min_vertical_angle_deg) & (vertical_angles_deg <= config.max_vertical_angle_deg))
+statistics = simulator.statistics
+assert statistics['matches_rejected_by_geometry'] > 0 and statistics['matches_accepted'] > 0
+number_of_match_candidates = sum(statistics[name] for name in ('matches_accepted', 'matches_rejected_by_geometry', 'matches_rejected_by_matching_probability', 'matches_rejected_by_visibility_conflict'))
+assert number_of_match_candidates == 3000*sum(len(test_graph.adjacency[pose_id]) for pose_id in test_poses)
+positions = np.array([[2.8, 0.0, 0.0], [0.0, 0.0, -2.8], [100.0, 0.0, 0.0]])
+simulator.relative_transformations[(1,1)] = np.eye(4)
+geometric_visibility = simulator.get_geometric_visibility(positions, 1, [1])
+assert [visible_features.tolist() for visible_features in geometric_visibility] == [[0]] #below the vertical angle limit, out of range
+simulator.config.matching_probability = 1.0
+visibility = simulator.match_features(np.random.default_rng(1), 3, [1], geometric_visibility = [np.array([0, 2])])
+assert visibility[:,0].tolist() == [True, False, True] #matching trials only for the geometrically visible features
+
+print ('testing parallel simulation...')
+
+stores = []
+for number_of_workers in (1, 3):
+    config = SimulationConfig.Config()
+    config.feature_generation_engine = 'batch'
+    config.number_of_features_per_cloud = 200
+    config.number_of_workers = number_of_workers
+    simulator = Simulator.Simulator(config, seed = 1234)
+    simulator.run_simulations(test_poses, test_graph)
+    stores.append(simulator.feature_store)
+#the same seed must give the same result regardless of the number of workers
+assert len(stores[0]) > 0
+assert np.array_equal(stores[0].feature_ids, stores[1].feature_ids)
+assert np.array_equal(stores[0].observation_pose_ids, stores[1].observation_pose_ids)
+assert np.array_equal(stores[0].positions, stores[1].positions)
+assert np.array_equal(stores[0].covariances, stores[1].covariances)
+
+print ('testing incremental simulation...')
+
+def simulate_with_state(poses, graph, path_state = None, use_streaming = False):
+    config = SimulationConfig.Config()
+    config.feature_generation_engine = 'batch'
+    config.number_of_features_per_cloud = 200
+    simulator = Simulator.Simulator(config, seed = 77)
+    if path_state is not None:
+        previous_state = SimulationState.SimulationState(path_state) if os.path.exists(path_state) else None
+        simulator.previous_state = previous_state
+        simulator.state_writer = SimulationState.SimulationStateWriter(path_state, config, simulator.seed, list(poses.keys()))
+    if use_streaming:
+        for _ in simulator.run_simulations_streaming(poses, graph):
+            pass
+    else:
+        simulator.run_simulations(poses, graph)
+    if path_state is not None:
+        if previous_state is not None:
+            previous_state.close()
+        simulator.state_writer.close()
+    return simulator
+
+with tempfile.TemporaryDirectory() as state_directory:
+    path_state = os.path.join(state_directory, 'state')
+    incremental_poses, incremental_graph = create_test_network()
+    simulator = simulate_with_state(incremental_poses, incremental_graph, path_state, use_streaming = True)
+    assert simulator.statistics['reference_poses_simulated'] == 4 and simulator.statistics['reference_poses_reused'] == 0
+    incremental_poses[1].set_position(incremental_poses[1].position + 0.1) #observations of poses 1 and 2 (neighbour of 1) change
+    simulator = simulate_with_state(incremental_poses, incremental_graph, path_state)
+    assert simulator.statistics['reference_poses_simulated'] == 2 and simulator.statistics['reference_poses_reused'] == 2
+    reference_simulator = simulate_with_state(incremental_poses, incremental_graph) #the same poses, so the same feature ids as a full simulation
+    for name in ('feature_ids', 'observation_pose_ids', 'number_of_measurements', 'positions', 'covariances'):
+        assert np.array_equal(getattr(simulator.feature_store, name), getattr(reference_simulator.feature_store, name))
+    columns_of_pose_1 = simulator.feature_store.get_pose_view(1) #features of reference poses 1 and 2, which are not changed by pose 5
+    incremental_poses[5] = geo.Pose(np.array([6.0, 4.0, 0.0]).reshape((3,1)), transf.Rotation.from_euler('ZYX', [30.0, 0.0, 0.0], True))
+    incremental_graph = geo.SimpleVisibilityGraph({1,2,3,4,5})
+    for edge in [geo.GraphEdge(1,2), geo.GraphEdge(2,3), geo.GraphEdge(3,4), geo.GraphEdge(4,2), geo.GraphEdge(4,5)]:
+        incremental_graph.try_add_edge(edge)
+    simulator = simulate_with_state(incremental_poses, incremental_graph, path_state) #reference poses 4 and 5 get new blocks of feature ids
+    assert simulator.statistics['reference_poses_simulated'] == 2 and simulator.statistics['reference_poses_reused'] == 3
+    for (name, column) in simulator.feature_store.get_pose_view(1).items():
+        assert np.array_equal(column, columns_of_pose_1[name])
+    reference_simulator = simulate_with_state(incremental_poses, incremental_graph)
+    for name in ('features_generated', 'features_not_matched', 'observations', 'matches_accepted'):
+        assert simulator.statistics[name] == reference_simulator.statistics[name]
+    for name in ('positions', 'covariances'): #the same observations, some of them with other feature ids
+        assert np.array_equal(np.sort(getattr(simulator.feature_store, name).reshape((len(simulator.feature_store), -1)), axis = 0),
+                              np.sort(getattr(reference_simulator.feature_store, name).reshape((len(reference_simulator.feature_store), -1)), axis = 0))
+    assert np.array_equal(np.sort(simulator.feature_store.number_of_measurements), np.sort(reference_simulator.feature_store.number_of_measurements))
+    with open(os.path.join(path_state, 'state.json')) as file:
+        chunks = json.load(file)['chunks']
+    assert sorted(chunks.keys()) == ['1', '2', '3', '4', '5']
+    assert [chunks[str(pose_id)]['feature_id_block'] for pose_id in (1, 2, 3)] == [[1, 4], [2, 4], [3, 4]]
+    assert [chunks[str(pose_id)]['feature_id_block'] for pose_id in (4, 5)] == [[3 + 4*199 + 1, 1], [3 + 4*199 + 201, 1]] #above the last id of pose 3
+    previous_feature_ids = simulator.feature_store.feature_ids
+    simulator = simulate_with_state(incremental_poses, incremental_graph, path_state) #nothing changed, nothing is renumbered
+    assert simulator.statistics['reference_poses_reused'] == 5 and np.array_equal(simulator.feature_store.feature_ids, previous_feature_ids)
+
+print ('testing noise of poses...')
+
+noise_poses, _ = create_test_network()
+poses_with_noise = io.add_noise_to_poses(noise_poses, (0.05, 3.0), 21)
+assert list(poses_with_noise.keys()) == list(noise_poses.keys())
+assert np.array_equal(poses_with_noise[1].position, noise_poses[1].position) and np.allclose(poses_with_noise[1].rotation_matrix(), noise_poses[1].rotation_matrix(), rtol = 0, atol = 1e-15)
+rng = utils.create_random_generator(21, 'pose_noise')
+for pose_id in (2, 3, 4): #free poses, the same draws as the scalar functions pose by pose
+    position_noise = np.array([utils.gaussian_noise_with_limit(0.05, rng) for _ in range(3)]).reshape((3,1))
+    rotation_noise = utils.generate_noise_on_so3(3.0*np.pi/180.0, rng)
+    assert np.allclose(poses_with_noise[pose_id].position, noise_poses[pose_id].position + position_noise, rtol = 0, atol = 1e-15)
+    assert np.allclose(poses_with_noise[pose_id].rotation_matrix(), noise_poses[pose_id].rotation_matrix()@rotation_noise, rtol = 0, atol = 1e-14)
+    assert poses_with_noise[pose_id].type == 'free'
+position_noise, rotation_vectors = utils.generate_pose_noise_batch(100000, 0.0, 0.02, np.random.default_rng(4))
+assert not np.any(position_noise) and abs(np.std(rotation_vectors) - 0.02) < 0.0005
+with tempfile.TemporaryDirectory() as output_directory:
+    io.save_poses(output_directory, noise_poses, (0.05, 3.0), 21)
+    saved_poses = np.loadtxt(os.path.join(output_directory, 'poses.txt'), skiprows = 1, delimiter = ',', usecols = range(8))
+    assert np.allclose(saved_poses[:,1:4], np.reshape([pose.position for pose in poses_with_noise.values()], (-1,3)), rtol = 0, atol = 1e-4)
+    for (row, pose) in zip(saved_poses, poses_with_noise.values()):
+        assert np.allclose(transf.Rotation.from_quat(row[[5,6,7,4]]).as_matrix(), pose.rotation_matrix(), rtol = 0, atol = 1e-12)
+
+print ('testing reproducibility of simulation with seed...')
+
+for engine in SimulationConfig.feature_generation_engines:
+    outputs = []
+    for _ in range(2):
+        config = SimulationConfig.Config()
+        config.number_of_features_per_cloud = 100
+        config.feature_generation_engine = engine
+        config.seed = 42
+        simulator = Simulator.Simulator(config)
+        simulator.run_simulations(test_poses, test_graph)
+        with tempfile.TemporaryDirectory() as output_directory:
+            io.save_features(output_directory, simulator)
+            io.save_poses(output_directory, test_poses, (0.05, 3.0), simulator.seed)
+            with open(os.path.join(output_directory, 'lidar_measurements.txt')) as file:
+                measurements = file.read()
+            with open(os.path.join(output_directory, 'poses.txt')) as file:
+                poses_with_noise = file.read()
+        outputs.append((measurements, poses_with_noise))
+    assert outputs[0] == outputs[1]
+
+print ('testing feature store...')
+
+feature_a = geo.FeatureIn3d(id = 5, position = np.array([1.0, 2.0, 3.0]).reshape((3,1)), covariance = np.eye(3))
+feature_b = geo.FeatureIn3d(id = 2, position = np.array([4.0, 5.0, 6.0]).reshape((3,1)), covariance = 2*np.eye(3))
+feature_c = geo.FeatureIn3d(id = 5, position = np.array([7.0, 8.0, 9.0]).reshape((3,1)), covariance = 3*np.eye(3))
+store = FeatureStore.FeatureStore.from_dict_of_features({3: [feature_a, feature_b], 1: [feature_c], 7: []})
+assert len(store) == 3
+assert store.pose_ids == [3, 1, 7]
+assert store.get_pose_view(3)['feature_id'].tolist() == [2, 5] #sorted by feature id
+assert np.array_equal(store.get_pose_view(3)['position'], [[4.0, 5.0, 6.0], [1.0, 2.0, 3.0]])
+assert np.array_equal(store.get_pose_view(1)['covariance'][0], 3*np.eye(3))
+assert len(store.get_pose_view(7)['feature_id']) == 0
+assert sorted(store.get_visibility(5).tolist()) == [1, 3]
+assert store.get_visibility(2).tolist() == [3]
+assert store.get_visibility(4).tolist() == []
+assert store.get_pose_view(3)['number_of_measurements'].tolist() == [1, 2]
+
+print ('testing level of detail of dxf...')
+
+with tempfile.TemporaryDirectory() as output_directory:
+    config = SimulationConfig.Config()
+    config.number_of_features_per_cloud = 300
+    simulator = Simulator.Simulator(config, seed = 5)
+    simulator.run_simulations(test_poses, test_graph)
+    number_of_rays = {}
+    for (dxf_ray_decimation, max_rays_per_pose_in_dxf) in ((1, 0), (3, 0), (1, 20)):
+        config.dxf_ray_decimation = dxf_ray_decimation
+        config.max_rays_per_pose_in_dxf = max_rays_per_pose_in_dxf
+        io.save_network_to_dxf(output_directory, simulator, test_poses)
+        with open(os.path.join(output_directory, 'network.dxf')) as file:
+            lines = file.read().split('\n')
+        assert lines[-2:] == ['0', ''] and lines[-3] == 'ENDSEC'
+        number_of_rays[(dxf_ray_decimation, max_rays_per_pose_in_dxf)] = lines.count('rays')
+        assert lines.count('cs') == 3*len(test_poses)
+    assert number_of_rays[(1, 0)] == len(simulator.feature_store)
+    assert number_of_rays[(3, 0)] == np.count_nonzero(simulator.feature_store.feature_ids % 3 == 0)
+    assert number_of_rays[(1, 20)] == 20*len(test_poses)
+
+print ('testing loaders of poses and graphs...')
+
+with tempfile.TemporaryDirectory() as input_directory:
+    path_poses = os.path.join(input_directory, 'poses.txt')
+    path_graph = os.path.join(input_directory, 'graph_edges.txt')
+    with open(path_poses, 'w') as file:
+        file.write('id,x,y,z,yaw[deg],pitch[deg],roll[deg],type\n1,1.0,1.3,0.0,14.0,0.0,0.0,fixed\n\n3, 7.1,1.7,0.05,106.0,1.3,-0.6,free\n')
+    with open(path_graph, 'w') as file:
+        file.write('from_id,to_id\n1,3\n3,4\n')
+    loaded_poses = io.read_poses(path_poses)
+    assert list(loaded_poses.keys()) == [1, 3]
+    assert loaded_poses[1].type == 'fixed' and loaded_poses[3].type == 'free'
+    assert np.allclose(loaded_poses[3].position, np.array([7.1, 1.7, 0.05]).reshape((3,1)))
+    assert np.allclose(loaded_poses[3].rotation_matrix(), transf.Rotation.from_euler('ZYX', [106.0, 1.3, -0.6], True).as_matrix())
+    assert np.allclose(loaded_poses[3].rotation.as_matrix(), loaded_poses[3].rotation_matrix())
+    loaded_graph = io.read_graph(path_graph)
+    assert loaded_graph.nodes == {1,3,4} and loaded_graph.adjacency == {1: {3}, 3: {1,4}, 4: {3}}
+    assert len(loaded_graph.edges) == 2
+
+    io.save_poses_npz(os.path.join(input_directory, 'poses.npz'), loaded_poses)
+    io.save_graph_npz(os.path.join(input_directory, 'graph_edges.npz'), loaded_graph)
+    binary_poses = io.read_poses(os.path.join(input_directory, 'poses.npz'))
+    assert list(binary_poses.keys()) == [1, 3]
+    for pose_id in binary_poses:
+        assert binary_poses[pose_id].type == loaded_poses[pose_id].type
+        assert np.allclose(binary_poses[pose_id].T(), loaded_poses[pose_id].T())
+    assert io.read_graph(os.path.join(input_directory, 'graph_edges.npz')).adjacency == loaded_graph.adjacency
+
+    for (content, path, expected_message) in (('id,x,y,z,yaw,pitch,roll,type\n1,1,2,3,4,5,6,free\n2,1,2,3,4,5,free\n', path_poses, 'Line 3'),
+                                              ('id,x,y,z,yaw,pitch,roll,type\n1,1,2,3,4,5,6,free\n2,1,2,a,4,5,6,free\n', path_poses, 'Line 3'),
+                                              ('id,x,y,z,yaw,pitch,roll,type\n1,1,2,3,4,5,6,free\n1,1,2,3,4,5,6,free\n', path_poses, 'Line 3'),
+                                              ('id,x,y,z,yaw,pitch,roll,type\n1,1,2,3,4,5,6,loose\n', path_poses, 'Line 2'),
+                                              ('from_id,to_id\n1,2\n2,3\n3,2\n', path_graph, 'Line 4'),
+                                              ('from_id,to_id\n1,2\n2,3.5\n', path_graph, 'Line 3')):
+        with open(path, 'w') as file:
+            file.write(content)
+        try:
+            io.read_poses(path) if path == path_poses else io.read_graph(path)
+            assert False, 'malformed input was accepted'
+        except ValueError as error:
+            assert str(error).startswith('Error! ' + expected_message), str(error)
+
+print ('testing profiler...')
+
+profiler = Profiler.Profiler(False)
+with profiler.stage('disabled'):
+    pass
+assert profiler.stages == {}
+profiler = Profiler.Profiler(True, ['tracemalloc'])
+profiler.start()
+for _ in range(2):
+    with profiler.stage('allocation'):
+        allocated = np.ones(100000)
+profiler.add_counters({'observations': 5})
+profiler.add_counters({'observations': np.int64(2)})
+profiler.stop()
+assert profiler.stages['allocation']['calls'] == 2 and profiler.stages['allocation']['peak_memory_bytes'] >= allocated.nbytes
+with tempfile.TemporaryDirectory() as output_directory:
+    with open(os.path.join(output_directory, 'poses.txt'), 'w') as file:
+        file.write('12345')
+    profiler.record_file_sizes(io.get_output_paths(output_directory))
+    profiler.save_report(os.path.join(output_directory, 'profile.json'))
+    with open(os.path.join(output_directory, 'profile.json')) as file:
+        report = json.load(file)
+assert report['counters'] == {'observations': 7} and report['file_sizes_bytes'] == {'poses.txt': 5} and report['total_time_s'] > 0.0
+
+print ('testing benchmark...')
+
+synthetic_poses, synthetic_graph = benchmark.create_synthetic_network(50, 6.0, 3)
+assert list(synthetic_poses.keys()) == list(range(1, 51)) and synthetic_graph.nodes == set(range(1, 51))
+assert len(synthetic_graph.edges) == 150 and len(synthetic_graph.get_connected_components()) == 1
+assert synthetic_poses[1].type == 'fixed' and synthetic_poses[2].type == 'free'
+benchmark_config = SimulationConfig.Config()
+benchmark_config.min_vertical_angle_deg = 0.2
+benchmark_config.number_of_features_per_cloud = 30
+benchmark_results = benchmark.run_benchmark(benchmark_config, [3, 6], [30], [0.3], 2.0, 2, 7)
+assert len(benchmark_results['cases']) == 2 and set(benchmark_results['scaling_exponents'].keys()) == set(benchmark.stages + ('total',))
+for case in benchmark_results['cases']:
+    assert set(case['stages'].keys()) == set(benchmark.stages)
+    assert case['number_of_observations'] >= 2*case['number_of_features'] and case['peak_memory_bytes'] > 0
+    assert all(measurement['time_s'] >= 0.0 and measurement['peak_memory_bytes'] is not None for measurement in case['stages'].values())
+json.dumps(benchmark_results)
+
+print ('testing scenario runner...')
+
+with tempfile.TemporaryDirectory() as scenarios_directory:
+    scenario_config = SimulationConfig.Config()
+    scenario_config.min_vertical_angle_deg = 0.2
+    scenario_config.number_of_features_per_cloud = 50
+    scenario_config.write_to_xml(os.path.join(scenarios_directory, 'config.xml'))
+    with open(os.path.join(scenarios_directory, 'manifest.txt'), 'w') as file:
+        file.write('config,seed,output\nconfig.xml,11,a\nconfig.xml,,b\nconfig.xml,11,c\n')
+    scenarios = scenario_runner.read_manifest(os.path.join(scenarios_directory, 'manifest.txt'))
+    assert [seed for (_, seed, _) in scenarios][0::2] == [11, 11] and scenarios[1][1] != 11
+    assert scenarios[0][2] == os.path.join(scenarios_directory, 'a') and scenarios[0][0].number_of_features_per_cloud == 50
+    scenarios.append((scenarios[0][0], 12, os.path.join(scenarios_directory, 'a', 'lidar_measurements.txt', 'd'))) #output can not be created
+    for number_of_workers in (1, 2):
+        results = scenario_runner.run_scenarios(test_poses, test_graph, scenarios, number_of_workers)
+        assert [result['status'] for result in results] == ['ok', 'ok', 'ok', 'failed'] and results[3]['error'] is not None
+        assert results[0]['observations'] == results[2]['observations'] > 0
+        with open(os.path.join(scenarios_directory, 'a', 'lidar_measurements.txt')) as file_a, open(os.path.join(scenarios_directory, 'c', 'lidar_measurements.txt')) as file_c:
+            assert file_a.read() == file_c.read()
+
+print ('testing result cache...')
+
+cache_config = SimulationConfig.Config()
+cache_key = ResultCache.get_cache_key(test_poses, test_graph, cache_config, 5)
+assert cache_key == ResultCache.get_cache_key(test_poses, test_graph, cache_config, 5)
+assert cache_key != ResultCache.get_cache_key(test_poses, test_graph, cache_config, 6)
+cache_config.number_of_workers = 4 #does not change the output
+assert cache_key == ResultCache.get_cache_key(test_poses, test_graph, cache_config, 5)
+cache_config.matching_probability = 0.3
+assert cache_key != ResultCache.get_cache_key(test_poses, test_graph, cache_config, 5)
+with tempfile.TemporaryDirectory() as cache_test_directory:
+    result_cache = ResultCache.ResultCache(os.path.join(cache_test_directory, 'cache'), 4500)
+    output_directory = os.path.join(cache_test_directory, 'output')
+    os.makedirs(os.path.join(output_directory, 'feature_data'))
+    output_paths = [os.path.join(output_directory, 'poses.txt'), os.path.join(output_directory, 'feature_data')]
+    assert not result_cache.restore('a', output_paths)
+    for (key, size) in (('a', 1000), ('b', 1000)):
+        with open(output_paths[0], 'w') as file:
+            file.write(key*size)
+        with open(os.path.join(output_paths[1], 'position.npy'), 'w') as file:
+            file.write(key*size)
+        result_cache.store(key, output_paths)
+    os.remove(output_paths[0])
+    assert result_cache.restore('a', output_paths) #a is now used more recently than b
+    with open(output_paths[0]) as file:
+        assert file.read() == 'a'*1000
+    assert os.path.samefile(output_paths[0], os.path.join(result_cache.get_entry_directory('a'), 'poses.txt'))
+    io.remove_outputs(output_directory) #removes hard links, so the next run does not overwrite the cache
+    with open(output_paths[0], 'w') as file:
+        file.write('c')
+    result_cache.store('c', output_paths) #does not fit with both a and b, b is the least recently used
+    assert os.path.isdir(result_cache.get_entry_directory('a')) and not os.path.isdir(result_cache.get_entry_directory('b'))
+    assert result_cache.restore('a', output_paths)
+    with open(os.path.join(result_cache.get_entry_directory('c'), 'poses.txt'), 'w') as file:
+        file.write('modified')
+    assert not result_cache.restore('c', output_paths) and not os.path.isdir(result_cache.get_entry_directory('c'))
+
+with tempfile.TemporaryDirectory() as cache_test_directory:
+    cache_config = SimulationConfig.Config()
+    cache_config.number_of_features_per_cloud = 50
+    cache_config.min_vertical_angle_deg = 0.2
+    cache_config.write_to_xml(os.path.join(cache_test_directory, 'config.xml'))
+    os.makedirs(os.path.join(cache_test_directory, 'output'))
+    arguments = [sys.executable, 'point_cloud_optimization_simulator.py', '-c', os.path.join(cache_test_directory, 'config.xml'), '-o', os.path.join(cache_test_directory, 'output'),
+                 '-e', 'batch', '--network', 'trajectory:6', '--seed', '3', '--cache-dir', os.path.join(cache_test_directory, 'cache'), '--state', os.path.join(cache_test_directory, 'state')]
+    for run in range(2):
+        output = subprocess.run(arguments, capture_output = True, text = True, check = True).stdout
+    #the second run is in the cache, but with a state it is simulated from the state, so the state is kept up to date
+    assert 'restored from cache' not in output and 'Reused observations of 6 of 6 reference poses' in output
+
+print ('testing binary output formats...')
+
+with tempfile.TemporaryDirectory() as output_directory:
+    io.save_features(output_directory, simulator, 'text')
+    io.save_all_feature_data(output_directory, simulator, test_poses, 'text')
+    measurements_text = np.loadtxt(os.path.join(output_directory, 'lidar_measurements.txt'), skiprows = 1, delimiter = ',')
+    feature_data_text = np.loadtxt(os.path.join(output_directory, 'feature_data.txt'), skiprows = 1, delimiter = ',')
+    for output_format, extension in (('npy', ''), ('npz', '.npz')):
+        io.save_features(output_directory, simulator, output_format)
+        io.save_all_feature_data(output_directory, simulator, test_poses, output_format)
+        measurements = io.read_binary_output(os.path.join(output_directory, 'lidar_measurements' + extension))
+        feature_data = io.read_binary_output(os.path.join(output_directory, 'feature_data' + extension))
+        assert np.array_equal(measurements['pose_id'], measurements_text[:,0])
+        assert np.array_equal(measurements['feature_id'], measurements_text[:,1])
+        assert np.allclose(measurements['position'], measurements_text[:,2:5], rtol = 0, atol = 1e-5)
+        assert np.allclose(measurements['covariance'].reshape((-1,9)), measurements_text[:,5:14], rtol = 0, atol = 1e-15)
+        assert np.array_equal(feature_data['number_of_measurements'], feature_data_text[:,2])
+        assert np.allclose(feature_data['position_global'], feature_data_text[:,6:9], rtol = 0, atol = 1e-4)
+    del measurements, feature_data #memory-mapped files must be closed before the directory is removed
+
+print ('testing export of problem structure...')
+
+config = SimulationConfig.Config()
+config.number_of_features_per_cloud = 200
+simulator = Simulator.Simulator(config, seed = 5)
+simulator.run_simulations(test_poses, test_graph)
+structure = io.get_problem_structure(simulator, test_poses)
+store = simulator.feature_store
+assert np.array_equal(structure['pose_ids'][structure['pose_indices']], store.observation_pose_ids)
+assert np.array_equal(structure['feature_ids'][structure['feature_indices']], store.feature_ids)
+assert structure['is_fixed'].tolist() == [test_poses[pose_id].type == 'fixed' for pose_id in store.pose_ids]
+for pose_index in range(len(store.pose_ids)): #CSR by pose
+    rows = slice(structure['pose_offsets'][pose_index], structure['pose_offsets'][pose_index+1])
+    assert np.all(structure['pose_indices'][rows] == pose_index) and structure['observations_per_pose'][pose_index] == rows.stop - rows.start
+for feature_index in (0, len(structure['feature_ids'])//2, len(structure['feature_ids']) - 1): #CSR by feature
+    rows = structure['feature_rows'][structure['feature_offsets'][feature_index]:structure['feature_offsets'][feature_index+1]]
+    assert np.all(structure['feature_indices'][rows] == feature_index)
+    assert sorted(structure['pose_ids'][structure['pose_indices'][rows]].tolist()) == sorted(store.get_visibility(structure['feature_ids'][feature_index]).tolist())
+    assert structure['observations_per_feature'][feature_index] == len(rows)
+pose_pairs = {(int(i), int(j)) for i in range(len(store.pose_ids)) for j in structure['reduced_indices'][structure['reduced_offsets'][i]:structure['reduced_offsets'][i+1]]}
+expected_pose_pairs = {(int(i), int(j)) for feature_index in range(len(structure['feature_ids']))
+                       for i in structure['pose_indices'][structure['feature_rows'][structure['feature_offsets'][feature_index]:structure['feature_offsets'][feature_index+1]]]
+                       for j in structure['pose_indices'][structure['feature_rows'][structure['feature_offsets'][feature_index]:structure['feature_offsets'][feature_index+1]]]}
+assert pose_pairs == expected_pose_pairs
+assert sorted(structure['pose_ordering'].tolist()) == list(range(len(store.pose_ids)))
+assert sorted(structure['feature_ordering'].tolist()) == list(range(len(structure['feature_ids'])))
+pose_ranks = np.argsort(structure['pose_ordering'])
+first_ranks = [min(pose_ranks[structure['pose_indices'][structure['feature_rows'][structure['feature_offsets'][index]:structure['feature_offsets'][index+1]]]]) for index in structure['feature_ordering']]
+assert np.all(np.diff(first_ranks) >= 0)
+banded_pattern = scipy.sparse.csr_matrix(np.array([[1,0,1],[0,1,0],[1,0,1]])) #poses 0 and 2 share landmarks
+assert io.get_envelope_size(banded_pattern, np.arange(3)) == 2 and io.get_envelope_size(banded_pattern, np.array([0,2,1])) == 1
+with tempfile.TemporaryDirectory() as output_directory:
+    io.save_problem_structure(output_directory, simulator, test_poses)
+    assert io.get_output_paths(output_directory, 'text', True)[-1] == os.path.join(output_directory, 'problem_structure.npz')
+    with np.load(os.path.join(output_directory, 'problem_structure.npz')) as saved_structure:
+        assert all(np.array_equal(saved_structure[name], array) for (name, array) in structure.items())
+    io.remove_outputs(output_directory)
+    assert not os.path.exists(os.path.join(output_directory, 'problem_structure.npz'))
+
+print ('testing streaming simulation...')
+
+with tempfile.TemporaryDirectory() as output_directory:
+    config = SimulationConfig.Config()
+    config.feature_generation_engine = 'batch'
+    config.number_of_features_per_cloud = 300
+    simulator = Simulator.Simulator(config)
+    io.save_simulation_streaming(output_directory, simulator, test_poses, test_graph, 'npy')
+    assert len(simulator.feature_store) == 0 #nothing is kept in memory
+    feature_data = io.read_binary_output(os.path.join(output_directory, 'feature_data'))
+    measurements = io.read_binary_output(os.path.join(output_directory, 'lidar_measurements'))
+    assert len(feature_data['feature_id']) > 0
+    assert np.array_equal(feature_data['feature_id'], measurements['feature_id'])
+    assert np.array_equal(np.bincount(feature_data['feature_id'])[feature_data['feature_id']], feature_data['number_of_measurements'])
+    for feature_id in feature_data['feature_id'][:50]:
+        rows = feature_data['feature_id'] == feature_id
+        assert np.allclose(feature_data['position_global'][rows], feature_data['position_global'][rows][0], rtol = 0, atol = 0.1)
+    del feature_data, measurements
+    empty_column = io.NpyColumnFile(os.path.join(output_directory, 'empty.npy'), np.float64, (3,3))
+    empty_column.close()
+    assert np.load(os.path.join(output_directory, 'empty.npy')).shape == (0,3,3)
+    with open(os.path.join(output_directory, 'empty.npy'), 'rb') as file: #length of the header is little-endian on every platform
+        assert file.read(10)[8:10] == (io.NpyColumnFile.header_length - 10).to_bytes(2, 'little')
+
+print ('testing network generator...')
+
+for layout in network_generator.layouts:
+    (network_poses, network_graph) = network_generator.create_network(f'{layout}:300:2', 'window:3', 7)
+    assert list(network_poses.keys()) == list(range(1, 301))
+    assert network_poses[1].type == 'fixed' and all(pose.type == 'free' for pose in list(network_poses.values())[1:])
+    assert len(network_graph.edges) == 3*300 - 6 and len(network_graph.get_connected_components()) == 1
+    assert network_graph.adjacency[10] == {7, 8, 9, 11, 12, 13}
+    positions = np.reshape([pose.position for pose in network_poses.values()], (-1,3))
+    assert np.all(np.linalg.norm(np.diff(positions[:,:2], axis = 0), axis = 1) <= 1.2*2.0) #consecutive poses are close to each other
+(network_poses, _) = network_generator.create_network('trajectory:300:2', 'window:3', 7)
+assert np.array_equal(network_poses[300].position, network_generator.create_network('trajectory:300:2', 'window:3', 7)[0][300].position)
+positions = np.reshape([pose.position for pose in network_poses.values()], (-1,3))
+distances = np.linalg.norm(positions[:,None,:] - positions[None,:,:], axis = 2)
+(from_indices, to_indices) = network_generator.get_distance_edges(positions, 5.0)
+assert {(int(i), int(j)) for (i, j) in zip(from_indices, to_indices)} == {(i, j) for (i, j) in zip(*np.nonzero(np.triu(distances <= 5.0, 1)))}
+(from_indices, to_indices) = network_generator.get_distance_edges(positions, 5.0, 1)
+assert np.all(distances[from_indices, to_indices] <= 5.0) and np.all(from_indices < to_indices)
+assert set(range(300)) <= set(from_indices.tolist()) | set(to_indices.tolist()) #every pose is connected with its nearest neighbour
+isolated_graph = network_generator.create_graph(network_poses, 'distance', 0.1)
+assert len(isolated_graph.edges) == 0 and len(isolated_graph.nodes) == 300 and len(isolated_graph.get_connected_components()) == 300
+assert network_generator.parse_graph('distance:2.5:4') == ('distance', 2.5, 4)
+for (network, graph) in (('grid', 'window:2'), ('grid:1', 'window:2'), ('corridor:10:0', 'window:2'), ('grid:10', 'window:1.5'), ('grid:10', 'window:2:3')):
+    try:
+        network_generator.create_network(network, graph, 1)
+        assert False, 'invalid network description must be rejected'
+    except ValueError:
+        pass
+
+print ('testing out-of-core simulation...')
+
+assert geo.get_breadth_first_order({1: {2, 3}, 2: {1, 4}, 3: {1}, 4: {2}, 5: set()}, [4, 1, 2, 3, 5]) == [4, 2, 1, 3, 5]
+config = SimulationConfig.Config()
+config.feature_generation_engine = 'batch'
+config.number_of_features_per_cloud = 300
+in_memory_simulator = Simulator.Simulator(config, 5)
+in_memory_simulator.run_simulations(test_poses, test_graph)
+with tempfile.TemporaryDirectory() as scratch_directory:
+    config.memory_budget_mb = 0.01 #a few reference poses per run
+    config.scratch_directory = scratch_directory
+    out_of_core_simulator = Simulator.Simulator(config, 5)
+    out_of_core_simulator.run_simulations(test_poses, test_graph)
+    spilled_store = out_of_core_simulator.feature_store
+    assert isinstance(spilled_store, FeatureStore.SpilledFeatureStore) and spilled_store.number_of_runs > 1
+    assert out_of_core_simulator.statistics['spilled_runs'] == spilled_store.number_of_runs
+    assert len(spilled_store) == len(in_memory_simulator.feature_store)
+    for ((pose_id, columns), (expected_pose_id, expected_columns)) in zip(spilled_store.pose_views(), in_memory_simulator.feature_store.pose_views()):
+        assert pose_id == expected_pose_id
+        assert all(np.array_equal(columns[name], expected_columns[name]) for name in FeatureStore.SpilledFeatureStore.column_names)
+    with tempfile.TemporaryDirectory() as output_directory:
+        io.save_all_feature_data(output_directory, out_of_core_simulator, test_poses, 'npy')
+        feature_data = io.read_binary_output(os.path.join(output_directory, 'feature_data'))
+        assert np.array_equal(feature_data['number_of_measurements'], in_memory_simulator.feature_store.number_of_measurements)
+        del feature_data
+    expected_store = in_memory_simulator.feature_store
+    assert np.array_equal(spilled_store.unique_feature_ids, expected_store.unique_feature_ids)
+    for feature_id in expected_store.unique_feature_ids[::37].tolist() + [0]:
+        assert np.array_equal(spilled_store.get_visibility(feature_id), expected_store.get_visibility(feature_id))
+    for (first_row, last_row) in ((0, None), (7, 301), (len(expected_store) - 5, None), (3, 3)):
+        columns = spilled_store.get_columns(first_row, last_row)
+        expected_columns = expected_store.get_columns(first_row, last_row)
+        assert all(np.array_equal(columns[name], expected_columns[name]) for name in FeatureStore.SpilledFeatureStore.column_names)
+    spilled_store.update_positions(lambda columns: columns['position'].__iadd__(columns['feature_id'][:,np.newaxis]))
+    assert np.array_equal(spilled_store.get_columns()['position'], expected_store.positions + expected_store.feature_ids[:,np.newaxis])
+    spilled_store.close()
+    assert os.listdir(scratch_directory) == []
+benchmark_config = SimulationConfig.Config()
+benchmark_config.feature_generation_engine = 'batch'
+benchmark_config.number_of_features_per_cloud = 200
+benchmark_config.output_format = 'npy'
+benchmark_config.min_vertical_angle_deg = 0.2
+with tempfile.TemporaryDirectory() as in_memory_directory, tempfile.TemporaryDirectory() as out_of_core_directory, tempfile.TemporaryDirectory() as scratch_directory:
+    in_memory_case = benchmark.run_case(in_memory_directory, benchmark_config, 30, 4.0, 3)
+    benchmark_config.memory_budget_mb = 0.01
+    benchmark_config.scratch_directory = scratch_directory
+    out_of_core_case = benchmark.run_case(out_of_core_directory, benchmark_config, 30, 4.0, 3) #noise is added to the spilled runs in place
+    assert all(in_memory_case[key] == out_of_core_case[key] for key in ('number_of_observations', 'number_of_features'))
+    for name in ('lidar_measurements', 'feature_data'):
+        (in_memory_output, out_of_core_output) = (io.read_binary_output(os.path.join(directory, name)) for directory in (in_memory_directory, out_of_core_directory))
+        assert all(np.allclose(in_memory_output[column], out_of_core_output[column], rtol = 0.0, atol = 1e-12) for column in in_memory_output.keys())
+        del in_memory_output, out_of_core_output
+    assert os.listdir(scratch_directory) == []
+empty_store = FeatureStore.SpilledFeatureStore([1, 2], 1000)
+empty_store.append({'pose_id': np.array([2]), 'feature_id': np.array([7]), 'number_of_measurements': np.array([1], dtype = np.int32),
+                    'position': np.zeros((1,3)), 'covariance': np.zeros((1,3,3), dtype = np.float32)})
+empty_store.finish()
+assert len(empty_store.get_pose_view(1)['feature_id']) == 0 and empty_store.get_pose_view(1)['covariance'].dtype == np.float32
+assert empty_store.get_pose_view(2)['feature_id'].tolist() == [7]
+empty_store.close()
+assert not os.path.exists(empty_store.directory)
+
+print ('testing concurrent writers...')
+
+def read_files(directory:str):
+    return {file_name: open(os.path.join(directory, file_name), 'rb').read() for file_name in sorted(os.listdir(directory))}
+
+class WriterStopped(BaseException):
+    pass
+
+class FailingWriter:
+    def __init__(self, error:BaseException):
+        self.error = error
+
+    def write(self, columns):
+        raise self.error
+
+config = SimulationConfig.Config()
+config.feature_generation_engine = 'batch'
+config.number_of_features_per_cloud = 300
+config.export_problem_structure = True
+simulator = Simulator.Simulator(config, 5)
+simulator.run_simulations(test_poses, test_graph)
+with tempfile.TemporaryDirectory() as sequential_directory, tempfile.TemporaryDirectory() as concurrent_directory:
+    sequential_results = io.run_writers(io.get_output_writers(sequential_directory, simulator, test_poses), 1)
+    concurrent_results = io.run_writers(io.get_output_writers(concurrent_directory, simulator, test_poses), 4)
+    assert list(concurrent_results.keys()) == ['save_features', 'save_all_feature_data', 'save_network_to_dxf', 'save_problem_structure', 'save_poses']
+    assert all(result['error'] is None for result in list(sequential_results.values()) + list(concurrent_results.values()))
+    assert read_files(sequential_directory) == read_files(concurrent_directory)
+    writers = io.get_output_writers(concurrent_directory, simulator, test_poses)
+    writers['save_features'] = (io.save_features, (os.path.join(concurrent_directory, 'missing'), simulator))
+    results = io.run_writers(writers, 4)
+    assert 'FileNotFoundError' in results['save_features']['error']
+    assert all(result['error'] is None for (name, result) in results.items() if name != 'save_features')
+config.export_problem_structure = False
+config.use_streaming = True
+with tempfile.TemporaryDirectory() as sequential_directory, tempfile.TemporaryDirectory() as concurrent_directory:
+    for (number_of_writer_threads, directory) in ((1, sequential_directory), (3, concurrent_directory)):
+        config.number_of_writer_threads = number_of_writer_threads
+        io.save_simulation_streaming(directory, Simulator.Simulator(config, 5), test_poses, test_graph)
+    assert read_files(sequential_directory) == read_files(concurrent_directory)
+for (error, expected_type, expected_message) in ((OSError('disk full'), OSError, 'Error! Writing test.txt failed: disk full'),
+                                                 (ValueError('bad row'), ValueError, 'bad row'), (WriterStopped('stopped'), WriterStopped, 'stopped')):
+    background_writer = io.BackgroundWriter(FailingWriter(error), 'test.txt', 1)
+    try:
+        for _ in range(10): #the failed writer keeps draining the queue, so writes do not block
+            background_writer.write({})
+        background_writer.stop()
+        background_writer.raise_error()
+        assert False
+    except expected_type as raised_error:
+        assert str(raised_error) == expected_message
+    background_writer.stop()
+    assert not background_writer.thread.is_alive()
 
 print("tests passed")
\ No newline at end of file
@@ -1,32 +1,77 @@
-import random
 import numpy as np
 
+#every subsystem draws from its own random streams, so changing one of them does not change results of the others
+random_streams = ('features', 'matching', 'point_noise', 'pose_noise', 'network')
+
+def get_seed(seed:int = None):
+    #returns seed that should be used for the simulation, a new random one if seed is not given
+    if seed is None:
+        return np.random.SeedSequence().entropy
+    return int(seed)
+
+def create_random_generator(seed:int, stream:str, key:int = None):
+    #generator of stream derived deterministically from seed, key allows independent sub-streams, e.g. for every reference pose
+    spawn_key = (random_streams.index(stream),) if key is None else (random_streams.index(stream), int(key) % 2**64)
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key = spawn_key))
+
 def deg_to_rad(deg):
     rad = 0.01745329251994329576923690768489*deg
     return rad
 
 
-def gaussian_noise_with_limit(sigma):
+noise_limit = 7 #noise is clipped to noise_limit*sigma
+
+def gaussian_noise_with_limit(sigma, rng:np.random.Generator):
     #this function allows to avoid randomly sampling of large outliers
-    limit = 7
-    noise = random.gauss(0.0, sigma)
-    if noise > limit*sigma:
-        noise = limit
-    if noise < -limit*sigma:
-        noise = -limit
+    noise = rng.normal(0.0, sigma)
+    if noise > noise_limit*sigma:
+        noise = noise_limit*sigma
+    if noise < -noise_limit*sigma:
+        noise = -noise_limit*sigma
     return noise
 
+def gaussian_noise_with_limit_batch(sigma, shape, rng:np.random.Generator):
+    #vectorized version of gaussian_noise_with_limit
+    return sigma*np.clip(rng.standard_normal(shape), -noise_limit, noise_limit)
+
+def get_square_root_factors(covariances):
+    #returns N x 3 x 3 stack of matrices L such that L@L.T equals covariance, Cholesky factors if all covariances are positive definite
+    try:
+        return np.linalg.cholesky(covariances)
+    except np.linalg.LinAlgError: #some covariances are singular (e.g. points on the vertical axis of the scanner)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariances)
+        return eigenvectors*np.sqrt(np.clip(eigenvalues, 0.0, None))[:,np.newaxis,:]
+
+def multivariate_gaussian_noise_with_limit(covariances, rng:np.random.Generator):
+    #samples N x 3 noise for N x 3 x 3 stack of covariances, standard normal samples are clipped to noise_limit
+    square_root_factors = get_square_root_factors(covariances)
+    standard_noise = np.clip(rng.standard_normal((len(covariances), 3)), -noise_limit, noise_limit)
+    return np.einsum('nij,nj->ni', square_root_factors, standard_noise)
+
 lie_alg_basis_x = np.array([[0,0,0],[0,0,-1],[0,1,0]])
 
 lie_alg_basis_y = np.array([[0,0,1],[0,0,0],[-1,0,0]])
 
 lie_alg_basis_z = np.array([[0,-1,0],[1,0,0],[0,0,0]])
 
-def generate_noise_on_so3(sigma):
+def generate_pose_noise_batch(number_of_poses:int, sigma_position, sigma_rotation, rng:np.random.Generator):
+    #returns N x 3 noise of positions and N x 3 rotation vectors (axis times angle) of noise on SO(3), drawn in one call in the same order
+    #as gaussian_noise_with_limit and generate_noise_on_so3 pose by pose (position first), components with zero sigma are not drawn
+    sigmas = [sigma for sigma in (sigma_position, sigma_rotation) if sigma > 0.0]
+    standard_noise = np.clip(rng.standard_normal((number_of_poses, 3*len(sigmas))), -noise_limit, noise_limit)
+    position_noise = np.zeros((number_of_poses, 3))
+    rotation_vectors = np.zeros((number_of_poses, 3))
+    if sigma_position > 0.0:
+        position_noise = sigma_position*standard_noise[:,0:3]
+    if sigma_rotation > 0.0:
+        rotation_vectors = sigma_rotation*standard_noise[:,-3:]
+    return position_noise, rotation_vectors
+
+def generate_noise_on_so3(sigma, rng:np.random.Generator):
     noise_rotation = np.eye(3)
-    ex = gaussian_noise_with_limit(sigma)
-    ey = gaussian_noise_with_limit(sigma)
-    ez = gaussian_noise_with_limit(sigma)
+    ex = gaussian_noise_with_limit(sigma, rng)
+    ey = gaussian_noise_with_limit(sigma, rng)
+    ez = gaussian_noise_with_limit(sigma, rng)
     e = np.array([ex,ey,ez])
     theta = np.linalg.norm(e)
     e *= (1.0/theta)